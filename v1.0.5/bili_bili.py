@@ -0,0 +1,5254 @@
+#!/usr/bin/env python3
+"""
+
+BiliBili Video Downloader (v1.0.5)
+--------------------------
+
+        pudszTTIOT
+
+--------------------------
+
+"""
+
+from __future__ import annotations
+import os
+import sys
+import shutil
+import tempfile
+import math
+import time
+import re
+import select
+import socket
+import sqlite3
+import json
+import queue
+import random
+import base64
+import string
+import struct
+import hashlib
+import heapq
+import itertools
+import zlib
+import argparse
+import contextlib
+import copy
+import dataclasses
+import cProfile
+import functools
+import io
+import pstats
+import tracemalloc
+import types
+import threading
+import subprocess
+import collections
+import ctypes
+import errno
+import datetime
+import http.client
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+# ---- Colors (Termux-safe ANSI) ----
+CSI = "\x1b["
+RESET = CSI + "0m"
+FG_RED = CSI + "31m"
+FG_GREEN = CSI + "32m"
+FG_YELLOW = CSI + "33m"
+FG_BLUE = CSI + "34m"
+FG_MAGENTA = CSI + "35m"
+FG_CYAN = CSI + "36m"
+
+def cprint(msg: str, color: str = RESET, end: str = "\n"):
+    # with --json, stdout carries only events and human-readable text moves to stderr
+    out = sys.stderr if EVENTS else sys.stdout
+    out.write(f"{color}{msg}{RESET}{end}")
+    out.flush()
+
+# ----- Ensure yt-dlp available -----
+try:
+    import yt_dlp
+except Exception:
+    cprint("[!] yt-dlp Python module not found.", FG_RED)
+    cprint("    Install/upgrade with: pip install -U 'yt-dlp[default]'", FG_YELLOW)
+    sys.exit(1)
+
+# ----- Helpers -----
+def human_size(num_bytes):
+    if num_bytes is None:
+        return "N/A"
+    num = float(num_bytes)
+    for unit in ['B','KB','MB','GB','TB','PB']:
+        if num < 1024:
+            return f"{num:.2f}{unit}"
+        num /= 1024.0
+    return f"{num:.2f}EB"
+
+def choose_download_dir():
+    home = Path.home()
+    candidates = [
+        home / "storage" / "downloads",
+        home / "storage" / "shared",
+        home / "downloads",
+        home
+    ]
+    for p in candidates:
+        if p.exists() and os.access(p, os.W_OK):
+            return str(p)
+    # fallback to cwd
+    return os.getcwd()
+
+def safe_filename(name: str) -> str:
+    # Make a filesystem-safe filename (reasonable for Android)
+    name = name.strip()
+    # replace problematic characters
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', name)
+    # collapse whitespace
+    name = re.sub(r'\s+', ' ', name)
+    return name
+
+def prompt_with_default(prompt: str, default: str = "") -> str:
+    if default:
+        return input(f"{FG_YELLOW}{prompt} [{default}]: {RESET}").strip() or default
+    else:
+        return input(f"{FG_YELLOW}{prompt}: {RESET}").strip()
+
+def parse_bv_av(url: str) -> str | None:
+    # Pull a BV... or av... id out of a URL (None if there isn't one)
+    m = re.search(r'(BV[0-9A-Za-z]{10})', url)
+    if m:
+        return m.group(1)
+    m = re.search(r'\bav(\d+)', url)
+    if m:
+        return 'av' + m.group(1)
+    return None
+
+def bounded_map(fn, items, workers: int = 4):
+    # Like ThreadPoolExecutor.map, but only keeps `workers` results in flight,
+    # so a slow consumer never has the whole batch sitting in memory.
+    workers = max(1, workers)
+    fn = egress_bound(fn)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# ----- Persistent state (watermarks, caches) -----
+def state_dir() -> Path:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(Path.home(), '.cache')
+    d = Path(base) / 'bili_bili'
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+def load_state(name: str, default=None):
+    try:
+        with open(state_dir() / name, encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {} if default is None else default
+
+def save_state(name: str, data) -> None:
+    # write-then-rename so a crash never leaves a half-written state file
+    path = state_dir() / name
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        json.dump(data, fh, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+# ----- Run metrics & adaptive concurrency (AIMD) -----
+class RunMetrics:
+    # Counters plus a bounded log of notable decisions; dumped with --metrics
+    def __init__(self, max_events: int = 5000):
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        self.counters = collections.Counter()
+        self.events = collections.deque(maxlen=max_events)
+
+    def count(self, key: str, n: int = 1):
+        with self.lock:
+            self.counters[key] += n
+
+    def event(self, kind: str, **fields):
+        with self.lock:
+            self.events.append({'t': round(time.time() - self.t0, 3), 'kind': kind, **fields})
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'elapsed': round(time.time() - self.t0, 3),
+                'counters': dict(self.counters),
+                'controllers': {name: c.state() for name, c in CONTROLLERS.items()},
+                'egress': EGRESS.state(),
+                'breakers': {name: b.info() for name, b in BREAKERS.items()},
+                'events': list(self.events),
+            }
+
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump(self.snapshot(), fh, ensure_ascii=False, indent=1)
+
+METRICS = RunMetrics()
+
+THROTTLE_HTTP = (412, 429)
+THROTTLE_API = (-412, -352, -509, -799)  # Bilibili's "request blocked / too frequent" codes
+
+def is_throttle_error(e: BaseException) -> bool:
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in THROTTLE_HTTP
+    if isinstance(e, ApiError):
+        return e.code in THROTTLE_API
+    # yt-dlp wraps HTTP errors in DownloadError/ExtractorError text
+    return bool(re.search(r'HTTP Error (412|429)|\((412|352)\)', str(e)))
+
+class AIMDController:
+    # Concurrency limit for one resource ('api' or 'cdn'). Every `window` seconds the
+    # limit grows by `increase` if the window saw no throttling, the limit was
+    # actually used, and throughput didn't fall; any throttle/error cuts it by
+    # `decrease` (at most once per half window, so a burst counts once).
+    def __init__(self, name: str, initial: int = 2, minimum: int = 1, maximum: int = 8,
+                 increase: int = 1, decrease: float = 0.5, window: float = 10.0, adaptive: bool = True):
+        self.name = name
+        self.minimum, self.maximum = minimum, max(minimum, maximum)
+        self.limit = max(self.minimum, min(initial, self.maximum))
+        self.increase, self.decrease, self.window = increase, decrease, window
+        self.adaptive = adaptive
+        self.cond = threading.Condition()
+        self.active = 0
+        self._reset_window(time.monotonic())
+        self._prev_byte_rate = self._prev_call_rate = 0.0
+        self._last_cut = 0.0
+
+    def _reset_window(self, now: float):
+        self._t0, self._bytes, self._ok, self._bad, self._peak = now, 0, 0, 0, self.active
+
+    def _set(self, new: int, action: str, reason: str):
+        old, self.limit = self.limit, new
+        METRICS.event('aimd', controller=self.name, action=action, old=old, new=new, reason=reason)
+        self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self._peak = max(self._peak, self.active)
+
+    def release(self, nbytes: int = 0, ok: bool = True, throttled: bool = False):
+        with self.cond:
+            self.active -= 1
+            now = time.monotonic()
+            if ok:
+                self._ok += 1
+                self._bytes += nbytes
+            else:
+                self._bad += 1
+                METRICS.count(f"{self.name}_{'throttled' if throttled else 'errors'}")
+                if self.adaptive and now - self._last_cut > self.window / 2 and self.limit > self.minimum:
+                    self._last_cut = now
+                    self._set(max(self.minimum, int(self.limit * self.decrease)), 'decrease',
+                              'throttled' if throttled else 'error')
+                    self._reset_window(now)
+            if now - self._t0 >= self.window:
+                # bytes/s when the window moved payload (CDN), completed calls/s otherwise (API);
+                # each is only compared with its own previous value
+                elapsed = now - self._t0
+                call_rate = self._ok / elapsed
+                if self._bytes:
+                    byte_rate = self._bytes / elapsed
+                    steady, reason = byte_rate >= self._prev_byte_rate * 0.95, f"rate {human_size(byte_rate)}/s"
+                    self._prev_byte_rate = byte_rate
+                else:
+                    steady, reason = call_rate >= self._prev_call_rate * 0.95, f"rate {call_rate:.1f} calls/s"
+                self._prev_call_rate = call_rate
+                if self.adaptive and not self._bad and self._ok and self._peak >= self.limit \
+                        and steady and self.limit < self.maximum:
+                    self._set(min(self.maximum, self.limit + self.increase), 'increase', reason)
+                self._reset_window(now)
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        # with controller.slot() as s: ... s.nbytes = n
+        s = types.SimpleNamespace(nbytes=0)
+        self.acquire()
+        try:
+            yield s
+        except Exception as e:
+            self.release(s.nbytes, ok=False, throttled=is_throttle_error(e))
+            raise
+        except BaseException:
+            # Ctrl-C / generator close: free the slot but say nothing about the resource
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+            raise
+        self.release(s.nbytes)
+
+    def state(self) -> dict:
+        with self.cond:
+            return {'limit': self.limit, 'active': self.active, 'min': self.minimum, 'max': self.maximum,
+                    'adaptive': self.adaptive}
+
+CONTROLLERS = {
+    'api': AIMDController('api', initial=2, maximum=6),
+    'cdn': AIMDController('cdn', initial=2, maximum=8),
+}
+
+def configure_controllers(cdn_max: int, adaptive: bool = True):
+    # -j sets the CDN ceiling; without adaptation the ceiling is used straight away.
+    # Each egress brings its own API allowance, so the API ceiling scales with the pool.
+    # The CDN start point follows this hour's history: cautious when it usually
+    # throttles, half the ceiling when it has been clean.
+    hist = CDN_STATS.hour(datetime.datetime.now().hour)
+    for name, ceiling in (('api', max(2, min(cdn_max, 6)) * max(1, len(EGRESS))), ('cdn', cdn_max)):
+        start = max(2, ceiling // 4) if adaptive else ceiling
+        if adaptive and name == 'cdn' and hist:
+            start = 1 if hist[1] > 0.2 else max(start, ceiling // 2) if hist[1] < 0.02 else start
+        CONTROLLERS[name] = AIMDController(name, initial=start, maximum=ceiling, window=5.0, adaptive=adaptive)
+
+# ----- Retry policy (error classes, backoff, circuit breaker) -----
+# A failure is put in one class and its policy decides what happens next: how
+# many times with_retry repeats the call in place, and how many times the batch
+# queue sends the whole job to the back of the line. Delays are exponential with
+# full jitter; requeues continue the exponent where the in-place tries stopped.
+# API calls also pass a circuit breaker (per egress) that stops all callers for
+# a while once throttling / network errors dominate its recent calls.
+BREAKER_WINDOW = 60.0           # s of API calls looked at
+BREAKER_MIN_CALLS = 10          # calls in the window before the ratio counts
+BREAKER_RATIO = 0.5             # share of failed calls that opens the breaker
+BREAKER_COOLDOWN = 30.0         # s open before one probe call; doubles while probes keep failing
+BREAKER_COOLDOWN_MAX = 600.0
+HOST_ERRORS = ('throttle', 'network')   # classes that say the host (not the video) is the problem
+API_AUTH_CODES = (-101, -111)           # not logged in / csrf check failed
+# yt-dlp's raise_login_required messages and the login hint it appends to them
+LOGIN_REQUIRED_RE = re.compile(r'for the authentication\b|only available for registered users'
+                               r'|for premium members only|You need to log ?in|账号未登录', re.I)
+API_REGION_CODES = (-10403, 6002003)
+API_MISSING_CODES = (-404, 62002, 62004, 62012)
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class RetryPolicy:
+    tries: int              # calls in place (with_retry), including the first
+    requeues: int           # times a failed job goes to the back of the queue
+    base: float = 1.0       # s; backoff ceiling is base * 2**n, capped
+    cap: float = 60.0
+
+    def delay(self, n: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** n))
+
+RETRY_POLICIES = {
+    'throttle': RetryPolicy(tries=5, requeues=3, base=2.0, cap=300.0),
+    'network': RetryPolicy(tries=3, requeues=2, base=1.0, cap=60.0),
+    'expired': RetryPolicy(tries=3, requeues=1, base=1.0, cap=10.0),   # each try re-extracts (download_vid)
+    'auth': RetryPolicy(tries=1, requeues=0),       # cookies missing or expired: retrying can't help
+    'region': RetryPolicy(tries=1, requeues=0),
+    'missing': RetryPolicy(tries=1, requeues=0),    # deleted / hidden video, no matching format
+    'storage': RetryPolicy(tries=1, requeues=0),
+    'other': RetryPolicy(tries=1, requeues=1, base=10.0, cap=60.0),
+}
+ERROR_HINTS = {
+    'auth': "log-in required or cookies expired: refresh cookies.txt",
+    'region': "region-locked: try an --egress in an allowed region",
+    'throttle': "rate-limited by Bilibili: lower -j or wait a few minutes",
+}
+
+def error_chain(e: BaseException):
+    # the error plus what it wraps: DownloadError.exc_info, ExtractorError.cause, __cause__
+    seen = set()
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+        yield e
+        exc_info = getattr(e, 'exc_info', None)
+        e = (exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None) \
+            or getattr(e, 'cause', None) or e.__cause__ or e.__context__
+        if not isinstance(e, BaseException):
+            e = None
+
+def _http_status(e: BaseException) -> int | None:
+    # urllib's HTTPError has .code, yt-dlp's networking HTTPError .status
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code
+    status = getattr(e, 'status', None)
+    return status if isinstance(status, int) else None
+
+def classify_error(e: BaseException) -> str:
+    # -> one of RETRY_POLICIES
+    chain = list(error_chain(e))
+    codes = {x.code for x in chain if isinstance(x, ApiError)}
+    statuses = {s for s in map(_http_status, chain) if s}
+    text = ' | '.join(str(x) for x in chain)
+    if any(is_throttle_error(x) for x in chain):
+        return 'throttle'
+    if codes & set(API_REGION_CODES) or any(isinstance(x, yt_dlp.utils.GeoRestrictedError) for x in chain) \
+            or re.search(r'geo.?restrict|region.?lock|not available in your (country|region)|地区|区域', text, re.I):
+        return 'region'
+    if codes & set(API_AUTH_CODES) or LOGIN_REQUIRED_RE.search(text):
+        return 'auth'
+    if codes & set(API_MISSING_CODES) or 404 in statuses or re.search(
+            r'HTTP Error 404|404: Not Found|does not exist|has been deleted|Video unavailable|啥都木有|稿件不可见'
+            r'|no format matches|Requested format is not available', text, re.I):
+        return 'missing'
+    if 403 in statuses or any(is_url_expired_error(x) for x in chain):
+        return 'expired'
+    if any(isinstance(x, StorageFull) or getattr(x, 'errno', None) in (errno.ENOSPC, errno.EDQUOT) for x in chain):
+        return 'storage'
+    if any(s >= 500 for s in statuses) or any(is_transient_error(x) for x in chain):
+        return 'network'
+    return 'other'
+
+def error_summary(e: BaseException) -> str:
+    cls = classify_error(e)
+    hint = ERROR_HINTS.get(cls)
+    return f"[{cls}] {e}" + (f" ({hint})" if hint else '')
+
+class CircuitBreaker:
+    # closed: calls pass, outcomes kept for BREAKER_WINDOW seconds.
+    # open: every caller waits out the cooldown - no requests are spent.
+    # half-open: one probe call goes through; success closes, failure reopens
+    # with twice the cooldown.
+    def __init__(self, name: str):
+        self.name = name
+        self.cond = threading.Condition()
+        self.calls = collections.deque()    # (monotonic time, failed)
+        self.state = 'closed'
+        self.until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = None                 # thread id of the half-open probe call
+        self.trips = 0
+
+    def wait(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.state == 'open' and now >= self.until:
+                    self.state = 'half-open'
+                if self.state == 'closed':
+                    return
+                if self.state == 'half-open' and not self.probing:
+                    self.probing = threading.get_ident()
+                    return
+                self.cond.wait(self.until - now if self.state == 'open' else None)
+
+    def record(self, failed: bool):
+        with self.cond:
+            now = time.monotonic()
+            if self.state == 'half-open' and self.probing:
+                self.probing = None
+                if failed:
+                    self._open(now)
+                else:
+                    self.state, self.cooldown = 'closed', BREAKER_COOLDOWN
+                    self.calls.clear()
+                    METRICS.event('breaker', name=self.name, action='close')
+                    cprint(f"[i] {self.name}: calls succeed again, resuming", FG_CYAN)
+                self.cond.notify_all()
+                return
+            if self.state != 'closed':
+                return  # stragglers started before the breaker opened
+            self.calls.append((now, failed))
+            while self.calls and self.calls[0][0] < now - BREAKER_WINDOW:
+                self.calls.popleft()
+            bad = sum(f for _, f in self.calls)
+            if len(self.calls) >= BREAKER_MIN_CALLS and bad >= BREAKER_RATIO * len(self.calls):
+                self._open(now)
+
+    def release(self):
+        # a probe that ended without an outcome (Ctrl-C, SystemExit) lets the next caller probe
+        with self.cond:
+            if self.probing == threading.get_ident():
+                self.probing = None
+                self.cond.notify_all()
+
+    def _open(self, now: float):
+        self.state, self.until = 'open', now + self.cooldown
+        self.trips += 1
+        METRICS.count('breaker_trips')
+        METRICS.event('breaker', name=self.name, action='open', seconds=self.cooldown)
+        cprint(f"[!] {self.name}: too many failed calls, pausing for {self.cooldown:.0f}s", FG_YELLOW)
+        self.cooldown = min(BREAKER_COOLDOWN_MAX, self.cooldown * 2)
+        self.calls.clear()
+        self.cond.notify_all()
+
+    def info(self) -> dict:
+        with self.cond:
+            return {'state': self.state, 'trips': self.trips,
+                    'open_for': round(max(0.0, self.until - time.monotonic()), 1) if self.state == 'open' else 0}
+
+BREAKERS = {}
+_breakers_lock = threading.Lock()
+
+def api_breaker() -> CircuitBreaker:
+    # one breaker per egress: a throttled proxy shouldn't stop the others
+    egress = current_egress()
+    name = f"API via {egress.name}" if egress else "API"
+    with _breakers_lock:
+        if name not in BREAKERS:
+            BREAKERS[name] = CircuitBreaker(name)
+        return BREAKERS[name]
+
+def with_retry(fn, controller: str = 'api', attempts: int | None = None):
+    # Run fn(slot) under the controller, repeating it in place as the error's class
+    # allows (RETRY_POLICIES; attempts overrides the count) with full-jitter backoff
+    breaker = api_breaker() if controller == 'api' else None
+    for n in itertools.count():
+        if breaker:
+            breaker.wait()
+        try:
+            with CONTROLLERS[controller].slot() as s:
+                result = fn(s)
+        except Exception as e:
+            cls = classify_error(e)
+            if breaker:
+                breaker.record(cls in HOST_ERRORS)
+            policy = RETRY_POLICIES[cls]
+            if n + 1 >= (attempts or policy.tries):
+                raise
+            delay = policy.delay(n)
+            if cls == 'throttle' and current_egress():
+                EGRESS.throttled(current_egress())
+            METRICS.count(f"{controller}_retries")
+            METRICS.event('retry', controller=controller, attempt=n + 1, error_class=cls, delay=round(delay, 2),
+                          error=str(e)[:200])
+            time.sleep(delay)
+            continue
+        else:
+            if breaker:
+                breaker.record(False)
+        finally:
+            if breaker:
+                breaker.release()
+        return result
+
+# ----- Egress pool (--egress: proxies / source addresses) -----
+# Each batch job leases one egress for its whole life: extraction, API calls
+# and CDN transfers all leave through the same proxy or local address, so a
+# per-IP throttle on one egress only slows the jobs pinned to it.
+EGRESS_CHECK_URL = 'https://api.bilibili.com/x/web-interface/zone'
+EGRESS_CHECK_EVERY = 60.0       # s between health checks of an egress marked down
+EGRESS_CHECK_TIMEOUT = 10
+EGRESS_REST = 30.0              # s an egress sits out after a throttle; doubles per repeat
+EGRESS_REST_MAX = 600.0
+EGRESS_FAILS = 3                # consecutive network failures before an egress is marked down
+EGRESS_ALPHA = 0.3              # EWMA weight of a job's throughput in the score
+EGRESS_LIMIT = 2               # jobs at once per egress unless the spec says limit=N
+EGRESS_KINDS = ('src', 'http', 'socks4', 'socks4a', 'socks5', 'socks5h')
+EGRESS_HEAD_MAX = 16 * 1024     # bytes of CONNECT reply header accepted from a proxy
+
+_egress_local = threading.local()
+
+def current_egress():
+    return getattr(_egress_local, 'current', None)
+
+@contextlib.contextmanager
+def use_egress(egress):
+    prev = current_egress()
+    _egress_local.current = egress
+    try:
+        yield egress
+    finally:
+        _egress_local.current = prev
+
+def egress_bound(fn):
+    # Carry the calling thread's egress into pool threads
+    egress = current_egress()
+    if egress is None:
+        return fn
+    def run(*args, **kwargs):
+        with use_egress(egress):
+            return fn(*args, **kwargs)
+    return run
+
+class Egress:
+    # "http://[user:pw@]host:port", "socks5h://host:port" (socks4/4a/5 too) or
+    # a local source address ("src:192.0.2.10" or just the address). TLS to the
+    # proxy itself (https://) is not supported: CONNECT is sent in the clear.
+    def __init__(self, spec: str, limit: int = 2):
+        if '://' not in spec:
+            spec = 'src://' + spec.removeprefix('src:')
+        u = urllib.parse.urlsplit(spec)
+        if u.scheme == 'https':
+            raise ValueError(f"bad egress '{spec}': https:// proxies are not supported, use http:// or socks5://")
+        self.kind = u.scheme
+        if self.kind not in EGRESS_KINDS or not u.hostname:
+            raise ValueError(f"bad egress '{spec}' (expected http://, socks5://, ... or a source address)")
+        self.spec, self.host, self.user, self.password = spec, u.hostname, u.username, u.password
+        self.port = u.port or {'src': 0, 'http': 3128}.get(self.kind, 1080)
+        self.name = u.hostname if self.kind == 'src' else f"{self.kind}://{u.hostname}:{self.port}"
+        self.limit = max(1, limit)
+        self.active = 0
+        self.score = None           # bytes/s, EWMA over finished jobs
+        self.jobs = self.failed = self.throttles = 0
+        self.fails = 0              # consecutive network failures
+        self.streak = 0             # consecutive throttles (sets the rest length)
+        self.rest_until = 0.0
+        self.down = False
+        self.latency = None
+        self._classes = {}
+        self._openers = {}
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        # Drop-in for socket.create_connection, used by the http.client classes below
+        host, port = address
+        if self.kind == 'src':
+            return socket.create_connection(address, timeout, (self.host, 0))
+        if self.kind == 'http':
+            sock = socket.create_connection((self.host, self.port), timeout)
+            auth = ''
+            if self.user:
+                cred = base64.b64encode(f"{urllib.parse.unquote(self.user)}:"
+                                        f"{urllib.parse.unquote(self.password or '')}".encode()).decode()
+                auth = f"Proxy-Authorization: Basic {cred}\r\n"
+            sock.sendall(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n{auth}\r\n".encode())
+            # a byte at a time: whatever follows the header already belongs to the tunnel
+            head = bytearray()
+            while not head.endswith(b'\r\n\r\n'):
+                b = sock.recv(1)
+                if not b or len(head) >= EGRESS_HEAD_MAX:
+                    sock.close()
+                    raise ConnectionResetError(f"{self.name} sent no complete CONNECT reply for {host}:{port}")
+                head += b
+            line = head.split(b'\r\n', 1)[0].decode(errors='replace')
+            status = line.split(' ', 2)[1:2]
+            if status != ['200']:
+                sock.close()
+                why = 'proxy authentication required' if status == ['407'] else line
+                raise ConnectionRefusedError(f"{self.name} refused CONNECT to {host}:{port}: {why}")
+            return sock
+        from yt_dlp.socks import ProxyType, sockssocket
+        sock = sockssocket()
+        sock.setproxy({'socks4': ProxyType.SOCKS4, 'socks4a': ProxyType.SOCKS4A}.get(self.kind, ProxyType.SOCKS5),
+                      self.host, self.port, rdns=self.kind in ('socks4a', 'socks5h'),
+                      username=self.user and urllib.parse.unquote(self.user),
+                      password=self.password and urllib.parse.unquote(self.password))
+        if timeout is not None and timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(timeout)
+        try:
+            sock.connect((host, port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def connection_class(self, base):
+        # http.client.HTTP(S)Connection whose socket leaves through this egress
+        cls = self._classes.get(base)
+        if cls is None:
+            egress = self
+            class cls(base):
+                def __init__(self, *args, **kwargs):
+                    super().__init__(*args, **kwargs)
+                    self._create_connection = egress.create_connection
+            self._classes[base] = cls
+        return cls
+
+    def opener(self, opener=None):
+        # Same cookies as `opener`, connections through this egress
+        key = id(opener)
+        new = self._openers.get(key)
+        if new is None:
+            egress = self
+            class HTTPHandler(urllib.request.HTTPHandler):
+                def http_open(self, req):
+                    return self.do_open(egress.connection_class(http.client.HTTPConnection), req)
+            class HTTPSHandler(urllib.request.HTTPSHandler):
+                def https_open(self, req):
+                    return self.do_open(egress.connection_class(http.client.HTTPSConnection), req,
+                                        context=self._context)
+            cookies = [h for h in getattr(opener, 'handlers', ()) if isinstance(h, urllib.request.HTTPCookieProcessor)]
+            new = self._openers[key] = urllib.request.build_opener(*cookies, HTTPHandler, HTTPSHandler)
+        return new
+
+    def ydl_opts(self) -> dict:
+        return {'source_address': self.host} if self.kind == 'src' else {'proxy': self.spec}
+
+    def state(self) -> dict:
+        return {'name': self.name, 'limit': self.limit, 'active': self.active, 'score': self.score,
+                'jobs': self.jobs, 'failed': self.failed, 'throttles': self.throttles, 'down': self.down,
+                'resting': max(0.0, round(self.rest_until - time.time(), 1)), 'latency': self.latency}
+
+class EgressPool:
+    # Hands out egresses per job: the healthiest, least loaded, fastest first.
+    # Throttled egresses rest (longer each time); ones that keep failing at the
+    # network level are marked down until a background health check passes.
+    def __init__(self, egresses=()):
+        self.egresses = list(egresses)
+        self.cond = threading.Condition()
+        self._checker = None
+        self._stop = threading.Event()
+
+    def __bool__(self) -> bool:
+        return bool(self.egresses)
+
+    def __len__(self) -> int:
+        return len(self.egresses)
+
+    def check(self, e: Egress) -> bool:
+        # Any HTTP answer means the path works; a throttle answer also starts a rest
+        t0 = time.perf_counter()
+        ok, err = True, None
+        try:
+            with use_egress(e):
+                http_get(EGRESS_CHECK_URL, timeout=EGRESS_CHECK_TIMEOUT)
+        except urllib.error.HTTPError as exc:
+            if is_throttle_error(exc):
+                self.throttled(e)
+        except Exception as exc:
+            ok, err = False, exc
+        with self.cond:
+            e.latency = round(time.perf_counter() - t0, 3) if ok else None
+            e.down = not ok
+            e.fails = 0 if ok else e.fails
+            self.cond.notify_all()
+        METRICS.event('egress_check', egress=e.name, ok=ok, error=str(err)[:200] if err else None)
+        return ok
+
+    def start(self):
+        # Check everything once up front, then keep re-checking the ones that are down
+        for e, ok in zip(self.egresses, bounded_map(self.check, self.egresses, len(self.egresses))):
+            if ok:
+                cprint(f"[i] Egress {e.name}: ok ({e.latency * 1000:.0f} ms), up to {e.limit} job(s)", FG_CYAN)
+            else:
+                cprint(f"[!] Egress {e.name}: unreachable, retrying every {EGRESS_CHECK_EVERY:.0f}s", FG_YELLOW)
+        if self._checker is None:
+            self._checker = threading.Thread(target=self._check_loop, daemon=True)
+            self._checker.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._checker is not None:
+            self._checker.join(EGRESS_CHECK_TIMEOUT)
+            self._checker = None
+
+    def _check_loop(self):
+        while not self._stop.wait(EGRESS_CHECK_EVERY):
+            for e in [e for e in self.egresses if e.down]:
+                if self._stop.is_set():
+                    return
+                if self.check(e):
+                    cprint(f"[i] Egress {e.name} is back", FG_CYAN)
+
+    def _rank(self, e: Egress):
+        # unmeasured egresses first (so each gets tried), then throughput per running job
+        return (e.score is not None, -(e.score or 0) / (e.active + 1), e.active)
+
+    def acquire(self, pin: str | None = None) -> Egress:
+        with self.cond:
+            while True:
+                if all(e.down for e in self.egresses):
+                    raise ApiError("no usable egress: all are down")
+                now = time.time()
+                pinned = next((e for e in self.egresses if e.name == pin and not e.down), None)
+                if pin and pinned is None:
+                    METRICS.count('egress_unpinned')
+                    pin = None
+                pool = [pinned] if pinned else self.egresses
+                free = [e for e in pool if not e.down and e.rest_until <= now and e.active < e.limit]
+                if free:
+                    e = min(free, key=self._rank)
+                    e.active += 1
+                    return e
+                resting = [e.rest_until - now for e in pool if not e.down and e.rest_until > now]
+                self.cond.wait(min(resting) if resting else EGRESS_CHECK_EVERY)
+
+    def throttled(self, e: Egress):
+        with self.cond:
+            e.throttles += 1
+            e.streak += 1
+            rest = min(EGRESS_REST_MAX, EGRESS_REST * 2 ** (e.streak - 1))
+            e.rest_until = max(e.rest_until, time.time() + rest)
+        METRICS.event('egress_rest', egress=e.name, seconds=rest)
+
+    def release(self, e: Egress, nbytes: int = 0, seconds: float = 0.0, error: BaseException | None = None):
+        with self.cond:
+            e.active -= 1
+            e.jobs += 1
+            if error is None:
+                e.fails = e.streak = 0
+                if nbytes and seconds > 0:
+                    rate = nbytes / seconds
+                    e.score = rate if e.score is None else (1 - EGRESS_ALPHA) * e.score + EGRESS_ALPHA * rate
+            elif is_transient_error(error):
+                # other errors (deleted video, no format...) say nothing about the egress
+                e.failed += 1
+                e.fails += 1
+                if e.fails >= EGRESS_FAILS and not e.down:
+                    e.down = True
+                    METRICS.event('egress_down', egress=e.name, error=str(error)[:200])
+                    cprint(f"[!] Egress {e.name} marked down after {e.fails} failures: {error}", FG_YELLOW)
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def lease(self, pin: str | None = None):
+        # with EGRESS.lease() as lease: ... lease.nbytes = n  (no-op without --egress)
+        lease = types.SimpleNamespace(egress=None, nbytes=0)
+        if not self.egresses:
+            yield lease
+            return
+        lease.egress = e = self.acquire(pin)
+        t0 = time.monotonic()
+        try:
+            with use_egress(e):
+                yield lease
+        except BaseException as exc:
+            if is_throttle_error(exc):
+                self.throttled(e)
+            self.release(e, error=exc)
+            raise
+        self.release(e, lease.nbytes, time.monotonic() - t0)
+
+    def state(self) -> list:
+        with self.cond:
+            return [e.state() for e in self.egresses]
+
+    def report(self):
+        cprint(f"{'egress':<32} {'jobs':>5} {'failed':>6} {'throttled':>9} {'score':>10}  state", FG_MAGENTA)
+        for s in self.state():
+            score = f"{human_size(s['score'])}/s" if s['score'] is not None else '-'
+            status = 'down' if s['down'] else f"resting {s['resting']:.0f}s" if s['resting'] else 'ok'
+            cprint(f"{s['name']:<32} {s['jobs']:>5} {s['failed']:>6} {s['throttles']:>9} {score:>10}  {status}",
+                   FG_YELLOW if s['down'] or s['throttles'] else FG_CYAN)
+
+EGRESS = EgressPool()
+
+def egress_ydl_opts() -> dict:
+    e = current_egress()
+    return e.ydl_opts() if e else {}
+
+def egress_connection_class(base):
+    e = current_egress()
+    return e.connection_class(base) if e else base
+
+# ----- JSON-lines events (--json) -----
+EVENT_FLUSH_EVERY = 0.5     # s; events are written and flushed in batches
+EVENT_QUEUE_MAX = 10000
+PROGRESS_EVERY = 1.0        # s between progress ticks per file
+
+class EventWriter:
+    # One JSON object per line. emit() only enqueues; a writer thread serialises
+    # and flushes in batches, so progress callbacks never wait on the pipe. When
+    # the consumer falls behind, progress ticks are dropped -- state changes never.
+    def __init__(self, stream, flush_every: float = EVENT_FLUSH_EVERY):
+        self.stream = stream
+        self.flush_every = flush_every
+        self.q = queue.Queue(maxsize=EVENT_QUEUE_MAX)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def emit(self, event: str, **fields):
+        rec = {'t': round(time.time(), 3), 'event': event, **fields}
+        if event != 'progress':
+            self.q.put(rec)
+            return
+        try:
+            self.q.put_nowait(rec)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self.q.get()]
+            flush_at = time.monotonic() + self.flush_every
+            while batch[-1] is not None:
+                wait = flush_at - time.monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    batch.append(self.q.get(timeout=wait))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if batch:
+                self.stream.write(''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in batch))
+                self.stream.flush()
+
+    def close(self):
+        if self.dropped:
+            self.emit('events_dropped', count=self.dropped)
+        self.q.put(None)
+        self.thread.join()
+
+EVENTS: EventWriter | None = None
+
+def emit(event: str, **fields):
+    if EVENTS:
+        EVENTS.emit(event, **fields)
+
+class ProgressTicker:
+    # Throttles progress events to one per PROGRESS_EVERY per key
+    def __init__(self, every: float = PROGRESS_EVERY):
+        self.every = every
+        self.last = {}
+
+    def due(self, key, final: bool = False) -> bool:
+        now = time.monotonic()
+        if final:
+            self.last.pop(key, None)
+            return True
+        if now - self.last.get(key, 0) < self.every:
+            return False
+        self.last[key] = now
+        return True
+
+_ydl_ticker = ProgressTicker()
+
+def event_progress_hook(d):
+    # yt-dlp progress_hooks entry for --json runs
+    if not EVENTS:
+        return
+    status = d.get('status')
+    name = os.path.basename(d.get('filename') or '')
+    if not _ydl_ticker.due(name, final=status != 'downloading'):
+        return
+    job = (d.get('info_dict') or {}).get('id')
+    if status == 'downloading':
+        emit('progress', job=job, file=name, downloaded=d.get('downloaded_bytes'),
+             total=d.get('total_bytes') or d.get('total_bytes_estimate'), speed=d.get('speed'), eta=d.get('eta'))
+    else:
+        emit('file', job=job, file=name, state=status, bytes=d.get('total_bytes') or d.get('downloaded_bytes'))
+
+# ----- Profiling (--profile) -----
+# Each phase (extract, download, postprocess, text) gets its own cProfile data,
+# merged across jobs and threads; tracemalloc snapshots are taken as phases end.
+PROFILE_SNAPSHOT_EVERY = 5.0    # s; at most one snapshot per phase per interval
+PROFILE_TOP = 15
+
+class PhaseProfiler:
+    def __init__(self, out_dir: str):
+        self.out_dir = os.path.abspath(os.path.expanduser(out_dir))
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {}
+        self.wall = collections.Counter()
+        self.calls = collections.Counter()
+        self.unprofiled = collections.Counter()
+        self.peak = collections.Counter()
+        self.snaps, self.snapped_at = {}, {}
+        tracemalloc.start()
+        self.baseline = tracemalloc.take_snapshot()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        # Nested phases are exclusive: the outer profiler pauses while an inner one runs
+        stack = self.local.__dict__.setdefault('stack', [])
+        if stack and stack[-1]:
+            stack[-1].disable()
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # 3.12+: one profiler per interpreter; a concurrent phase keeps wall time only
+            prof = None
+        stack.append(prof)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            if prof:
+                prof.disable()
+            stack.pop()
+            # bookkeeping first, so it never shows up in the outer phase's profile
+            self._record(name, prof, elapsed)
+            if stack and stack[-1]:
+                with contextlib.suppress(ValueError):
+                    stack[-1].enable()
+
+    def _record(self, name: str, prof, elapsed: float):
+        now = time.time()
+        with self.lock:
+            self.wall[name] += elapsed
+            self.calls[name] += 1
+            if prof is None:
+                self.unprofiled[name] += 1
+            elif name in self.stats:
+                self.stats[name].add(prof)
+            else:
+                self.stats[name] = pstats.Stats(prof)
+            self.peak[name] = max(self.peak[name], tracemalloc.get_traced_memory()[0])
+            if now - self.snapped_at.get(name, 0) < PROFILE_SNAPSHOT_EVERY:
+                return
+            self.snapped_at[name] = now
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        with self.lock:
+            self.snaps[name] = snap
+
+    def write(self):
+        tracemalloc.stop()
+        lines = []
+        for name in sorted(self.calls):
+            lines.append(f"=== {name}: {self.calls[name]} calls, {self.wall[name]:.2f}s wall, "
+                         f"traced memory up to {human_size(self.peak[name])} ===")
+            if self.unprofiled[name]:
+                lines.append(f"({self.unprofiled[name]} calls ran beside another profiled phase: wall time only)")
+            stats = self.stats.get(name)
+            if stats:
+                stats.dump_stats(os.path.join(self.out_dir, f"{name}.pstats"))
+                buf = io.StringIO()
+                stats.stream = buf
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+                lines.append(buf.getvalue().strip())
+            snap = self.snaps.get(name)
+            if snap:
+                lines.append(f"Top allocators (growth since start, at the last {name} boundary):")
+                for diff in snap.compare_to(self.baseline, 'lineno')[:10]:
+                    lines.append(f"  {diff}")
+            lines.append('')
+        path = os.path.join(self.out_dir, 'summary.txt')
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.write('\n'.join(lines))
+        for name in sorted(self.calls):
+            cprint(f"[i] profile {name:<11} {self.calls[name]:>6} calls {self.wall[name]:>9.2f}s "
+                   f"peak {human_size(self.peak[name])}", FG_CYAN)
+        cprint(f"[+] Profile written to {self.out_dir} (summary.txt, <phase>.pstats)", FG_GREEN)
+
+PROFILER: PhaseProfiler | None = None
+
+def profile_phase(name: str):
+    return PROFILER.phase(name) if PROFILER else contextlib.nullcontext()
+
+def profiled(name: str):
+    # Decorator form of profile_phase
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with profile_phase(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+# ----- Bilibili web API (plain urllib, shares the cookiefile with yt-dlp) -----
+API_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Linux; Android 12) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36',
+    'Referer': 'https://www.bilibili.com/',
+    'Accept-Encoding': 'gzip, deflate',
+}
+
+class ApiError(Exception):
+    def __init__(self, msg: str, code: int | None = None):
+        super().__init__(msg)
+        self.code = code
+
+def build_opener(cookiefile: str | None = None):
+    handlers = []
+    if cookiefile:
+        jar = http.cookiejar.MozillaCookieJar(cookiefile)
+        try:
+            jar.load(ignore_discard=True, ignore_expires=True)
+        except (OSError, http.cookiejar.LoadError):
+            cprint(f"[!] Could not load cookiefile for API calls: {cookiefile}", FG_YELLOW)
+        handlers.append(urllib.request.HTTPCookieProcessor(jar))
+    return urllib.request.build_opener(*handlers)
+
+def _decoded_chunks(resp, chunk_size: int = 64 * 1024):
+    # Yield the response body in decoded chunks (handles gzip / raw deflate)
+    encoding = (resp.headers.get('Content-Encoding') or '').lower()
+    if encoding == 'gzip':
+        dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        dec = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        dec = None
+    while True:
+        chunk = resp.read(chunk_size)
+        if not chunk:
+            break
+        yield dec.decompress(chunk) if dec else chunk
+    if dec:
+        tail = dec.flush()
+        if tail:
+            yield tail
+
+def http_open(url: str, opener=None, headers: dict | None = None, timeout: float = 15):
+    req = urllib.request.Request(url, headers={**API_HEADERS, **(headers or {})})
+    if current_egress():
+        opener = current_egress().opener(opener)
+    return (opener or urllib.request.build_opener()).open(req, timeout=timeout)
+
+def http_get(url: str, opener=None, headers: dict | None = None, timeout: float = 15) -> bytes:
+    with http_open(url, opener, headers, timeout) as resp:
+        return b''.join(_decoded_chunks(resp))
+
+def api_get(url: str, params: dict | None = None, opener=None, timeout: float = 15):
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    def call(_slot):
+        data = json.loads(http_get(url, opener, timeout=timeout))
+        if data.get('code', 0) != 0:
+            raise ApiError(f"{url}: code {data.get('code')} {data.get('message', '')}", data.get('code'))
+        return data.get('data')
+    return with_retry(call, 'api')
+
+_WBI_MIXIN = [
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+    33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40,
+    61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11,
+    36, 20, 34, 44, 52,
+]
+_wbi_cache = {'key': None, 'ts': 0.0}
+_wbi_lock = threading.Lock()
+
+def wbi_sign(params: dict, opener=None) -> dict:
+    # Same WBI signature the web player (and yt-dlp) uses; the key rotates daily-ish
+    with _wbi_lock:
+        if not _wbi_cache['key'] or time.time() > _wbi_cache['ts'] + 3600:
+            # nav answers -101 when logged out, but still carries the wbi images
+            nav = json.loads(http_get('https://api.bilibili.com/x/web-interface/nav', opener)).get('data') or {}
+            img = nav.get('wbi_img') or {}
+            lookup = ''.join(u.rpartition('/')[2].partition('.')[0]
+                             for u in (img.get('img_url') or '', img.get('sub_url') or ''))
+            if len(lookup) < 64:
+                raise ApiError("could not obtain WBI signing key")
+            _wbi_cache.update(key=''.join(lookup[i] for i in _WBI_MIXIN)[:32], ts=time.time())
+        key = _wbi_cache['key']
+    params = {**params, 'wts': round(time.time())}
+    params = {k: ''.join(c for c in str(v) if c not in "!'()*") for k, v in sorted(params.items())}
+    params['w_rid'] = hashlib.md5((urllib.parse.urlencode(params) + key).encode()).hexdigest()
+    return params
+
+def _vid_params(vid: str) -> dict:
+    return {'aid': vid[2:]} if vid.startswith('av') else {'bvid': vid}
+
+@profiled('extract')
+def fetch_view(vid: str, opener=None) -> dict:
+    # Basic video info: title, owner, pubdate and the page (cid) list
+    return api_get('https://api.bilibili.com/x/web-interface/view', _vid_params(vid), opener)
+
+# ----- Automatic cookiefile detection -----
+def auto_detect_cookiefile() -> str | None:
+    possible_names = ["cookies.txt", "bili_cookies.txt", "cookies2.txt", "bilibili_cookies.txt"]
+    search_dirs = [
+        Path.home(),
+        Path.home() / "storage" / "downloads",
+        Path.home() / "storage" / "shared",
+        Path.home() / "Download",
+        Path("/sdcard/Download"),
+        Path("/sdcard"),
+    ]
+    found = []
+    for d in search_dirs:
+        try:
+            for name in possible_names:
+                candidate = d / name
+                if candidate.exists() and candidate.is_file():
+                    found.append(str(candidate))
+        except Exception:
+            continue
+    if not found:
+        return None
+    # Prefer the one in storage/downloads if present
+    for f in found:
+        if "/storage" in f or "/sdcard" in f:
+            cprint(f"[+] Auto-detected cookiefile: {f}", FG_CYAN)
+            return f
+    cprint(f"[+] Auto-detected cookiefile: {found[0]}", FG_CYAN)
+    return found[0]
+
+# ----- Format size probing -----
+SIZE_CACHE = 'format_sizes.json'
+SIZE_CACHE_MAX_VIDEOS = 2000
+SIZE_PROBE_TIMEOUT = 4
+SIZE_PROBE_WORKERS = 8
+
+_probe_local = threading.local()
+_probe_pool = None
+
+def _probe_request(url: str, headers: dict, timeout: float):
+    # GET on a kept-alive connection per (thread, host); a 206 for one byte is
+    # drained so the connection can serve the next probe
+    u = urllib.parse.urlsplit(url)
+    conns = _probe_local.__dict__.setdefault('conns', {})
+    egress = current_egress()
+    key = (u.scheme, u.netloc, egress and egress.name)
+    for attempt in (0, 1):
+        conn = conns.get(key)
+        if conn is None:
+            cls = egress_connection_class(http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection)
+            conn = conns[key] = cls(u.netloc, timeout=timeout)
+        try:
+            conn.request('GET', u.path + (f"?{u.query}" if u.query else ''), headers=headers)
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conns.pop(key, None)
+            if attempt:
+                raise
+            continue
+        if resp.status == 206:
+            resp.read()
+        else:
+            # Range ignored (or an error): never read a whole stream just for its size
+            conn.close()
+            conns.pop(key, None)
+        return resp
+
+def probe_size(fmt: dict) -> int | None:
+    headers = {**CDN_HEADERS, **(fmt.get('http_headers') or {}), 'Range': 'bytes=0-0'}
+    try:
+        resp = _probe_request(fmt['url'], headers, SIZE_PROBE_TIMEOUT)
+    except (OSError, http.client.HTTPException):
+        return None
+    return _content_total(resp) if resp.status in (200, 206) else None
+
+def fill_format_sizes(formats, video_id: str | None = None) -> int:
+    # Fill missing 'filesize' from the on-disk cache, then by probing the rest in
+    # parallel. Returns how many formats got a size.
+    global _probe_pool
+    cache = load_state(SIZE_CACHE) if video_id else {}
+    known = dict(cache.get(video_id) or {})
+    missing, filled = [], 0
+    for f in formats:
+        if f.get('filesize') or f.get('filesize_approx'):
+            continue
+        fid = f.get('format_id')
+        if fid in known:
+            f['filesize'] = known[fid]
+            filled += 1
+        elif (f.get('url') or '').startswith('http') and f.get('protocol', 'https') in ('http', 'https'):
+            missing.append(f)
+    if missing:
+        if _probe_pool is None:
+            _probe_pool = ThreadPoolExecutor(max_workers=SIZE_PROBE_WORKERS)
+        for f, size in zip(missing, _probe_pool.map(egress_bound(probe_size), missing)):
+            if size:
+                f['filesize'] = known[f.get('format_id')] = size
+                filled += 1
+        if video_id:
+            cache[video_id] = {**known, '_t': int(time.time())}
+            if len(cache) > SIZE_CACHE_MAX_VIDEOS:
+                newest = sorted(cache, key=lambda k: cache[k].get('_t', 0), reverse=True)
+                cache = {k: cache[k] for k in newest[:SIZE_CACHE_MAX_VIDEOS]}
+            save_state(SIZE_CACHE, cache)
+    return filled
+
+def close_size_probes():
+    # The probe pool outlives single calls so its threads keep their kept-alive
+    # connections; main shuts it down (and those connections with it) at exit
+    global _probe_pool
+    if _probe_pool is not None:
+        _probe_pool.shutdown(wait=True)
+        _probe_pool = None
+
+# ----- Format list printing -----
+def print_format_list(formats, video_id: str | None = None):
+    fill_format_sizes(formats, video_id)
+    cprint("\nAvailable formats (top entries shown):", FG_BLUE)
+    filtered = [f for f in formats if 'format_id' in f]
+    sorted_f = sorted(filtered, key=lambda x: (x.get('height') or 0, x.get('filesize') or 0), reverse=True)
+    header = f"{'Idx':>4} {'format_id':>12} {'note':>12} {'res':>9} {'fps':>5} {'size':>10} {'type':>10}"
+    cprint(header, FG_MAGENTA)
+    for i, f in enumerate(sorted_f[:30], start=1):
+        fid = f.get('format_id') or ''
+        note = f.get('format_note') or ''
+        res = f"{f.get('width') or '?'}x{f.get('height') or '?'}"
+        fps = str(f.get('fps') or '')
+        size = human_size(f.get('filesize') or f.get('filesize_approx'))
+        typ = 'video+audio' if f.get('vcodec') != 'none' and f.get('acodec') != 'none' else ('video' if f.get('vcodec') != 'none' else 'audio')
+        line = f"{i:4d} {fid:>12} {note:>12} {res:>9} {fps:>5} {size:>10} {typ:>10}"
+        cprint(line)
+    cprint("\nIndex 0 = automatic BEST (bestvideo+bestaudio/best)", FG_BLUE)
+
+# ----- Progress hook for yt-dlp -----
+def make_progress_hook():
+    last_print = {'t': 0}
+    def hook(d):
+        status = d.get('status')
+        if status == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            downloaded = d.get('downloaded_bytes', 0)
+            pct = (downloaded / total * 100) if total else 0.0
+            speed = d.get('speed') or 0
+            eta = d.get('eta') or 0
+            now = time.time()
+            # throttle updates to ~5 per second
+            if now - last_print['t'] > 0.18:
+                last_print['t'] = now
+                sys.stdout.write(f"\r{FG_GREEN}Downloading: {pct:5.1f}% {human_size(downloaded)}/{human_size(total)}  ETA:{eta}s  {human_size(speed)}/s{RESET}")
+                sys.stdout.flush()
+        elif status == 'finished':
+            cprint("\n[+] Download finished, post-processing (if any) ...", FG_GREEN)
+        elif status == 'error':
+            cprint("\n[!] Error during download: " + str(d), FG_RED)
+    return hook
+
+# ----- Danmaku (bullet comments) & subtitles -----
+Danmaku = collections.namedtuple('Danmaku', 'time mode size color text')
+
+DM_SEGMENT_SECONDS = 360  # the web player fetches danmaku in 6-minute protobuf segments
+
+def iter_danmaku_xml(chunks):
+    # Incremental parse of comment.bilibili.com XML: elements are dropped as soon
+    # as they are read, so memory stays flat however many <d> entries there are.
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == 'd':
+                p = (elem.get('p') or '').split(',')
+                if len(p) >= 4 and elem.text:
+                    try:
+                        yield Danmaku(float(p[0]), int(p[1]), int(p[2]), int(p[3]), elem.text)
+                    except ValueError:
+                        pass
+            if elem is not root:
+                root.clear()
+    parser.close()
+
+def _pb_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def _pb_fields(buf):
+    # Minimal protobuf wire-format reader: yields (field_number, value)
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _pb_varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            val, pos = _pb_varint(buf, pos)
+        elif wire == 2:
+            length, pos = _pb_varint(buf, pos)
+            val = buf[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            val, pos = buf[pos:pos + 8], pos + 8
+        elif wire == 5:
+            val, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire}")
+        yield field, val
+
+def iter_danmaku_segment(data: bytes):
+    # DmSegMobileReply { repeated DanmakuElem elems = 1; }
+    # DanmakuElem: 2=progress(ms) 3=mode 4=fontsize 5=color 7=content
+    for field, elem in _pb_fields(memoryview(data)):
+        if field != 1:
+            continue
+        progress, mode, size, color, text = 0, 1, 25, 0xffffff, None
+        for f, v in _pb_fields(elem):
+            if f == 2:
+                progress = v
+            elif f == 3:
+                mode = v
+            elif f == 4:
+                size = v
+            elif f == 5:
+                color = v
+            elif f == 7:
+                text = bytes(v).decode('utf-8', 'replace')
+        if text:
+            yield Danmaku(progress / 1000.0, mode, size, color, text)
+
+def reorder_window(items, window: int = 4096):
+    # Near-sort a stream by time using a bounded heap (XML comes in dmid order);
+    # once the heap is full each item costs one heappushpop instead of a push and a pop
+    heap = []
+    for seq, item in enumerate(items):
+        if len(heap) < window:
+            heapq.heappush(heap, (item.time, seq, item))
+        else:
+            yield heapq.heappushpop(heap, (item.time, seq, item))[2]
+    heap.sort()
+    for entry in heap:
+        yield entry[2]
+
+def fetch_danmaku(cid: int, duration: float, opener=None, workers: int = 4):
+    # Protobuf segments fetched concurrently (in order, bounded prefetch);
+    # falls back to the single XML document when there is no usable segment API
+    # (404, or a reply that isn't protobuf). Any other error is the caller's.
+    n_segments = max(1, math.ceil((duration or 0) / DM_SEGMENT_SECONDS))
+    def get_segment(idx):
+        return http_get('https://api.bilibili.com/x/v2/dm/web/seg.so?'
+                        + urllib.parse.urlencode({'type': 1, 'oid': cid, 'segment_index': idx}), opener)
+    try:
+        first = sorted(iter_danmaku_segment(get_segment(1)), key=lambda d: d.time)
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        first = None
+    except (ValueError, IndexError):
+        first = None
+    if first is None:
+        METRICS.count('danmaku_xml_fallback')
+        with http_open(f'https://comment.bilibili.com/{cid}.xml', opener) as resp:
+            yield from reorder_window(iter_danmaku_xml(_decoded_chunks(resp)))
+        return
+    yield from first
+    for data in bounded_map(get_segment, range(2, n_segments + 1), workers):
+        yield from sorted(iter_danmaku_segment(data), key=lambda d: d.time)
+
+def _ass_time(t: float) -> str:
+    # called twice per event: divmod keeps it to three integer ops
+    s, cs = divmod(round(t * 100) if t > 0 else 0, 100)
+    m, s = divmod(s, 60)
+    return f"{m // 60}:{m % 60:02d}:{s:02d}.{cs:02d}"
+
+def _srt_time(t: float) -> str:
+    ms = int(round(max(t, 0) * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+def _text_width(text: str, font_size: int) -> float:
+    # CJK glyphs are roughly square, latin roughly half as wide
+    if text.isascii():
+        return len(text) * 0.55 * font_size
+    wide = sum(1 for ch in text if ch > '\u2e80')
+    return (wide + (len(text) - wide) * 0.55) * font_size
+
+def _ass_escape(text: str) -> str:
+    # ASS has no escape for a backslash: a zero-width joiner after it stops "\n",
+    # "\N", "\h" or "\{" in a comment from being read as a tag
+    return text.replace('\\', '\\\u200d').replace('{', '\\{').replace('}', '\\}').replace('\n', '\\N')
+
+def write_danmaku_ass(comments, fh, width: int = 1920, height: int = 1080, font_size: int = 48,
+                      scroll_time: float = 8.0, fixed_time: float = 4.0, font: str = 'sans-serif') -> int:
+    # Streams events straight to fh; lane state is the only thing kept around.
+    fh.write("[Script Info]\nScriptType: v4.00+\n"
+             f"PlayResX: {width}\nPlayResY: {height}\nWrapStyle: 2\nScaledBorderAndShadow: yes\n\n"
+             "[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+             "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+             "Alignment, MarginL, MarginR, MarginV, Encoding\n"
+             f"Style: Danmaku,{font},{font_size},&H33FFFFFF,&H33FFFFFF,&H33000000,&H00000000,"
+             "0,0,0,0,100,100,0,0,1,1.5,0,7,0,0,0,0\n\n"
+             "[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+    line_h = int(font_size * 1.15)
+    rows = max(1, int(height * 0.85) // line_h)
+    scroll_free = [0.0] * rows
+    top_free = [0.0] * rows
+    bottom_free = [0.0] * rows
+    count = 0
+    for dm in comments:
+        if dm.mode not in (1, 2, 3, 4, 5):
+            continue  # 7 = positioned/advanced, 8 = code, 9 = BAS: not representable here
+        size = max(12, int(font_size * (dm.size or 25) / 25))
+        w = _text_width(dm.text, size)
+        color = '' if dm.color == 0xffffff else f"\\c&H{dm.color & 0xff:02X}{dm.color >> 8 & 0xff:02X}{dm.color >> 16 & 0xff:02X}&"
+        if dm.mode in (1, 2, 3):
+            lanes, dur = scroll_free, scroll_time
+            row = next((i for i, t in enumerate(lanes) if t <= dm.time), None)
+            if row is None:
+                row = min(range(rows), key=lanes.__getitem__)
+            # lane frees up once this comment's tail has fully entered the screen
+            lanes[row] = dm.time + dur * w / (width + w)
+            y = row * line_h
+            pos = f"\\move({width},{y},{-int(w)},{y})"
+        else:
+            lanes, dur = (bottom_free, fixed_time) if dm.mode == 4 else (top_free, fixed_time)
+            row = next((i for i, t in enumerate(lanes) if t <= dm.time), None)
+            if row is None:
+                row = min(range(rows), key=lanes.__getitem__)
+            lanes[row] = dm.time + dur
+            if dm.mode == 4:
+                pos = f"\\an2\\pos({width // 2},{height - row * line_h})"
+            else:
+                pos = f"\\an8\\pos({width // 2},{row * line_h})"
+        fs = '' if size == font_size else f"\\fs{size}"
+        fh.write(f"Dialogue: 2,{_ass_time(dm.time)},{_ass_time(dm.time + dur)},Danmaku,,0,0,0,,"
+                 f"{{{pos}{color}{fs}}}{_ass_escape(dm.text)}\n")
+        count += 1
+    return count
+
+def write_danmaku_srt(comments, fh, show_time: float = 4.0) -> int:
+    count = 0
+    for count, dm in enumerate(comments, start=1):
+        fh.write(f"{count}\n{_srt_time(dm.time)} --> {_srt_time(dm.time + show_time)}\n{dm.text}\n\n")
+    return count
+
+def write_subtitle(body: list, fh, fmt: str = 'srt') -> int:
+    # body: Bilibili subtitle JSON lines, [{'from': s, 'to': s, 'content': str}, ...]
+    if fmt == 'ass':
+        fh.write("[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n"
+                 "[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+                 "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+                 "Alignment, MarginL, MarginR, MarginV, Encoding\n"
+                 "Style: Default,sans-serif,64,&H00FFFFFF,&H00FFFFFF,&H00000000,&H80000000,"
+                 "0,0,0,0,100,100,0,0,1,2,1,2,40,40,50,0\n\n"
+                 "[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+        for line in body:
+            fh.write(f"Dialogue: 0,{_ass_time(line['from'])},{_ass_time(line['to'])},Default,,0,0,0,,"
+                     f"{_ass_escape(line.get('content') or '')}\n")
+    else:
+        for idx, line in enumerate(body, start=1):
+            fh.write(f"{idx}\n{_srt_time(line['from'])} --> {_srt_time(line['to'])}\n{line.get('content') or ''}\n\n")
+    return len(body)
+
+LIST_NEST_MAX = 2   # playlist-of-playlists levels followed (seasons inside a series...)
+
+def iter_video_ids(url: str, cookiefile: str | None = None):
+    # A BV/av URL is yielded as-is; anything else (favorites, series, spaces...)
+    # is listed flat by yt-dlp, which costs one request per page, not per video.
+    # Unprocessed results keep the extractor's lazy entries, so pages are fetched
+    # as the consumer advances and no entry dict outlives its id.
+    vid = parse_bv_av(url)
+    if vid:
+        yield vid
+        return
+    opts = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist', 'skip_download': True,
+            **egress_ydl_opts()}
+    if cookiefile:
+        opts['cookiefile'] = cookiefile
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        with profile_phase('extract'):
+            info = ydl.extract_info(url, download=False, process=False)
+        yield from _iter_entry_ids(ydl, info)
+
+def _iter_entry_ids(ydl, info: dict, depth: int = 0):
+    kind = info.get('_type', 'video')
+    if kind in ('url', 'url_transparent'):
+        vid = parse_bv_av(info.get('url') or '')
+        if vid:
+            yield vid
+        elif depth < LIST_NEST_MAX:
+            with profile_phase('extract'):
+                sub = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+            yield from _iter_entry_ids(ydl, sub, depth + 1)
+        return
+    if kind != 'playlist':
+        vid = parse_bv_av(info.get('webpage_url') or info.get('id') or '')
+        if vid:
+            yield vid
+        return
+    entries = info.pop('entries', None) or ()
+    del info
+    for entry in entries:
+        if entry:
+            yield from _iter_entry_ids(ydl, entry, depth)
+
+@profiled('extract')
+def expand_video_ids(url: str, cookiefile: str | None = None) -> list:
+    return list(iter_video_ids(url, cookiefile))
+
+def iter_video_parts(url: str, opener=None, cookiefile: str | None = None):
+    # Yield (title, bvid, cid, duration) for every part behind a URL:
+    # a single video, a multi-part anthology, or any playlist yt-dlp can list.
+    vids = expand_video_ids(url, cookiefile)
+    part_wanted = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('p')
+    for v in vids:
+        try:
+            view = fetch_view(v, opener)
+        except Exception as e:
+            cprint(f"[!] Could not fetch video info for {v}: {e}", FG_RED)
+            continue
+        pages = view.get('pages') or [{'cid': view.get('cid'), 'page': 1, 'part': '', 'duration': view.get('duration')}]
+        for page in pages:
+            if part_wanted and len(vids) == 1 and str(page.get('page')) != part_wanted[0]:
+                continue
+            title = view.get('title') or v
+            if len(pages) > 1:
+                # same naming yt-dlp uses for anthology parts
+                title += f" p{page.get('page', 1):02d} {page.get('part') or ''}"
+            yield safe_filename(title), view.get('bvid') or v, page.get('cid'), page.get('duration') or 0
+
+@profiled('text')
+def fetch_text_tracks(part, out_dir: str, danmaku_fmt: str | None, subs_fmt: str | None,
+                      opener=None, workers: int = 4) -> dict:
+    title, bvid, cid, duration = part
+    result = {'title': title, 'danmaku': 0, 'subtitles': []}
+    if danmaku_fmt:
+        path = os.path.join(out_dir, f"{title}.danmaku.{danmaku_fmt}")
+        with open(path + '.part', 'w', encoding='utf-8') as fh:
+            comments = fetch_danmaku(cid, duration, opener, workers)
+            writer = write_danmaku_ass if danmaku_fmt == 'ass' else write_danmaku_srt
+            result['danmaku'] = writer(comments, fh)
+        os.replace(path + '.part', path)
+    if subs_fmt:
+        player = api_get('https://api.bilibili.com/x/player/wbi/v2', wbi_sign({'bvid': bvid, 'cid': cid}, opener),
+                         opener) or {}
+        tracks = [s for s in (player.get('subtitle') or {}).get('subtitles') or [] if s.get('subtitle_url')]
+        def get_track(s):
+            sub_url = s['subtitle_url']
+            if sub_url.startswith('//'):
+                sub_url = 'https:' + sub_url
+            return s.get('lan') or 'und', json.loads(http_get(sub_url, opener)).get('body') or []
+        for lan, body in bounded_map(get_track, tracks, workers):
+            path = os.path.join(out_dir, f"{title}.{safe_filename(lan)}.{subs_fmt}")
+            with open(path + '.part', 'w', encoding='utf-8') as fh:
+                write_subtitle(body, fh, subs_fmt)
+            os.replace(path + '.part', path)
+            result['subtitles'].append(lan)
+    return result
+
+def fetch_text_tracks_batch(urls, out_dir: str, danmaku_fmt: str | None, subs_fmt: str | None,
+                            cookiefile: str | None = None, jobs: int = 4):
+    opener = build_opener(cookiefile)
+    parts = (p for url in urls for p in iter_video_parts(url, opener, cookiefile))
+    def work(part):
+        try:
+            return fetch_text_tracks(part, out_dir, danmaku_fmt, subs_fmt, opener)
+        except Exception as e:
+            return {'title': part[0], 'error': str(e)}
+    for res in bounded_map(work, parts, jobs):
+        if 'error' in res:
+            cprint(f"[!] {res['title']}: {res['error']}", FG_RED)
+            continue
+        subs = ', '.join(res['subtitles']) or 'none'
+        cprint(f"[+] {res['title']}: {res['danmaku']} danmaku, subtitles: {subs}", FG_GREEN)
+
+def with_text_tracks(fn, danmaku_fmt: str | None, subs_fmt: str | None, cookiefile: str | None = None):
+    # Job hook for --danmaku/--subs in batch runs: once a video is downloaded its
+    # tracks go next to the first file. A track that fails is reported, the job isn't.
+    if not (danmaku_fmt or subs_fmt):
+        return fn
+    opener = build_opener(cookiefile)
+    def run(item):
+        files = fn(item)
+        if not files:
+            return files
+        # a planned anthology part (BV..._p2) only gets its own page's tracks
+        m = re.search(r'_p(\d+)$', getattr(item, 'id', None) or '')
+        url = f"https://www.bilibili.com/video/{job_id(item)}" + (f"?p={m.group(1)}" if m else '')
+        for part in iter_video_parts(url, opener):
+            try:
+                res = fetch_text_tracks(part, os.path.dirname(files[0][0]), danmaku_fmt, subs_fmt, opener)
+            except Exception as e:
+                METRICS.count('text_tracks_failed')
+                cprint(f"[!] {part[0]}: danmaku/subtitles failed: {error_summary(e)}", FG_YELLOW)
+                continue
+            cprint(f"[+] {res['title']}: {res['danmaku']} danmaku, subtitles: "
+                   f"{', '.join(res['subtitles']) or 'none'}", FG_GREEN)
+        return files
+    return run
+
+def bench_danmaku(n: int = 200_000):
+    # Synthetic large danmaku file -> ASS, reporting throughput and peak memory
+    rnd = random.Random(42)
+    words = ['哈哈哈', '前方高能', 'awsl', '2333', '名场面', 'xswl', '泪目', 'lol', '好耶', '来了来了']
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'bench.xml')
+        with open(src, 'w', encoding='utf-8') as fh:
+            fh.write('<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver>\n')
+            for i in range(n):
+                p = f"{rnd.uniform(0, 7200):.5f},{rnd.choice((1, 1, 1, 4, 5))},25,{rnd.choice((16777215, 16711680, 65280))},0,0,0,{i}"
+                fh.write(f'<d p="{p}">{rnd.choice(words)} {i}</d>\n')
+            fh.write('</i>\n')
+        size = os.path.getsize(src)
+        cprint(f"[i] Synthetic danmaku: {n} entries, {human_size(size)}", FG_CYAN)
+
+        def chunks(path):
+            with open(path, 'rb') as f:
+                while True:
+                    b = f.read(64 * 1024)
+                    if not b:
+                        break
+                    yield b
+
+        def streaming():
+            with open(os.path.join(tmp, 'bench.ass'), 'w', encoding='utf-8') as out:
+                return write_danmaku_ass(reorder_window(iter_danmaku_xml(chunks(src))), out)
+
+        def full_dom():
+            tree = ET.parse(src)
+            items = sorted((Danmaku(float(p[0]), int(p[1]), int(p[2]), int(p[3]), d.text)
+                            for d in tree.getroot().iter('d') for p in [d.get('p').split(',')]),
+                           key=lambda d: d.time)
+            with open(os.path.join(tmp, 'bench_dom.ass'), 'w', encoding='utf-8') as out:
+                return write_danmaku_ass(items, out)
+
+        runs = []
+        for label, fn in (("streaming XML->ASS", streaming), ("full-DOM baseline ", full_dom)):
+            # timed run first, then a separate tracemalloc run (tracing skews timings)
+            t0 = time.perf_counter()
+            count = fn()
+            elapsed = time.perf_counter() - t0
+            tracemalloc.start()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            runs.append((elapsed, peak))
+            cprint(f"[+] {label}: {count} events in {elapsed:.2f}s "
+                   f"({count / elapsed:,.0f}/s, {human_size(size / elapsed)}/s), peak {human_size(peak)}", FG_GREEN)
+        # the streaming path is not faster: it trades some speed for a flat memory ceiling
+        (s_time, s_peak), (d_time, d_peak) = runs
+        cprint(f"[i] streaming runs at {d_time / s_time:.2f}x the DOM speed "
+               f"with {d_peak / max(s_peak, 1):.1f}x less peak memory", FG_CYAN)
+
+# ----- Storage: free-space preflight, preallocation, placement, staging -----
+STAGING_DIRNAME = '.bili_staging'
+STORAGE_MARGIN = 1.05                   # container overhead / merge slack on top of the stream sizes
+STORAGE_UNKNOWN_BYTES = 1024 ** 3       # reserved for a job whose size can't be estimated
+FALLOC_FL_KEEP_SIZE = 0x01
+
+class StorageFull(Exception):
+    pass
+
+_fallocate = None
+
+def preallocate(fh, size: int) -> bool:
+    # Reserve the blocks up front: less fragmentation, and ENOSPC now rather than
+    # at 95%. KEEP_SIZE leaves the visible length alone so size-based resume works.
+    global _fallocate
+    if _fallocate is None:
+        try:
+            fn = ctypes.CDLL(None, use_errno=True).fallocate
+            fn.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+            _fallocate = fn
+        except (OSError, AttributeError):
+            _fallocate = False
+    if not _fallocate or size <= 0:
+        return False
+    if _fallocate(fh.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            raise StorageFull(f"no room to preallocate {human_size(size)} for {fh.name}")
+        return False  # e.g. EOPNOTSUPP on FUSE /sdcard: just carry on
+    return True
+
+class StorageManager:
+    # Places each job on the output root with the most free space, net of what
+    # jobs already running have reserved, and stages it under <root>/.bili_staging
+    # so the finished file appears with a single rename on the same filesystem.
+    # With a stage_dir (--stage-dir) jobs that fit are staged there instead and
+    # committed with one sequential copy.
+    def __init__(self, roots, margin: float = STORAGE_MARGIN, stage_dir: str | None = None):
+        self.roots = [os.path.abspath(os.path.expanduser(r)) for r in roots]
+        for r in self.roots:
+            os.makedirs(r, exist_ok=True)
+        self.margin = margin
+        self.reserved = {r: 0 for r in self.roots}
+        self.stage_dir = stage_dir
+        self.stage_reserved = 0
+        self._local = threading.local()     # the running job's staging dir, set by place()
+        self.lock = threading.Lock()
+
+    def free(self, root: str) -> int:
+        return shutil.disk_usage(root).free - self.reserved[root]
+
+    def total_free(self) -> int:
+        # roots on the same filesystem are only counted once
+        seen, total = set(), 0
+        for r in self.roots:
+            dev = os.stat(r).st_dev
+            if dev not in seen:
+                seen.add(dev)
+                total += shutil.disk_usage(r).free
+        return total
+
+    @contextlib.contextmanager
+    def place(self, expected: int | None):
+        need = int((expected or STORAGE_UNKNOWN_BYTES) * self.margin)
+        with self.lock:
+            root = max(self.roots, key=self.free)
+            if self.free(root) < need:
+                raise StorageFull(f"needs {human_size(need)}, best root {root} has {human_size(self.free(root))} free")
+            self.reserved[root] += need
+            # tmpfs is small: jobs that don't fit next to the others stage on the root
+            stage = self.stage_dir if self.stage_dir and \
+                shutil.disk_usage(self.stage_dir).free - self.stage_reserved >= need else None
+            if stage:
+                self.stage_reserved += need
+            elif self.stage_dir:
+                METRICS.count('stage_full')
+        METRICS.event('placed', root=root, bytes=need, staged=stage)
+        self._local.stage = stage
+        try:
+            yield root
+        finally:
+            self._local.stage = None
+            with self.lock:
+                self.reserved[root] -= need
+                if stage:
+                    self.stage_reserved -= need
+
+    def staging(self, root: str) -> str:
+        path = getattr(self._local, 'stage', None) or os.path.join(root, STAGING_DIRNAME)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def commit(self, staged: str, root: str) -> str:
+        return move_file(staged, os.path.join(root, os.path.basename(staged)))
+
+def expected_bytes(ydl, ie_result: dict, spec: str) -> int | None:
+    # Size of what `spec` would pick from a raw (unprocessed) single-video result
+    if ie_result.get('_type', 'video') != 'video' or not ie_result.get('formats'):
+        return None
+    formats = [dict(f) for f in ie_result['formats']]
+    ydl.sort_formats({'formats': formats, '_format_sort_fields': ie_result.get('_format_sort_fields')})
+    pick = select_for_plan(ydl, {'formats': formats, 'duration': ie_result.get('duration')}, spec)
+    return pick['bytes'] if pick else None
+
+# ----- Output writes: coalescing buffer, private staging (--write-buffer, --stage-dir) -----
+# Shared storage on Android (/sdcard) is a FUSE mount: every write() is a round
+# trip through the FUSE daemon, so many small writes cost far more than a few
+# large ones, and a merge pass on top of it pays the price twice. Downloads
+# write in WRITE_BUFFER-sized pieces at aligned offsets, and with --stage-dir
+# the partial files and merges live on app-private storage or tmpfs; the
+# finished file then reaches the output root in one sequential copy.
+WRITE_BUFFER = 4 * 1024 * 1024      # bytes per write(); --write-buffer
+WRITE_ALIGN = 128 * 1024            # flushes end on this boundary (FUSE max_write, a multiple of the page size)
+STAGE_DIRNAME = 'bili_bili_staging'
+BENCH_WRITE_BYTES = 256 * 1024 * 1024
+BENCH_WRITE_SMALL = 16 * 1024       # roughly what yt-dlp's default block size settles at on a slow link
+STAGE_DIR = None                    # resolved --stage-dir, or None for <root>/.bili_staging
+
+def size_arg(text: str) -> int:
+    # "4M", "512k", "1048576" -> bytes
+    m = re.fullmatch(r'\s*(\d+)\s*([kmg]?)i?b?\s*', text, re.I)
+    if not m:
+        raise argparse.ArgumentTypeError(f"not a size: {text!r}")
+    return int(m.group(1)) * 1024 ** ' kmg'.index(m.group(2).lower() or ' ')
+
+class CoalescingWriter:
+    # File wrapper that gathers small writes into `size`-byte writes ending on
+    # `align` boundaries; seek, flush, truncate and close push out the rest.
+    def __init__(self, fh, size: int | None = None, align: int = WRITE_ALIGN):
+        self.fh = fh
+        self.size = size or WRITE_BUFFER
+        self.align = align
+        self.buf = bytearray()
+        self.pos = fh.tell()
+        self.writes = 0
+
+    def _out(self, n: int):
+        try:
+            with memoryview(self.buf) as mv:
+                done = 0
+                while done < n:     # raw files may write short
+                    done += self.fh.write(mv[done:n])
+        except BaseException:
+            # how much reached the file is unknown: drop everything buffered and
+            # rewind to the last good position, so a retry can't write bytes twice
+            self.buf = bytearray()   # a view may still be held by the traceback
+            with contextlib.suppress(OSError):
+                self.fh.seek(self.pos)
+            raise
+        del self.buf[:n]
+        self.pos += n
+        self.writes += 1
+
+    def write(self, data) -> int:
+        self.buf += data
+        if len(self.buf) >= self.size:
+            n = len(self.buf) - (self.pos + len(self.buf)) % self.align
+            if n > 0:
+                self._out(n)
+        return len(data)
+
+    def flush(self):
+        if self.buf:
+            self._out(len(self.buf))
+        self.fh.flush()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self.flush()
+        self.pos = self.fh.seek(offset, whence)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos + len(self.buf)
+
+    def truncate(self, size: int | None = None):
+        self.flush()
+        return self.fh.truncate(size)
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def copy_sequential(src: str, dst: str, buffer_size: int | None = None) -> int:
+    # One front-to-back pass with large writes into a preallocated file
+    buf = bytearray(buffer_size or WRITE_BUFFER)
+    size = os.path.getsize(src)
+    done = 0
+    with open(src, 'rb', buffering=0) as fi, open(dst, 'wb', buffering=0) as fo:
+        with contextlib.suppress(AttributeError, OSError):
+            os.posix_fadvise(fi.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        preallocate(fo, size)
+        with memoryview(buf) as mv:
+            while True:
+                n = fi.readinto(buf)
+                if not n:
+                    break
+                pos = 0
+                while pos < n:
+                    pos += fo.write(mv[pos:n])
+                done += n
+        os.fsync(fo.fileno())
+    shutil.copystat(src, dst)
+    return done
+
+def move_file(src: str, dst: str) -> str:
+    # rename on the same filesystem; otherwise copy under a .part name and swap in
+    try:
+        os.replace(src, dst)
+        return dst
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    t0 = time.perf_counter()
+    try:
+        n = copy_sequential(src, dst + '.part')
+        os.replace(dst + '.part', dst)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(dst + '.part')
+        raise
+    os.remove(src)
+    METRICS.count('staged_copies')
+    METRICS.event('staged_copy', file=os.path.basename(dst), bytes=n,
+                  seconds=round(time.perf_counter() - t0, 3))
+    return dst
+
+def stage_candidates() -> list:
+    # app-private first (Termux's $TMPDIR lives under /data/data/<app>), then tmpfs
+    dirs = [os.environ.get('TMPDIR'), '/dev/shm', os.environ.get('XDG_RUNTIME_DIR'), tempfile.gettempdir()]
+    return [d for d in dict.fromkeys(dirs) if d and os.path.isdir(d) and os.access(d, os.W_OK)]
+
+def resolve_stage_dir(spec: str | None, root: str) -> str | None:
+    # --stage-dir DIR, or 'auto': the first candidate that is not on root's filesystem
+    if not spec:
+        return None
+    if spec != 'auto':
+        path = os.path.abspath(os.path.expanduser(spec))
+    else:
+        os.makedirs(root, exist_ok=True)
+        dev = os.stat(root).st_dev
+        path = next((os.path.join(d, STAGE_DIRNAME) for d in stage_candidates() if os.stat(d).st_dev != dev), None)
+        if path is None:
+            cprint("[i] No private or tmpfs storage apart from the output root; staging next to the output", FG_YELLOW)
+            return None
+    os.makedirs(path, exist_ok=True)
+    cprint(f"[i] Staging on {path} ({human_size(shutil.disk_usage(path).free)} free)", FG_CYAN)
+    return path
+
+def bench_write(target: str | None = None, total: int = BENCH_WRITE_BYTES) -> list:
+    # Write `total` bytes into target (default: the directory choose_download_dir()
+    # picks) with each strategy; fsync is inside the timing so the page cache can't hide the device
+    target = target or choose_download_dir()
+    stage = resolve_stage_dir('auto', target)
+    block = os.urandom(BENCH_WRITE_SMALL)
+    cprint(f"[i] Write benchmark: {human_size(total)} into {target}", FG_CYAN)
+
+    def produce(fh):
+        for _ in range(total // len(block)):
+            fh.write(block)
+
+    def direct_small(path):
+        with open(path, 'wb') as fh:
+            produce(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def direct_coalesced(path):
+        with open(path, 'wb', buffering=0) as raw:
+            preallocate(raw, total)
+            with CoalescingWriter(raw) as fh:
+                produce(fh)
+                fh.flush()
+                os.fsync(raw.fileno())
+
+    def staged(path):
+        tmp = os.path.join(stage, os.path.basename(path))
+        direct_coalesced(tmp)
+        move_file(tmp, path)
+
+    strategies = [(f"direct, {human_size(BENCH_WRITE_SMALL)} writes", direct_small),
+                  (f"direct, {human_size(WRITE_BUFFER)} coalesced writes", direct_coalesced)]
+    if stage:
+        strategies.append((f"staged on {stage} + one copy", staged))
+    results = []
+    for label, fn in strategies:
+        path = os.path.join(target, f".bili_bench_write_{os.getpid()}")
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            fn(path)
+        except OSError as e:
+            cprint(f"[!] {label}: {e}", FG_RED)
+            continue
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        elapsed, cpu = time.perf_counter() - t0, time.process_time() - c0
+        results.append({'strategy': label, 'seconds': round(elapsed, 3), 'cpu': round(cpu, 3),
+                        'rate': round(total / elapsed)})
+        cprint(f"[+] {label:<48} {elapsed:6.2f}s  {human_size(total / elapsed)}/s  cpu {cpu:.2f}s", FG_GREEN)
+    if results:
+        best = min(results, key=lambda r: r['seconds'])
+        cprint(f"[i] Fastest here: {best['strategy']}", FG_CYAN)
+    return results
+
+# ----- CDN host statistics (persistent, sqlite) -----
+# Rolling throughput and error counts per (CDN host, hour of day, downloader
+# setting), fed by the yt-dlp progress hooks and the mirror downloader. Mirror
+# ranking, the starting CDN concurrency and the planner's estimates read it.
+CDN_STATS_DB = 'cdn_stats.sqlite3'
+CDN_STATS_FLUSH_EVERY = 30.0    # s between batched writes
+CDN_STATS_SAMPLE = 5.0          # s of progress per throughput sample
+CDN_STATS_ALPHA = 0.2           # EWMA weight of a new flush
+CDN_STATS_MIN_SAMPLES = 5
+
+class CdnStats:
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.lock = threading.Lock()       # pending samples; never held across sqlite I/O
+        self.db_lock = threading.Lock()    # the shared connection
+        self.pending = {}
+        self.flushed_at = time.time()
+        self.db = None
+
+    def _conn(self):
+        # callers hold db_lock
+        if self.db is None:
+            self.db = sqlite3.connect(self.path or str(state_dir() / CDN_STATS_DB), timeout=10,
+                                      check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS host_stats (
+                host TEXT, hour INTEGER, setting TEXT, bytes INTEGER, seconds REAL, samples INTEGER,
+                errors INTEGER, ewma REAL, updated INTEGER, PRIMARY KEY (host, hour, setting))""")
+        return self.db
+
+    def record(self, host: str, nbytes: int, seconds: float, ok: bool = True, setting: str = 'native'):
+        if not host:
+            return
+        key = (host, datetime.datetime.now().hour, setting)
+        with self.lock:
+            p = self.pending.setdefault(key, [0, 0.0, 0, 0])
+            if ok:
+                p[0] += nbytes
+                p[1] += seconds
+                p[2] += 1
+            else:
+                p[3] += 1
+            due = time.time() - self.flushed_at >= CDN_STATS_FLUSH_EVERY
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.time()
+        if not pending:
+            return
+        with self.db_lock:
+            try:
+                db = self._conn()
+                with db:
+                    for (host, hour, setting), (nbytes, secs, samples, errors) in pending.items():
+                        row = db.execute("SELECT ewma FROM host_stats WHERE host=? AND hour=? AND setting=?",
+                                         (host, hour, setting)).fetchone()
+                        rate = nbytes / secs if secs > 0 else None
+                        old = row[0] if row else None
+                        ewma = old if rate is None else rate if old is None else (1 - CDN_STATS_ALPHA) * old + CDN_STATS_ALPHA * rate
+                        db.execute("""INSERT INTO host_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (host, hour, setting) DO UPDATE SET bytes = bytes + excluded.bytes,
+                            seconds = seconds + excluded.seconds, samples = samples + excluded.samples,
+                            errors = errors + excluded.errors, ewma = excluded.ewma, updated = excluded.updated""",
+                                   (host, hour, setting, nbytes, secs, samples, errors, ewma, int(time.time())))
+            except sqlite3.Error as e:
+                cprint(f"[!] Could not update CDN stats: {e}", FG_YELLOW)
+
+    def _query(self, sql: str, args=()):
+        with self.db_lock:
+            try:
+                return self._conn().execute(sql, args).fetchall()
+            except sqlite3.Error:
+                return []
+
+    def host(self, host: str, hour: int | None = None):
+        # -> (ewma bytes/s, error rate) for this host, this hour if known, else any hour
+        for where, args in (("host=? AND hour=?", (host, hour)), ("host=?", (host,))):
+            if hour is None and 'hour' in where:
+                continue
+            (row,) = self._query(f"SELECT SUM(ewma * samples) / SUM(samples), SUM(samples), SUM(errors) "
+                                 f"FROM host_stats WHERE {where}", args) or [(None, None, None)]
+            if row[1] and row[1] >= CDN_STATS_MIN_SAMPLES:
+                return row[0], row[2] / (row[1] + row[2])
+        return None
+
+    def hour(self, hour: int):
+        # -> (mean bytes/s, error rate, samples) over all hosts at this hour of day
+        (row,) = self._query("SELECT SUM(bytes) / NULLIF(SUM(seconds), 0), SUM(samples), SUM(errors) "
+                             "FROM host_stats WHERE hour=?", (hour,)) or [(None, None, None)]
+        if not row[1] or row[1] < CDN_STATS_MIN_SAMPLES:
+            return None
+        return row[0], row[2] / (row[1] + row[2]), row[1]
+
+    def hour_factor(self, hour: int) -> float:
+        # how this hour compares with the all-day average (1.0 when unknown)
+        now = self.hour(hour)
+        (row,) = self._query("SELECT SUM(bytes) / NULLIF(SUM(seconds), 0) FROM host_stats") or [(None,)]
+        if not now or not now[0] or not row[0]:
+            return 1.0
+        return max(0.25, min(2.0, now[0] / row[0]))
+
+    def blend(self, host: str, measured: float) -> float:
+        # rank score for a mirror: a fresh probe mostly, history to break near-ties
+        # and to demote hosts that often fail
+        hist = self.host(host, datetime.datetime.now().hour)
+        if not hist:
+            return measured
+        rate, err = hist
+        return (0.7 * measured + 0.3 * (rate or measured)) * (1 - min(err, 0.9))
+
+    def report(self, limit: int = 20):
+        hour = datetime.datetime.now().hour
+        rows = self._query("SELECT host, setting, SUM(bytes), SUM(seconds), SUM(samples), SUM(errors), "
+                           "SUM(CASE WHEN hour=? THEN ewma * samples END) / SUM(CASE WHEN hour=? THEN samples END) "
+                           "FROM host_stats GROUP BY host, setting ORDER BY SUM(bytes) DESC LIMIT ?",
+                           (hour, hour, limit))
+        if not rows:
+            cprint("[i] No CDN statistics recorded yet.", FG_CYAN)
+            return
+        cprint(f"{'host':<40} {'setting':<16} {'moved':>9} {'avg/s':>9} {'now/s':>9} {'err%':>5}", FG_BLUE)
+        for host, setting, nbytes, secs, samples, errors, now_rate in rows:
+            avg = nbytes / secs if secs else 0
+            err = 100 * errors / max(1, samples + errors)
+            cprint(f"{host[:40]:<40} {setting[:16]:<16} {human_size(nbytes):>9} {human_size(avg):>9} "
+                   f"{human_size(now_rate) if now_rate else '-':>9} {err:5.1f}", FG_CYAN)
+        for h in sorted({(hour + d) % 24 for d in range(-2, 3)}):
+            st = self.hour(h)
+            if st:
+                cprint(f"[i] {h:02d}:00  {human_size(st[0] or 0)}/s per stream, {100 * st[1]:.1f}% errors "
+                       f"({st[2]} samples)", FG_CYAN)
+
+CDN_STATS = CdnStats()
+
+_stats_local = threading.local()
+
+@contextlib.contextmanager
+def cdn_stats_job():
+    # The hook's per-file state belongs to the job running on this thread; it is
+    # dropped when the job ends, also for files that never reported 'finished'
+    _stats_local.files = {}
+    try:
+        yield
+    finally:
+        _stats_local.__dict__.pop('files', None)
+
+def cdn_stats_hook(d, setting: str = 'native'):
+    # yt-dlp progress hook: one throughput sample per CDN_STATS_SAMPLE seconds per file
+    _open = _stats_local.__dict__.setdefault('files', {})
+    name = d.get('filename')
+    host = urllib.parse.urlsplit((d.get('info_dict') or {}).get('url') or '').netloc
+    status = d.get('status')
+    now = time.monotonic()
+    done = d.get('downloaded_bytes') or d.get('total_bytes') or 0
+    last = _open.get(name)
+    if status == 'downloading':
+        if last is None:
+            _open[name] = (now, done)
+        elif now - last[0] >= CDN_STATS_SAMPLE:
+            CDN_STATS.record(host, done - last[1], now - last[0], setting=setting)
+            _open[name] = (now, done)
+    elif status == 'finished':
+        _open.pop(name, None)
+        if last and done > last[1]:
+            CDN_STATS.record(host, done - last[1], now - last[0], setting=setting)
+        elif last is None and d.get('elapsed') and done:
+            # external downloaders (aria2c) only report the end
+            CDN_STATS.record(host, done, d['elapsed'], setting=setting)
+    elif status == 'error':
+        _open.pop(name, None)
+        CDN_STATS.record(host, 0, 0, ok=False, setting=setting)
+
+# ----- CDN mirror racing (playurl base_url + backup_url) -----
+CDN_HEADERS = {
+    'User-Agent': API_HEADERS['User-Agent'],
+    'Referer': 'https://www.bilibili.com/',
+}
+RACE_PROBE_BYTES = 512 * 1024      # per-candidate probe size
+RACE_WINDOW = 1.5                  # seconds of transfer measured per probe
+RACE_TIMEOUT = 8                   # connect/read timeout while probing
+CHUNK_SIZE = 4 * 1024 * 1024       # ranged request size for the direct downloader
+RERACE_MIN_SPEED = 256 * 1024      # bytes/s; a slower chunk triggers a re-race
+RERACE_COOLDOWN = 15               # seconds between re-races on one stream
+RESUME_SUFFIX = '.chunks.json'     # sidecar manifest next to a .part file
+RANGE_ERRORS_MAX = 8               # failed requests in a row (no bytes) before a transfer gives up
+
+def _open_range(url: str, start: int, end: int | None = None, timeout: float = RACE_TIMEOUT):
+    u = urllib.parse.urlsplit(url)
+    cls = egress_connection_class(http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection)
+    conn = cls(u.netloc, timeout=timeout)
+    rng = f"bytes={start}-{'' if end is None else end}"
+    conn.request('GET', u.path + (f"?{u.query}" if u.query else ''), headers={**CDN_HEADERS, 'Range': rng})
+    resp = conn.getresponse()
+    if resp.status not in (200, 206):
+        conn.close()
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return conn, resp
+
+def _content_total(resp) -> int | None:
+    # "bytes 0-524287/73400320" -> 73400320
+    cr = resp.headers.get('Content-Range') or ''
+    if '/' in cr and cr.rsplit('/', 1)[1].isdigit():
+        return int(cr.rsplit('/', 1)[1])
+    cl = resp.headers.get('Content-Length')
+    return int(cl) if resp.status == 200 and cl and cl.isdigit() else None
+
+def probe_mirror(url: str, offset: int = 0) -> dict:
+    # Time-to-first-byte plus throughput over a short window, from `offset`
+    res = {'url': url, 'host': urllib.parse.urlsplit(url).netloc, 'ttfb': None, 'speed': 0.0, 'total': None, 'error': None}
+    t0 = time.perf_counter()
+    conn = None
+    try:
+        conn, resp = _open_range(url, offset, offset + RACE_PROBE_BYTES - 1)
+        res['total'] = _content_total(resp)
+        first = resp.read(1)
+        t1 = time.perf_counter()
+        res['ttfb'] = t1 - t0
+        got = len(first)
+        while got < RACE_PROBE_BYTES and time.perf_counter() - t1 < RACE_WINDOW:
+            b = resp.read(64 * 1024)
+            if not b:
+                break
+            got += len(b)
+        res['speed'] = got / max(time.perf_counter() - t1, 1e-3)
+    except Exception as e:
+        res['error'] = str(e)
+    finally:
+        if conn:
+            conn.close()
+    return res
+
+def race_mirrors(candidates, offset: int = 0) -> list:
+    # Probe every candidate at once; fastest first, failures last
+    cands = list(dict.fromkeys(c for c in candidates if c))
+    if len(cands) <= 1:
+        return [probe_mirror(c, offset) for c in cands]
+    with ThreadPoolExecutor(max_workers=len(cands)) as pool:
+        results = list(pool.map(egress_bound(lambda c: probe_mirror(c, offset)), cands))
+    return sorted(results, key=lambda r: (r['error'] is not None, -r['speed'], r['ttfb'] or 0))
+
+class ChunkManifest:
+    # Sidecar of a .part file: stream key, total size, chunk size and the crc32 of
+    # every finished chunk. After a crash only the recorded chunks are re-read to
+    # verify them; anything unrecorded or corrupt is fetched again. The key is the
+    # stream's file name, which mirrors and re-signed URLs share.
+    def __init__(self, part: str, key: str, total: int, chunk_size: int):
+        self.part, self.key, self.total, self.chunk_size = part, key, total, chunk_size
+        self.path = part + RESUME_SUFFIX
+        self.done = {}
+
+    @property
+    def count(self) -> int:
+        return -(-self.total // self.chunk_size)
+
+    def load(self, fh) -> tuple:
+        # -> (chunks kept, chunks found corrupt); starts over if the sidecar is for another stream
+        try:
+            with open(self.path, encoding='utf-8') as mf:
+                data = json.load(mf)
+        except (OSError, ValueError):
+            data = None
+        if data and (data.get('key'), data.get('total'), data.get('chunk')) == (self.key, self.total, self.chunk_size):
+            claimed = {int(i): crc for i, crc in data.get('done', {}).items()}
+        elif data is None and os.fstat(fh.fileno()).st_size:
+            # a .part from before manifests: its whole chunks are taken as they are
+            claimed = {i: None for i in range(min(os.fstat(fh.fileno()).st_size // self.chunk_size, self.count))}
+        else:
+            claimed = {}
+        bad = 0
+        for i in sorted(claimed):
+            fh.seek(i * self.chunk_size)
+            size = min(self.chunk_size, self.total - i * self.chunk_size)
+            crc, left = 0, size
+            while left:
+                b = fh.read(min(left, 1024 * 1024))
+                if not b:
+                    break
+                crc = zlib.crc32(b, crc)
+                left -= len(b)
+            if left or (claimed[i] is not None and crc != claimed[i]):
+                bad += 1
+                continue
+            self.done[i] = crc
+        self.save()
+        return len(self.done), bad
+
+    def missing(self) -> list:
+        return [i for i in range(self.count) if i not in self.done]
+
+    def mark(self, i: int, crc: int):
+        self.done[i] = crc
+        self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as mf:
+            json.dump({'key': self.key, 'total': self.total, 'chunk': self.chunk_size,
+                       'done': {str(i): crc for i, crc in sorted(self.done.items())}}, mf)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+class MirrorDownloader:
+    # Ranged download of one stream from a set of equivalent mirrors: starts on the
+    # race winner, re-races when a chunk falls under min_speed, and resumes after an
+    # interruption from the verified chunks in its manifest. `renew` (optional)
+    # returns fresh candidate URLs when every mirror rejects the signed ones.
+    def __init__(self, candidates, path: str, chunk_size: int = CHUNK_SIZE,
+                 min_speed: float = RERACE_MIN_SPEED, label: str = '', renew=None):
+        self.candidates = list(dict.fromkeys(c for c in candidates if c))
+        self.path = path
+        self.chunk_size = chunk_size
+        self.min_speed = min_speed
+        self.label = label or os.path.basename(path)
+        self.total = None
+        self.switches = 0
+        self.renew = renew
+        self.renewals = 0
+        self.ticker = ProgressTicker()
+
+    def _pick(self, offset: int, exclude=()) -> str:
+        ranked = [r for r in race_mirrors([c for c in self.candidates if c not in exclude] or self.candidates, offset)
+                  if not r['error']]
+        if not ranked and self.renew and self.renewals < RETRY_POLICIES['expired'].tries:
+            # every signed URL refused: new ones from the API; the manifest keeps the progress
+            self.renewals += 1
+            METRICS.count('stream_url_refreshed')
+            self.candidates = list(dict.fromkeys(c for c in self.renew() if c))
+            if isinstance(exclude, set):
+                exclude.clear()
+            return self._pick(offset)
+        if not ranked:
+            raise ApiError(f"no CDN mirror reachable for {self.label}")
+        best = max(ranked, key=lambda r: CDN_STATS.blend(r['host'], r['speed']))
+        self.total = self.total or best['total']
+        return best['url']
+
+    @profiled('download')
+    def run(self) -> int:
+        part = self.path + '.part'
+        url = self._pick(0)
+        if self.total is None:
+            raise ApiError(f"CDN did not report a size for {self.label}")
+        last_race = time.time()
+        dead = set()
+        errors = 0
+        cdn = CONTROLLERS['cdn']
+        manifest = ChunkManifest(part, os.path.basename(urllib.parse.urlsplit(url).path), self.total, self.chunk_size)
+        # unbuffered: CoalescingWriter does the buffering and knows what reached the file
+        with open(part, 'r+b' if os.path.exists(part) else 'w+b', buffering=0) as fh:
+            preallocate(fh, self.total)
+            kept, bad = manifest.load(fh)
+            if kept or bad:
+                METRICS.count('resume_chunks_kept', kept)
+                METRICS.count('resume_chunks_corrupt', bad)
+                cprint(f"[i] {self.label}: resuming, {kept}/{manifest.count} chunk(s) verified"
+                       + (f", {bad} corrupt" if bad else ''), FG_CYAN if not bad else FG_YELLOW)
+            done = kept * self.chunk_size
+            out = CoalescingWriter(fh)
+            for idx in manifest.missing():
+                start = offset = idx * self.chunk_size
+                end = min(start + self.chunk_size, self.total) - 1
+                crc = 0
+                out.seek(start)
+                while offset <= end:
+                    t0 = time.perf_counter()
+                    got = offset
+                    cdn.acquire()
+                    err = None
+                    try:
+                        conn, resp = _open_range(url, offset, end, timeout=30)
+                    except (OSError, http.client.HTTPException) as e:
+                        err = e
+                    else:
+                        try:
+                            if resp.status != 206 and (offset or end < self.total - 1):
+                                err = http.client.HTTPException(f"{urllib.parse.urlsplit(url).netloc} ignored the Range header")
+                            while err is None and offset <= end:
+                                try:
+                                    b = resp.read(min(256 * 1024, end + 1 - offset))
+                                except (OSError, http.client.HTTPException) as e:
+                                    err = e
+                                    break
+                                if not b:
+                                    break
+                                # local I/O is outside the network handling: a disk error
+                                # (ENOSPC...) ends the job instead of re-racing mirrors
+                                out.write(b)
+                                crc = zlib.crc32(b, crc)
+                                offset += len(b)
+                        except BaseException:
+                            cdn.release(offset - got)
+                            raise
+                        finally:
+                            conn.close()
+                    if err is not None:
+                        cdn.release(offset - got, ok=False, throttled=is_throttle_error(err))
+                        CDN_STATS.record(urllib.parse.urlsplit(url).netloc, 0, 0, ok=False, setting='mirror')
+                        # the bytes already written stay; drop this mirror and continue elsewhere
+                        if isinstance(err, urllib.error.HTTPError) and err.code in (403, 404):
+                            dead.add(url)
+                        errors = 0 if offset > got else errors + 1
+                        if errors >= RANGE_ERRORS_MAX:
+                            raise ApiError(f"{self.label}: {errors} failed requests in a row, last: {err}") from err
+                        url = self._switch(url, offset, dead, f"error: {err}")
+                        last_race = time.time()
+                        continue
+                    cdn.release(offset - got)
+                    errors = 0
+                    elapsed = max(time.perf_counter() - t0, 1e-3)
+                    speed = (offset - got) / elapsed
+                    CDN_STATS.record(urllib.parse.urlsplit(url).netloc, offset - got, elapsed, setting='mirror')
+                    if EVENTS and self.ticker.due(self.path):
+                        emit('progress', job=self.label, file=os.path.basename(self.path),
+                             downloaded=done + offset - start, total=self.total, speed=round(speed),
+                             mirror=urllib.parse.urlsplit(url).netloc)
+                    if speed < self.min_speed and offset < self.total and len(self.candidates) > 1 \
+                            and time.time() - last_race > RERACE_COOLDOWN:
+                        url = self._switch(url, offset, dead, f"{human_size(speed)}/s")
+                        last_race = time.time()
+                # data before checksum: a crash in between only costs this chunk
+                out.flush()
+                manifest.mark(idx, crc)
+                done += end + 1 - start
+            out.truncate(self.total)
+        os.replace(part, self.path)
+        manifest.remove()
+        return self.total
+
+    def _switch(self, url: str, offset: int, dead: set, why: str) -> str:
+        new = self._pick(offset, exclude=dead)
+        if new != url:
+            self.switches += 1
+            emit('mirror_switch', job=self.label, old=urllib.parse.urlsplit(url).netloc,
+                 new=urllib.parse.urlsplit(new).netloc, reason=why)
+            cprint(f"\n[i] {self.label}: {urllib.parse.urlsplit(url).netloc} ({why}) -> "
+                   f"{urllib.parse.urlsplit(new).netloc}", FG_CYAN)
+        return new
+
+@profiled('extract')
+def fetch_playurl(vid: str, cid: int, opener=None) -> dict:
+    params = {**_vid_params(vid), 'cid': cid, 'fnval': 4048, 'fourk': 1}
+    return api_get('https://api.bilibili.com/x/player/wbi/playurl', wbi_sign(params, opener), opener) or {}
+
+def stream_candidates(stream: dict) -> list:
+    return [stream.get('baseUrl') or stream.get('base_url')] + list(stream.get('backupUrl') or stream.get('backup_url') or [])
+
+def pick_dash_streams(play: dict, max_height: int | None = None, audio_only: bool = False):
+    # -> (video or None, audio). Quality ids: 127 8K, 120 4K, 116 1080p60, 80 1080p, 64 720p, 32 480p
+    dash = play.get('dash') or {}
+    audios = list(dash.get('audio') or [])
+    if audio_only:
+        flac = (dash.get('flac') or {}).get('audio')
+        if flac:
+            return None, flac
+    if not audios:
+        raise ApiError("no DASH audio in playurl response (legacy FLV-only video?)")
+    audio = max(audios, key=lambda a: a.get('bandwidth') or 0)
+    if audio_only:
+        return None, audio
+    videos = dash.get('video') or []
+    if max_height:
+        videos = [v for v in videos if (v.get('height') or 0) <= max_height] or videos[-1:]
+    if not videos:
+        raise ApiError("no DASH video in playurl response")
+    # on equal quality prefer AVC (codecid 7): it plays everywhere
+    video = max(videos, key=lambda v: (v.get('id') or 0, v.get('codecid') == 7, v.get('bandwidth') or 0))
+    return video, audio
+
+def same_stream(play: dict, stream: dict) -> dict:
+    # The stream in a fresh playurl answer matching one from an earlier answer
+    dash = play.get('dash') or {}
+    pool = [*(dash.get('video') or []), *(dash.get('audio') or []),
+            *([(dash.get('flac') or {}).get('audio')] if (dash.get('flac') or {}).get('audio') else []),
+            *((dash.get('dolby') or {}).get('audio') or [])]
+    for st in pool:
+        if (st.get('id'), st.get('codecid')) == (stream.get('id'), stream.get('codecid')):
+            return st
+    raise ApiError(f"stream {stream.get('id')} is gone from the refreshed playurl")
+
+def fetch_streams(streams, stem: str, refresh=None) -> list:
+    # Download several (label, stream) pairs side by side; returns their paths.
+    # refresh: optional () -> fresh playurl, used once the signed URLs are refused.
+    def one(item):
+        label, stream = item
+        path = f"{stem}.{label}.m4s"
+        renew = (lambda: stream_candidates(same_stream(refresh(), stream))) if refresh else None
+        MirrorDownloader(stream_candidates(stream), path, label=f"{os.path.basename(stem)} [{label}]",
+                         renew=renew).run()
+        return path
+    with ThreadPoolExecutor(max_workers=max(1, len(streams))) as pool:
+        return list(pool.map(egress_bound(one), streams))
+
+@profiled('postprocess')
+def mux_copy(ffmpeg_path: str, inputs, out: str, cleanup: bool = True) -> str:
+    cmd = [ffmpeg_path, '-v', 'error', '-y']
+    for p in inputs:
+        cmd += ['-i', p]
+    for i in range(len(inputs)):
+        cmd += ['-map', f'{i}']
+    subprocess.run(cmd + ['-c', 'copy', out + '.part.mp4'], check=True)
+    os.replace(out + '.part.mp4', out)
+    if cleanup:
+        for p in inputs:
+            os.remove(p)
+    return out
+
+def dash_stream_bytes(stream: dict, duration: float) -> int:
+    return int(stream.get('size') or (stream.get('bandwidth') or 0) / 8 * (duration or 0))
+
+def download_dash_direct(vid: str, storage: StorageManager, opener=None, ffmpeg_path: str | None = None,
+                         max_height: int | None = None, audio_only: bool = False) -> list:
+    # yt-dlp only ever uses base_url; this path races base_url/backup_url itself
+    view = fetch_view(vid, opener)
+    pages = view.get('pages') or [{'cid': view.get('cid'), 'page': 1, 'part': ''}]
+    results = []
+    for page in pages:
+        title = view.get('title') or vid
+        if len(pages) > 1:
+            title += f" p{page.get('page', 1):02d} {page.get('part') or ''}"
+        play = fetch_playurl(vid, page['cid'], opener)
+        refresh = functools.partial(fetch_playurl, vid, page['cid'], opener)
+        video, audio = pick_dash_streams(play, max_height, audio_only)
+        duration = (play.get('dash') or {}).get('duration') or page.get('duration') or 0
+        expected = sum(dash_stream_bytes(st, duration) for st in (video, audio) if st)
+        with storage.place(expected or None) as root:
+            stem = os.path.join(storage.staging(root), safe_filename(title))
+            if audio_only:
+                (path,) = fetch_streams([(f"f{audio.get('id')}", audio)], stem, refresh)
+                out = stem + '.m4a'
+                os.replace(path, out)
+                if ffmpeg_path and (audio.get('codecs') or '').lower() == 'flac':
+                    out = remux_flac(out, ffmpeg_path)
+            else:
+                if not ffmpeg_path:
+                    raise ApiError("ffmpeg is required to merge DASH video and audio")
+                paths = fetch_streams([(f"f{video.get('id')}", video), (f"f{audio.get('id')}", audio)], stem, refresh)
+                out = mux_copy(ffmpeg_path, paths, stem + '.mp4')
+            out = storage.commit(out, root)
+        note_media(out, view_media_meta(view, page, title))
+        results.append((out, os.path.getsize(out)))
+    return results
+
+def policy_height(policy: str) -> int | None:
+    m = re.search(r'height<=(\d+)', policy)
+    return int(m.group(1)) if m else None
+
+def download_variants(vid: str, qualities, storage: StorageManager, opener=None,
+                      ffmpeg_path: str | None = None) -> list:
+    # Several quality variants of one video from one view + playurl call: the
+    # audio track is fetched once, every distinct video stream in parallel with
+    # it, and each variant is muxed from the shared audio.
+    if not ffmpeg_path:
+        raise ApiError("ffmpeg is required to mux quality variants")
+    view = fetch_view(vid, opener)
+    pages = view.get('pages') or [{'cid': view.get('cid'), 'page': 1, 'part': ''}]
+    results = []
+    for page in pages:
+        title = view.get('title') or vid
+        if len(pages) > 1:
+            title += f" p{page.get('page', 1):02d} {page.get('part') or ''}"
+        play = fetch_playurl(vid, page['cid'], opener)
+        picks = {q: pick_dash_streams(play, policy_height(QUALITY_POLICIES[q])) for q in qualities}
+        audio = next(iter(picks.values()))[1]
+        # a short video may resolve two targets to the same stream: fetch it once
+        videos = {}
+        for q, (video, _) in picks.items():
+            videos.setdefault((video.get('id'), video.get('codecid')), video)
+        duration = (play.get('dash') or {}).get('duration') or page.get('duration') or 0
+        size = lambda st: dash_stream_bytes(st, duration)
+        # the downloaded streams plus every muxed output, all staged at once
+        expected = sum(map(size, [audio, *videos.values()])) + sum(size(v) + size(audio) for v, _ in picks.values())
+        with storage.place(expected or None) as root:
+            stem = os.path.join(storage.staging(root), safe_filename(title))
+            labels = [f"f{audio.get('id')}"] + [f"f{vid_id}c{codec}" for vid_id, codec in videos]
+            paths = dict(zip(labels, fetch_streams(list(zip(labels, [audio, *videos.values()])), stem,
+                                                   functools.partial(fetch_playurl, vid, page['cid'], opener))))
+            try:
+                for q, (video, _) in picks.items():
+                    src = paths[f"f{video.get('id')}c{video.get('codecid')}"]
+                    out = mux_copy(ffmpeg_path, [src, paths[labels[0]]], f"{stem} [{q}].mp4", cleanup=False)
+                    out = storage.commit(out, root)
+                    note_media(out, view_media_meta(view, page, title))
+                    results.append((out, os.path.getsize(out)))
+                # every variant went out with the one audio download: count what it saved
+                METRICS.count('variant_audio_saved', os.path.getsize(paths[labels[0]]) * (len(picks) - 1))
+            finally:
+                for p in paths.values():
+                    with contextlib.suppress(OSError):
+                        os.remove(p)
+    return results
+
+# ----- Clip mode (time ranges through the DASH segment index) -----
+# Bilibili's m4s streams are fragmented MP4 with a sidx box right after the init
+# segment: fetch init+sidx, map the section onto whole fragments, fetch just that
+# byte range and let ffmpeg trim it with -c copy.
+CLIP_PAD = 1.0              # s of context kept either side, before keyframe alignment
+
+def parse_timestamp(text: str) -> float:
+    # "95", "1:35", "01:01:35.5" -> seconds
+    secs = 0.0
+    for part in text.strip().split(':'):
+        secs = secs * 60 + float(part)
+    return secs
+
+def parse_section(text: str):
+    # "12:30-14:00" -> (750.0, 840.0)
+    start, sep, end = text.partition('-')
+    if not sep:
+        raise ValueError(f"section '{text}' is not START-END")
+    start, end = parse_timestamp(start), parse_timestamp(end)
+    if end <= start:
+        raise ValueError(f"section '{text}' ends before it starts")
+    return start, end
+
+def fmt_clock(seconds: float) -> str:
+    s = int(seconds)
+    return f"{s // 3600}.{s // 60 % 60:02d}.{s % 60:02d}" if s >= 3600 else f"{s // 60}.{s % 60:02d}"
+
+def segment_base(stream: dict):
+    # -> (init_end, index_end); the web API uses both spellings
+    sb = stream.get('SegmentBase') or stream.get('segment_base') or {}
+    init = sb.get('Initialization') or sb.get('initialization')
+    index = sb.get('indexRange') or sb.get('index_range')
+    if not init or not index:
+        raise ApiError(f"stream {stream.get('id')} has no segment index; clip mode can't map it")
+    return int(init.split('-')[1]), int(index.split('-')[1])
+
+def parse_sidx(data: bytes):
+    # -> [(t_start, t_end, byte_start, byte_end, starts_with_sap), ...] for each fragment
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        if kind == b'sidx':
+            break
+        if size < 8:
+            break
+        pos += size
+    else:
+        raise ApiError("no sidx box in the stream header")
+    if kind != b'sidx':
+        raise ApiError("malformed box in the stream header")
+    body = pos + 8
+    version = data[body]
+    timescale = struct.unpack_from('>I', data, body + 8)[0]
+    if version == 0:
+        t, first = struct.unpack_from('>II', data, body + 12)
+        p = body + 20
+    else:
+        t, first = struct.unpack_from('>QQ', data, body + 12)
+        p = body + 28
+    count = struct.unpack_from('>H', data, p + 2)[0]
+    p += 4
+    offset = pos + size + first
+    refs = []
+    for _ in range(count):
+        ref, dur, sap = struct.unpack_from('>III', data, p)
+        p += 12
+        if ref >> 31:
+            raise ApiError("hierarchical sidx isn't supported")
+        length = ref & 0x7FFFFFFF
+        refs.append((t / timescale, (t + dur) / timescale, offset, offset + length - 1, bool(sap >> 31)))
+        t += dur
+        offset += length
+    return refs
+
+def clip_refs(refs, start: float, end: float, pad: float = CLIP_PAD):
+    # Fragments covering [start - pad, end + pad], widened back to one starting on a keyframe
+    lo, hi = start - pad, end + pad
+    hit = [i for i, r in enumerate(refs) if r[1] > lo and r[0] < hi]
+    if not hit:
+        raise ApiError(f"section {fmt_clock(start)}-{fmt_clock(end)} is past the end of the stream")
+    i = hit[0]
+    while i > 0 and not refs[i][4]:
+        i -= 1
+    return refs[i:hit[-1] + 1]
+
+@profiled('download')
+def fetch_range(candidates, start: int, end: int, fh=None):
+    # Bytes start..end from the first mirror that honours Range; into fh if given
+    mark = fh.tell() if fh else 0
+
+    def call(slot):
+        err = None
+        for url in candidates:
+            if fh:
+                fh.seek(mark)
+                fh.truncate()
+            try:
+                conn, resp = _open_range(url, start, end)
+            except (OSError, http.client.HTTPException) as e:
+                err = e
+                continue
+            try:
+                if resp.status != 206:
+                    err = ApiError(f"{urllib.parse.urlsplit(url).netloc} ignored the Range header")
+                    continue
+                chunks, got = [], 0
+                while True:
+                    b = resp.read(CHUNK_SIZE)
+                    if not b:
+                        break
+                    got += len(b)
+                    if fh:
+                        fh.write(b)
+                    else:
+                        chunks.append(b)
+            except (OSError, http.client.HTTPException) as e:
+                err = e
+                continue
+            finally:
+                conn.close()
+            slot.nbytes = got
+            return got if fh else b''.join(chunks)
+        raise err or ApiError("no mirror to fetch from")
+    return with_retry(call, 'cdn')
+
+@profiled('extract')
+def stream_index(stream: dict):
+    # -> (init segment bytes, fragment refs); one small request per stream
+    init_end, index_end = segment_base(stream)
+    head = fetch_range(stream_candidates(stream), 0, index_end)
+    return head[:init_end + 1], parse_sidx(head)
+
+@profiled('postprocess')
+def cut_copy(ffmpeg_path: str, inputs, duration: float, out: str) -> str:
+    # inputs: [(path, offset of the section start from the file's first fragment), ...]
+    cmd = [ffmpeg_path, '-v', 'error', '-y']
+    for path, offset in inputs:
+        cmd += ['-ss', f"{max(offset, 0.0):.3f}", '-i', path]
+    for i in range(len(inputs)):
+        cmd += ['-map', f'{i}']
+    tmp = out + '.part' + os.path.splitext(out)[1]
+    subprocess.run(cmd + ['-t', f"{duration:.3f}", '-c', 'copy', '-avoid_negative_ts', 'make_zero', tmp], check=True)
+    os.replace(tmp, out)
+    for path, _ in inputs:
+        os.remove(path)
+    return out
+
+def download_clips(vid: str, sections, storage: StorageManager, opener=None, ffmpeg_path: str | None = None,
+                   max_height: int | None = None, audio_only: bool = False) -> list:
+    # One output file per (part, section); only the fragments a section touches are fetched
+    if not ffmpeg_path:
+        raise ApiError("ffmpeg is required to cut clips")
+    view = fetch_view(vid, opener)
+    pages = view.get('pages') or [{'cid': view.get('cid'), 'page': 1, 'part': ''}]
+    results = []
+    for page in pages:
+        title = view.get('title') or vid
+        if len(pages) > 1:
+            title += f" p{page.get('page', 1):02d} {page.get('part') or ''}"
+        video, audio = pick_dash_streams(fetch_playurl(vid, page['cid'], opener), max_height, audio_only)
+        streams = [(f"f{st.get('id')}", st) for st in (video, audio) if st]
+        with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+            indexes = list(pool.map(lambda item: stream_index(item[1]), streams))
+        flac = audio_only and (audio.get('codecs') or '').lower() == 'flac'
+        for start, end in sections:
+            picks = [clip_refs(refs, start, end) for _, refs in indexes]
+            expected = sum(sel[-1][3] - sel[0][2] + 1 for sel in picks)
+            METRICS.count('clip_bytes', expected)
+            with storage.place(expected) as root:
+                stem = os.path.join(storage.staging(root),
+                                    safe_filename(f"{title} [{fmt_clock(start)}-{fmt_clock(end)}]"))
+
+                def fetch(i):
+                    (label, stream), (init, _), sel = streams[i], indexes[i], picks[i]
+                    path = f"{stem}.{label}.m4s"
+                    with open(path, 'wb') as fh:
+                        fh.write(init)
+                        fetch_range(stream_candidates(stream), sel[0][2], sel[-1][3], fh)
+                    return path, start - sel[0][0]
+                with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+                    inputs = list(pool.map(fetch, range(len(streams))))
+                ext = '.flac' if flac else '.m4a' if audio_only else '.mp4'
+                out = storage.commit(cut_copy(ffmpeg_path, inputs, end - start, stem + ext), root)
+            cprint(f"[+] Clip {os.path.basename(out)} ({human_size(expected)} fetched)", FG_GREEN)
+            note_media(out, view_media_meta(view, None, f"{title} [{fmt_clock(start)}-{fmt_clock(end)}]"))
+            results.append((out, os.path.getsize(out)))
+    return results
+
+# ----- Download queue (non-interactive batch runs) -----
+BEST_FORMAT = 'bestvideo+bestaudio/best'
+
+SCHED_DEFAULT_BYTES = 256 * 1024 * 1024  # size assumed for jobs whose size is unknown
+SCHED_PRIORITY_STEP = 600                # one priority level is worth 10 minutes of waiting
+SCHED_NO_DEADLINE = 24 * 3600            # jobs without a deadline are due a day after queueing
+SCHED_AGING = {'fifo': 1.0, 'size': 4 * 1024 * 1024, 'priority': 1.0, 'deadline': 0.0}
+
+class Scheduler:
+    # Pending jobs ordered by key = base score + aging * enqueue time. A job's
+    # effective score (base - aging * time waited) keeps dropping while it waits,
+    # so big or low-priority jobs can't starve; and because all jobs age at the
+    # same rate the relative order never changes, so a plain heap is enough.
+    #   fifo:     base 0
+    #   size:     base = expected bytes, aging in bytes per second waited
+    #   priority: base = -priority * SCHED_PRIORITY_STEP, aging 1/s
+    #   deadline: base = deadline (earliest first), no aging needed
+    def __init__(self, order: str = 'fifo', aging: float | None = None, maxsize: int = 0):
+        self.order = order
+        self.aging = SCHED_AGING[order] if aging is None else aging
+        self.maxsize = maxsize
+        self.heap = []      # (key, seq, item, base)
+        self.later = []     # (monotonic due time, seq, item, base): requeued jobs sitting out a backoff
+        self.running = {}   # id(item) -> base of jobs handed out, so a requeue keeps its score
+        self.seq = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def _base(self, now: float, size=None, priority: int = 0, deadline=None) -> float:
+        if self.order == 'size':
+            return float(size or SCHED_DEFAULT_BYTES)
+        if self.order == 'priority':
+            return -float(priority or 0) * SCHED_PRIORITY_STEP
+        if self.order == 'deadline':
+            return float(deadline or now + SCHED_NO_DEADLINE)
+        return 0.0
+
+    def put(self, item, size=None, priority: int = 0, deadline=None):
+        with self.cond:
+            while self.maxsize and len(self.heap) >= self.maxsize:
+                self.cond.wait()
+            now = time.time()
+            base = self._base(now, size, priority, deadline)
+            heapq.heappush(self.heap, (base + self.aging * now, self.seq, item, base))
+            self.seq += 1
+            self.cond.notify_all()
+
+    def put_later(self, item, delay: float):
+        # Requeue: after `delay` seconds the job joins at the back, whatever the order
+        with self.cond:
+            base = self.running.pop(id(item), 0.0)
+            heapq.heappush(self.later, (time.monotonic() + delay, self.seq, item, base))
+            self.seq += 1
+            self.cond.notify_all()
+
+    def done(self, item):
+        with self.cond:
+            self.running.pop(id(item), None)
+
+    def _release_due(self, now: float):
+        while self.later and self.later[0][0] <= now:
+            _, _, item, base = heapq.heappop(self.later)
+            # keyed like a fresh put() of the same job, but never ahead of what is waiting
+            back = max(base + self.aging * time.time(), max((e[0] for e in self.heap), default=-math.inf))
+            heapq.heappush(self.heap, (back, self.seq, item, base))
+            self.seq += 1
+
+    def get(self):
+        # Next job, or None once closed and drained (including jobs waiting to be requeued)
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._release_due(now)
+                if self.heap or (self.closed and not self.later):
+                    break
+                self.cond.wait(self.later[0][0] - now if self.later else None)
+            if not self.heap:
+                return None
+            _, _, item, base = heapq.heappop(self.heap)
+            self.running[id(item)] = base
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+def job_id(item) -> str:
+    # queue items are BV/av ids, or JobRecords (planner/scheduler) carrying one
+    return item.vid if isinstance(item, JobRecord) else str(item)
+
+class JobQueue:
+    # Worker threads pulling jobs as soon as they are put(); producers (channel
+    # sync, list readers) can keep discovering work while downloads run.
+    def __init__(self, fn, jobs: int = 4, on_result=None, order: str = 'fifo', aging: float | None = None):
+        self.fn = fn
+        self.on_result = on_result
+        # FIFO producers get back-pressure; ordered queues need room to reorder
+        self.sched = Scheduler(order, aging, maxsize=max(1, jobs) * 4 if order == 'fifo' else 10000)
+        self.lock = threading.Lock()
+        self.result_lock = threading.Lock()     # on_result calls run one at a time, outside self.lock
+        self.results = []
+        self.requeued = {}  # id(item) -> times sent back so far
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, jobs))]
+        for t in self.threads:
+            t.start()
+
+    def _worker(self):
+        while True:
+            item = self.sched.get()
+            if item is None:
+                return
+            job = job_id(item)
+            emit('job', job=job, state='started')
+            t0 = time.time()
+            try:
+                # extraction and download share one egress; pinned when extraction ran ahead
+                with EGRESS.lease(getattr(item, 'egress', None)) as lease:
+                    files = self.fn(item)
+                    lease.nbytes = sum(n for _, n in files or [])
+                res = (item, files, None)
+            except Exception as e:
+                if self._requeue(item, job, e):
+                    continue
+                res = (item, None, e)
+            files = res[1] or []
+            emit('job', job=job, state='failed' if res[2] else 'done', elapsed=round(time.time() - t0, 3),
+                 files=[{'path': p, 'bytes': n} for p, n in files], error=str(res[2]) if res[2] else None,
+                 error_class=classify_error(res[2]) if res[2] else None)
+            self.sched.done(item)
+            with self.lock:
+                self.requeued.pop(id(item), None)
+                # only the id is kept: a finished job's record (formats, URLs) is freed here
+                self.results.append((job, res[1], res[2]))
+            if self.on_result:
+                with self.result_lock:
+                    self.on_result(*res)
+
+    def _requeue(self, item, job: str, e: Exception) -> bool:
+        # Back of the queue after a backoff, while the error class has requeues left
+        cls = classify_error(e)
+        policy = RETRY_POLICIES[cls]
+        with self.lock:
+            n = self.requeued.get(id(item), 0)
+            if n >= policy.requeues:
+                return False
+            self.requeued[id(item)] = n + 1
+        delay = policy.delay(policy.tries + n)
+        METRICS.count('jobs_requeued')
+        METRICS.event('requeue', job=job, error_class=cls, attempt=n + 1, delay=round(delay, 2), error=str(e)[:200])
+        emit('job', job=job, state='requeued', error=str(e), error_class=cls, delay=round(delay, 2))
+        cprint(f"[i] {job}: {cls} error, back in the queue in {delay:.0f}s ({n + 1}/{policy.requeues})", FG_YELLOW)
+        self.sched.put_later(item, delay)
+        return True
+
+    def put(self, item, size=None, priority: int = 0, deadline=None):
+        emit('job', job=job_id(item), state='queued', bytes=size, priority=priority, deadline=deadline)
+        self.sched.put(item, size, priority, deadline)
+
+    def join(self):
+        self.sched.close()
+        for t in self.threads:
+            t.join()
+        return self.results
+
+def parse_job_spec(text: str):
+    # "URL [priority=N] [deadline=2026-10-20T08:00 | deadline=+90m]" -> (url, meta)
+    parts = text.split()
+    if not parts:
+        return '', {}
+    meta = {}
+    for tok in parts[1:]:
+        key, _, val = tok.partition('=')
+        try:
+            if key == 'priority':
+                meta['priority'] = int(val)
+            elif key == 'deadline':
+                m = re.fullmatch(r'\+(\d+)([smhd])', val)
+                if m:
+                    meta['deadline'] = time.time() + int(m.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+                else:
+                    meta['deadline'] = datetime.datetime.fromisoformat(val).timestamp()
+        except ValueError:
+            cprint(f"[!] Ignoring bad job option '{tok}' for {parts[0]}", FG_YELLOW)
+    return parts[0], meta
+
+# ----- URL ingestion (files, stdin, NDJSON, watch folder) -----
+# Lists can hold 100k+ links: everything here is a generator, one line at a time.
+_BV_ALPHABET = 'FcwAPNKTMug3GV5Lj7EJnHpWsx4tb8haYeviqBz6rkCy12mUSDQX9RdoZf'
+_BV_ORDER = (8, 7, 0, 5, 1, 3, 2, 4, 6)
+_BV_XOR = 23442827791579
+_BV_MASK = (1 << 51) - 1
+INBOX_SUFFIXES = ('.txt', '.list', '.json', '.jsonl', '.ndjson')
+INBOX_SETTLE = 2.0          # s a file must sit unmodified before it's read (polling mode)
+INBOX_POLL = 5.0
+IN_CLOSE_WRITE, IN_MOVED_TO = 0x08, 0x80
+
+def bv_to_aid(bvid: str) -> int | None:
+    # BV ids are a reversible encoding of the numeric aid
+    tail = bvid[3:]
+    if not bvid.startswith('BV1') or len(tail) != 9:
+        return None
+    tmp = 0
+    try:
+        for i in reversed(_BV_ORDER):
+            tmp = tmp * 58 + _BV_ALPHABET.index(tail[i])
+    except ValueError:
+        return None
+    return (tmp & _BV_MASK) ^ _BV_XOR
+
+def video_key(url: str) -> int:
+    # BV.../av... for the same video share one key; other URLs key on their text minus
+    # query and fragment. A 64-bit int in the seen-set costs about 75 bytes (int object
+    # plus hash slot), a fraction of what the URL string itself would.
+    vid = parse_bv_av(url)
+    if vid:
+        aid = int(vid[2:]) if vid.startswith('av') else bv_to_aid(vid)
+        if aid is not None:
+            return aid
+        text = vid
+    else:
+        parts = urllib.parse.urlsplit(url.strip())
+        text = (parts.netloc.lower().removeprefix('www.') + parts.path.rstrip('/')) or url.strip()
+    # ids stay below 2**52, text hashes are pushed above it so the two never collide
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big') | (1 << 63)
+
+def parse_ingest_line(line: str):
+    # "URL [priority=N] [deadline=...]" or an NDJSON object with url/bvid/aid (+priority, deadline)
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return '', {}
+    if not line.startswith('{'):
+        # pasted share text ("【title】 https://b23.tv/xxxx"): start at the link
+        m = re.search(r'https?://\S+', line)
+        if m and not line.startswith(('http', 'BV', 'av')):
+            line = line[m.start():]
+        return parse_job_spec(line)
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        cprint(f"[!] Skipping bad JSON line: {line[:80]}", FG_YELLOW)
+        return '', {}
+    url = obj.get('url') or obj.get('bvid') or (f"av{obj['aid']}" if obj.get('aid') else '')
+    meta = {}
+    if obj.get('priority') is not None:
+        meta['priority'] = int(obj['priority'])
+    deadline = obj.get('deadline')
+    if isinstance(deadline, (int, float)):
+        meta['deadline'] = float(deadline)
+    elif deadline:
+        meta.update(parse_job_spec(f"{url} deadline={deadline}")[1])
+    return url, meta
+
+def iter_source_lines(source: str):
+    # A list file, or '-' for stdin
+    if source == '-':
+        yield from sys.stdin
+        return
+    with open(os.path.expanduser(source), encoding='utf-8', errors='replace') as fh:
+        yield from fh
+
+def _inotify_waiter(path: str):
+    # Returns (wait(timeout), close): wait wakes early when a file is closed/moved
+    # into `path`; plain sleeping (polling, close is None) where inotify isn't available.
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify unavailable")
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, "inotify unavailable")
+    except (OSError, AttributeError):
+        return time.sleep, None
+
+    def wait(timeout: float):
+        if select.select([fd], [], [], timeout)[0]:
+            with contextlib.suppress(BlockingIOError):
+                while os.read(fd, 65536):
+                    pass  # the directory is rescanned anyway; events only wake us
+    return wait, functools.partial(os.close, fd)
+
+def iter_inbox(path: str, poll: float = INBOX_POLL):
+    # Reads every list file dropped into `path`, oldest first, then moves it to
+    # <path>/done. Runs until interrupted (Ctrl-C ends the stream cleanly).
+    path = os.path.abspath(os.path.expanduser(path))
+    done = os.path.join(path, 'done')
+    os.makedirs(done, exist_ok=True)
+    wait, close = _inotify_waiter(path)
+    native = close is not None
+    cprint(f"[i] Watching {path} for URL lists ({'inotify' if native else 'polling'}; Ctrl-C to stop)", FG_CYAN)
+    try:
+        while True:
+            now = time.time()
+            ready = sorted((e for e in os.scandir(path)
+                            if e.is_file() and not e.name.startswith('.')
+                            and e.name.lower().endswith(INBOX_SUFFIXES)
+                            and (native or now - e.stat().st_mtime >= INBOX_SETTLE)),
+                           key=lambda e: e.stat().st_mtime)
+            for entry in ready:
+                cprint(f"[i] Inbox: {entry.name}", FG_CYAN)
+                yield from iter_source_lines(entry.path)
+                os.replace(entry.path, os.path.join(done, entry.name))
+            wait(poll if native or not ready else INBOX_SETTLE)
+    except KeyboardInterrupt:
+        cprint("\n[i] Inbox watch stopped; finishing queued jobs.", FG_YELLOW)
+    finally:
+        if close:
+            close()
+
+# ----- b23.tv short links -----
+SHORT_LINK_CACHE = 'short_links.json'
+SHORT_LINK_RE = re.compile(r'https?://(?:b23\.tv|bili2233\.cn)/([0-9A-Za-z]+)')
+SHORT_LINK_WORKERS = 8
+SHORT_LINK_CACHE_MAX = 200000
+SHORT_LINK_SAVE_EVERY = 50
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Surface the 302 as an HTTPError instead of fetching the (heavy) video page
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def canonical_url(url: str) -> str:
+    # Drop share_source/spm tracking; a video becomes its bare /video/<id> URL
+    vid = parse_bv_av(url)
+    if vid:
+        return f"https://www.bilibili.com/video/{vid}"
+    u = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit((u.scheme or 'https', u.netloc, u.path, '', ''))
+
+class ShortLinkResolver:
+    # short code -> canonical URL, persisted across runs; a code is only ever
+    # expanded once, and batches of new codes are expanded in parallel.
+    def __init__(self, workers: int = SHORT_LINK_WORKERS):
+        self.cache = load_state(SHORT_LINK_CACHE)
+        self.lock = threading.Lock()
+        self.dirty = 0
+        self.workers = workers
+        self.opener = urllib.request.build_opener(_NoRedirect())
+
+    def expand(self, code: str) -> str:
+        def call(_slot):
+            try:
+                with http_open(f"https://b23.tv/{code}", self.opener, timeout=10):
+                    pass
+            except urllib.error.HTTPError as e:
+                if e.code in (301, 302, 303, 307, 308) and e.headers.get('Location'):
+                    return e.headers['Location']
+                raise
+            raise ApiError(f"b23.tv/{code} did not redirect")
+        return canonical_url(with_retry(call, 'api'))
+
+    def resolve(self, url: str) -> str:
+        m = SHORT_LINK_RE.search(url)
+        if not m:
+            return url
+        code = m.group(1)
+        with self.lock:
+            hit = self.cache.get(code)
+        if hit:
+            METRICS.count('short_link_cached')
+            return hit
+        try:
+            long_url = self.expand(code)
+        except Exception as e:
+            cprint(f"[!] Could not expand {m.group(0)} ({e}); passing it to yt-dlp as-is", FG_YELLOW)
+            return url
+        METRICS.count('short_link_expanded')
+        with self.lock:
+            self.cache[code] = long_url
+            self.dirty += 1
+            flush = self.dirty >= SHORT_LINK_SAVE_EVERY
+        if flush:
+            self.save()
+        return long_url
+
+    def resolve_specs(self, specs):
+        # (url, meta) -> (canonical url, meta, was_short), input order kept
+        def one(spec):
+            url, meta = spec
+            long_url = self.resolve(url)
+            return long_url, meta, long_url != url
+        return bounded_map(one, specs, self.workers)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            if len(self.cache) > SHORT_LINK_CACHE_MAX:
+                # dicts keep insertion order: drop the oldest codes
+                self.cache = dict(list(self.cache.items())[-SHORT_LINK_CACHE_MAX:])
+            save_state(SHORT_LINK_CACHE, self.cache)
+            self.dirty = 0
+
+# ----- Ingest pipeline -----
+def ingest_specs(lines, seen: set | None = None, resolver: ShortLinkResolver | None = None):
+    # Normalise and de-duplicate on the fly: the same video via a BV link, an av
+    # link, a mobile share URL or a b23.tv short link is yielded once.
+    seen = set() if seen is None else seen
+
+    def unseen(url: str) -> bool:
+        key = video_key(url)
+        if key in seen:
+            METRICS.count('ingest_duplicate')
+            return False
+        seen.add(key)
+        return True
+
+    # repeats of a short link are dropped here, before any network work
+    specs = (spec for spec in map(parse_ingest_line, lines) if spec[0] and unseen(spec[0]))
+    resolved = resolver.resolve_specs(specs) if resolver else ((u, m, False) for u, m in specs)
+    try:
+        for url, meta, was_short in resolved:
+            if was_short and not unseen(url):
+                continue
+            METRICS.count('ingest_url')
+            yield url, meta
+    finally:
+        if resolver:
+            resolver.save()
+
+_ydl_local = threading.local()
+
+def thread_ydl(opts: dict, opened: list):
+    # One YoutubeDL per worker thread and option set, so connections and cookies are reused;
+    # the thread's egress (proxy / source address) is part of the option set
+    opts = {**opts, **egress_ydl_opts()}
+    cache = _ydl_local.__dict__.setdefault('by_opts', {})
+    key = repr(sorted(opts.items()))
+    ydl = cache.get(key)
+    if ydl is None:
+        ydl = cache[key] = yt_dlp.YoutubeDL(opts)
+        opened.append(ydl)
+    return ydl
+
+def batch_ydl_opts(download_dir: str, cookiefile: str | None, fmt: str = BEST_FORMAT,
+                   audio_only: bool | None = None) -> dict:
+    # audio_only defaults to fmt == AUDIO_FORMAT; composite specs (plans) pass it explicitly
+    if audio_only is None:
+        audio_only = fmt == AUDIO_FORMAT
+    opts = {
+        'format': fmt,
+        'outtmpl': os.path.join(download_dir, '%(title)s.%(ext)s'),
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'continuedl': True,
+        # fixed large blocks: one write() per WRITE_BUFFER instead of yt-dlp's small adaptive ones
+        'buffersize': WRITE_BUFFER,
+        'noresizebuffer': True,
+        # with_retry (RETRY_POLICIES) is the one place failures are repeated: yt-dlp gives up
+        # at once, and a missing fragment fails the job instead of leaving a gap
+        'retries': 0,
+        'fragment_retries': 0,
+        'extractor_retries': 0,
+        'skip_unavailable_fragments': False,
+    }
+    opts['progress_hooks'] = [cdn_stats_hook, event_progress_hook] if EVENTS else [cdn_stats_hook]
+    if audio_only:
+        opts['fixup'] = 'never'  # keep the DASH track byte-for-byte, no ffmpeg pass
+    else:
+        opts['merge_output_format'] = 'mp4'
+    if cookiefile:
+        opts['cookiefile'] = cookiefile
+    return opts
+
+def download_vid(vid: str, opts: dict, opened: list, ffmpeg_path: str | None = None,
+                 ie_result: dict | None = None, storage: StorageManager | None = None,
+                 expected: int | None = None) -> list:
+    # Download one BV/av id (all parts of an anthology); returns [(path, size), ...].
+    # A still-valid ie_result (from a plan or an earlier attempt) skips extraction.
+    ydl = thread_ydl(opts, opened)
+    url = f"https://www.bilibili.com/video/{vid}"
+    handed_out = False
+
+    def extract(_slot):
+        # extraction counts against the API limit, the transfer against the CDN limit
+        with profile_phase('extract'):
+            return ydl.extract_info(url, download=False, process=False)
+
+    def transfer(slot, dl_ydl):
+        # yt-dlp fills in the dict it processes (requested_formats, requested_downloads)
+        # and consumes a playlist's lazy entries: each attempt works on its own copy,
+        # and an anthology is listed afresh after the first attempt
+        nonlocal handed_out
+        if ie_result.get('_type', 'video') == 'video':
+            res = copy.deepcopy(ie_result)
+        elif handed_out:
+            res = extract(slot)
+        else:
+            res, handed_out = ie_result, True
+        with profile_phase('download'), cdn_stats_job():
+            info = dl_ydl.process_ie_result(res, download=True)
+        results = []
+        for entry in [e for e in info.get('entries') or [info] if e]:
+            for dl in entry.get('requested_downloads') or []:
+                path = dl.get('filepath')
+                if not path or not os.path.exists(path):
+                    continue
+                if dl.get('vcodec') == 'none' and ffmpeg_path and not path.endswith('.flac') \
+                        and (dl.get('acodec') or entry.get('acodec') or '').startswith('flac'):
+                    path = remux_flac(path, ffmpeg_path)
+                note_media(path, media_meta(entry))
+                results.append((path, os.path.getsize(path)))
+        slot.nbytes = sum(size for _, size in results)
+        return results
+
+    def attempt():
+        if storage is None:
+            return with_retry(lambda slot: transfer(slot, ydl), 'cdn')
+        size = expected
+        if size is None:
+            try:
+                size = expected_bytes(ydl, ie_result, opts['format'])
+            except Exception:
+                size = None  # estimate only; place() falls back to the default reservation
+        with storage.place(size) as root:
+            # yt-dlp downloads and merges under paths['temp'], then moves into 'home'
+            job_opts = {**opts, 'outtmpl': '%(title)s.%(ext)s',
+                        'paths': {'home': root, 'temp': storage.staging(root)}}
+            return with_retry(lambda slot: transfer(slot, thread_ydl(job_opts, opened)), 'cdn')
+
+    if ie_result is not None:
+        STREAM_URLS.put(vid, ie_result)
+    # with_retry already repeated other failures as their class allows (and the
+    # queue may requeue the job); a rejected signature is the one case handled
+    # here, because it needs a fresh extraction first
+    refresh = RETRY_POLICIES['expired']
+    for n in itertools.count():
+        if ie_result is None:
+            ie_result = STREAM_URLS.get(vid)
+        if ie_result is None:
+            ie_result = with_retry(extract, 'api')
+            handed_out = False
+            STREAM_URLS.put(vid, ie_result)
+        try:
+            results = attempt()
+        except Exception as e:
+            if n + 1 >= refresh.tries or classify_error(e) != 'expired':
+                raise  # STREAM_URLS keeps still-signed URLs for a requeued attempt
+            METRICS.count('stream_url_refreshed')
+            STREAM_URLS.drop(vid)
+            ie_result = None
+            time.sleep(refresh.delay(n))
+            continue
+        STREAM_URLS.drop(vid)
+        return results
+
+def make_download_fn(storage: StorageManager, cookiefile: str | None, fmt: str, opened: list,
+                     race_mirrors: bool = False, sections=None, variants=None):
+    # vid -> [(path, size), ...] through yt-dlp, the mirror-racing direct path, or clip mode
+    ffmpeg_path = shutil.which('ffmpeg')
+    if fmt == AUDIO_FORMAT and not ffmpeg_path:
+        cprint("[!] ffmpeg not found — FLAC tracks will be kept in their .m4a box.", FG_YELLOW)
+    if race_mirrors or sections or variants:
+        opener = build_opener(cookiefile)
+        max_height = policy_height(fmt)
+        if variants:
+            return lambda vid: download_variants(vid, variants, storage, opener, ffmpeg_path)
+        if sections:
+            return lambda vid: download_clips(vid, sections, storage, opener, ffmpeg_path, max_height,
+                                              audio_only=fmt == AUDIO_FORMAT)
+        return lambda vid: download_dash_direct(vid, storage, opener, ffmpeg_path, max_height,
+                                                audio_only=fmt == AUDIO_FORMAT)
+    opts = batch_ydl_opts(storage.roots[0], cookiefile, fmt)
+    return lambda vid: download_vid(vid, opts, opened, ffmpeg_path, storage=storage)
+
+def make_batch_reporter(transcode=None):
+    # transcode: optional post-processing stage (EmbedStage / TranscodeStage) fed every finished file
+    stats = {'files': 0, 'bytes': 0, 'failed': 0, 't0': time.time(), 'completions': [],
+             'errors': collections.Counter()}
+    def report(vid, files, err):
+        METRICS.count('jobs_failed' if err else 'jobs_done')
+        if not err:
+            stats['completions'].append(time.time() - stats['t0'])
+        if err:
+            stats['failed'] += 1
+            stats['errors'][classify_error(err)] += 1
+            cprint(f"[!] {vid}: {error_summary(err)}", FG_RED)
+            return
+        for path, size in files:
+            stats['files'] += 1
+            stats['bytes'] += size
+            METRICS.count('bytes', size)
+            cprint(f"[+] {os.path.basename(path)} ({human_size(size)})", FG_GREEN)
+            if transcode:
+                transcode.submit(path)
+    def summary(label: str):
+        elapsed = max(time.time() - stats['t0'], 1e-6)
+        record_throughput(stats['bytes'], elapsed)
+        errors = ', '.join(f"{n} {cls}" for cls, n in stats['errors'].most_common())
+        cprint(f"[i] {label}: {stats['files']} file(s), {human_size(stats['bytes'])} in {elapsed:.1f}s "
+               f"({human_size(stats['bytes'] / elapsed)}/s), {stats['failed']} failed"
+               + (f" ({errors})" if errors else ''), FG_CYAN)
+        done = sorted(stats['completions'])
+        if done:
+            cprint(f"[i] Job completion: mean {sum(done) / len(done):.1f}s, median {done[len(done) // 2]:.1f}s, "
+                   f"last {done[-1]:.1f}s", FG_CYAN)
+        limits = ', '.join(f"{name} {c.limit}/{c.maximum}" for name, c in CONTROLLERS.items())
+        cuts = sum(1 for e in METRICS.events if e['kind'] == 'aimd' and e['action'] == 'decrease')
+        emit('summary', label=label, files=stats['files'], bytes=stats['bytes'], failed=stats['failed'],
+             errors=dict(stats['errors']), requeued=METRICS.counters['jobs_requeued'],
+             elapsed=round(elapsed, 3), limits={name: c.limit for name, c in CONTROLLERS.items()},
+             egress=EGRESS.state() if EGRESS else None)
+        cprint(f"[i] Concurrency limits: {limits} ({cuts} back-off(s))", FG_CYAN)
+        trips = {name: b.trips for name, b in BREAKERS.items() if b.trips}
+        if trips or METRICS.counters['jobs_requeued']:
+            cprint(f"[i] Retries: {METRICS.counters['jobs_requeued']} job(s) requeued, circuit breaker opened "
+                   + (', '.join(f"{n}x for {name}" for name, n in trips.items()) or '0x'), FG_CYAN)
+        if EGRESS:
+            EGRESS.report()
+        if transcode:
+            transcode.join()
+    return report, summary
+
+def make_job_items(vid: str, cookiefile: str | None, opened: list, quality: str) -> list:
+    # Extract (cache first) and size one video for the scheduler -> [JobRecord, ...]
+    items = []
+    ydl = thread_ydl({'quiet': True, 'no_warnings': True}, opened)
+    egress = current_egress()
+    for info in cached_extract(vid, cookiefile, opened):
+        pick = select_for_plan(ydl, info, QUALITY_POLICIES[quality])
+        if not pick:
+            raise ApiError(f"no format matches policy {quality}")
+        items.append(JobRecord.from_info(vid, info, pick, quality, egress and egress.name))
+    return items
+
+def run_batch(specs, storage: StorageManager, cookiefile: str | None, fmt: str = BEST_FORMAT,
+              jobs: int = 4, race_mirrors: bool = False, label: str = "Batch",
+              order: str = 'fifo', aging: float | None = None, quality: str = 'best', sections=None,
+              transcode=None, variants=None, danmaku_fmt: str | None = None, subs_fmt: str | None = None):
+    # specs: [(url, {'priority': .., 'deadline': ..}), ...] as from parse_job_spec
+    opened = []
+    report, summary = make_batch_reporter(transcode)
+    if order == 'fifo':
+        jq = JobQueue(with_text_tracks(make_download_fn(storage, cookiefile, fmt, opened, race_mirrors, sections,
+                                                        variants), danmaku_fmt, subs_fmt, cookiefile),
+                      jobs, report)
+    else:
+        # ordering needs sizes, so extraction (API side) runs ahead of the downloads
+        direct = (make_download_fn(storage, cookiefile, fmt, opened, race_mirrors, sections, variants)
+                  if race_mirrors or sections or variants else None)
+        planned = plan_download_fn(storage, cookiefile, opened)
+        jq = JobQueue(with_text_tracks(lambda rec: direct(rec.vid) if direct else planned(rec),
+                                       danmaku_fmt, subs_fmt, cookiefile), jobs,
+                      lambda rec, files, err: report(rec.vid, files, err), order, aging)
+    try:
+        pairs = ((vid, meta) for url, meta in specs for vid in iter_video_ids(url, cookiefile))
+        if order == 'fifo':
+            for vid, _meta in pairs:
+                jq.put(vid)
+        else:
+            def extract(pair):
+                vid, meta = pair
+                try:
+                    with EGRESS.lease():
+                        return meta, make_job_items(vid, cookiefile, opened, quality), None
+                except Exception as e:
+                    return meta, vid, e
+            for meta, items, err in bounded_map(extract, pairs, jobs):
+                if err:
+                    report(items, None, err)
+                    continue
+                for rec in items:
+                    jq.put(rec, rec.bytes, meta.get('priority', 0), meta.get('deadline'))
+        jq.join()
+    finally:
+        for ydl in opened:
+            ydl.close()
+    summary(label)
+
+# ----- Audio-only fast path -----
+# Never falls back to a combined stream (no '/best'): flac if offered, else the m4a DASH track.
+AUDIO_FORMAT = 'bestaudio[acodec=flac]/bestaudio[ext=m4a]/bestaudio'
+
+@profiled('postprocess')
+def remux_flac(path: str, ffmpeg_path: str) -> str:
+    # Bilibili ships FLAC inside an mp4 box; lift it into a .flac file (stream copy only)
+    out = os.path.splitext(path)[0] + '.flac'
+    subprocess.run([ffmpeg_path, '-v', 'error', '-y', '-i', path, '-map', '0:a', '-c', 'copy', out], check=True)
+    os.remove(path)
+    return out
+
+# ----- Transcoding profiles (post-processing on a process pool) -----
+# Profiles come from transcode.json in the config dir (or --transcode-config) and
+# override/extend the built-ins. Keys: codec (name ffprobe reports), vcodec
+# (encoder), profile, level, max_height, crf or video_bitrate/maxrate/bufsize,
+# preset, acodec, audio_bitrate, threads, suffix.
+TRANSCODE_CONFIG = 'transcode.json'
+TRANSCODE_PROFILES = {
+    'tablet': {'codec': 'h264', 'vcodec': 'libx264', 'profile': 'baseline', 'level': '3.1', 'max_height': 720,
+               'video_bitrate': '1500k', 'maxrate': '1800k', 'bufsize': '3000k', 'preset': 'veryfast',
+               'acodec': 'aac', 'audio_bitrate': '128k', 'threads': 2},
+}
+
+def config_dir() -> Path:
+    base = os.environ.get('XDG_CONFIG_HOME') or os.path.join(Path.home(), '.config')
+    return Path(base) / 'bili_bili'
+
+def load_transcode_profiles(path: str | None = None) -> dict:
+    profiles = {name: dict(p) for name, p in TRANSCODE_PROFILES.items()}
+    path = os.path.expanduser(path) if path else config_dir() / TRANSCODE_CONFIG
+    try:
+        with open(path, encoding='utf-8') as fh:
+            for name, p in json.load(fh).items():
+                profiles[name] = {**profiles.get(name, {}), **p}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        cprint(f"[!] Could not read transcode profiles from {path}: {e}", FG_YELLOW)
+    return profiles
+
+def _bitrate(text) -> int | None:
+    # "1800k" / "2M" / 1800000 -> bits per second
+    if text is None:
+        return None
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([kKmM]?)', str(text))
+    return int(float(m.group(1)) * {'': 1, 'k': 1000, 'm': 1000 ** 2}[m.group(2).lower()]) if m else None
+
+def probe_video(ffprobe_path: str | None, path: str) -> dict | None:
+    # First video stream as ffprobe reports it; {} when there is none, None if unknown
+    if not ffprobe_path:
+        return None
+    proc = subprocess.run([ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                           'stream=codec_name,profile,height,bit_rate:format=bit_rate', '-of', 'json', path],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    data = json.loads(proc.stdout or '{}')
+    streams = data.get('streams') or []
+    if not streams:
+        return {}
+    st = streams[0]
+    st['bit_rate'] = _bitrate(st.get('bit_rate') or (data.get('format') or {}).get('bit_rate'))
+    return st
+
+def profile_matches(stream: dict, profile: dict) -> bool:
+    # Already what the device needs: same codec, not taller, (constrained) same profile, within the cap
+    if stream.get('codec_name') != profile.get('codec'):
+        return False
+    if profile.get('max_height') and (stream.get('height') or 0) > profile['max_height']:
+        return False
+    if profile.get('profile') and profile['profile'].lower() not in (stream.get('profile') or '').lower():
+        return False
+    cap = _bitrate(profile.get('maxrate') or profile.get('video_bitrate'))
+    return not (cap and stream.get('bit_rate') and stream['bit_rate'] > cap)
+
+def transcode_command(ffmpeg_path: str, src: str, out: str, p: dict) -> list:
+    cmd = [ffmpeg_path, '-v', 'error', '-y', '-i', src, '-map', '0:v:0', '-map', '0:a?',
+           '-c:v', p.get('vcodec', 'libx264')]
+    for opt, key in (('-profile:v', 'profile'), ('-level', 'level'), ('-preset', 'preset'), ('-crf', 'crf'),
+                     ('-b:v', 'video_bitrate'), ('-maxrate', 'maxrate'), ('-bufsize', 'bufsize')):
+        if p.get(key) is not None:
+            cmd += [opt, str(p[key])]
+    if p.get('max_height'):
+        cmd += ['-vf', f"scale=-2:'min({int(p['max_height'])},ih)'"]
+    cmd += ['-c:a', p.get('acodec', 'aac')]
+    if p.get('audio_bitrate'):
+        cmd += ['-b:a', str(p['audio_bitrate'])]
+    return cmd + list(p.get('extra') or []) + ['-threads', str(p.get('threads', 2)), '-movflags', '+faststart', out]
+
+def transcode_one(src: str, name: str, profile: dict, ffmpeg_path: str, ffprobe_path: str | None) -> dict:
+    # Runs in a pool process. Output lands as <stem>.<profile>.mp4 next to the
+    # source via a .part file, so an interrupted run simply redoes that one file.
+    res = {'src': src, 'profile': name, 'state': 'done', 'out': None, 'error': None, 'seconds': 0.0}
+    out = f"{os.path.splitext(src)[0]}.{profile.get('suffix', name)}.mp4"
+    if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(src):
+        res.update(state='exists', out=out)
+        return res
+    stream = probe_video(ffprobe_path, src)
+    if stream == {} or (stream and profile_matches(stream, profile)):
+        res['state'] = 'skipped'   # audio-only, or already fits the device
+        return res
+    part = out + '.part.mp4'
+    t0 = time.time()
+    proc = subprocess.run(transcode_command(ffmpeg_path, src, part, profile), capture_output=True, text=True)
+    res['seconds'] = round(time.time() - t0, 2)
+    if proc.returncode != 0:
+        with contextlib.suppress(OSError):
+            os.remove(part)
+        res.update(state='failed', error=(proc.stderr or '').strip()[-300:] or f"ffmpeg exit {proc.returncode}")
+        return res
+    os.replace(part, out)
+    res['out'] = out
+    return res
+
+class TranscodeStage:
+    # Downloads keep flowing while encodes run: submit() only queues the work.
+    # Pool size is cores / ffmpeg threads per job, so encodes don't oversubscribe.
+    def __init__(self, names, profiles: dict, workers: int | None = None):
+        self.ffmpeg = shutil.which('ffmpeg')
+        self.ffprobe = shutil.which('ffprobe')
+        unknown = [n for n in names if n not in profiles]
+        if unknown:
+            raise ValueError(f"unknown transcode profile(s): {', '.join(unknown)} (have: {', '.join(profiles)})")
+        if not self.ffmpeg:
+            raise ValueError("ffmpeg is required for --transcode")
+        if not self.ffprobe:
+            cprint("[!] ffprobe not found — every file will be transcoded, even ones that already fit.", FG_YELLOW)
+        self.profiles = {n: profiles[n] for n in names}
+        threads = max(p.get('threads', 2) for p in self.profiles.values())
+        self.workers = workers or max(1, (os.cpu_count() or 2) // threads)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.futures = []
+        self.counts = collections.Counter()
+
+    def submit(self, path: str):
+        for name, profile in self.profiles.items():
+            fut = self.pool.submit(transcode_one, path, name, profile, self.ffmpeg, self.ffprobe)
+            fut.add_done_callback(self._done)
+            self.futures.append(fut)
+
+    def _done(self, fut):
+        try:
+            res = fut.result()
+        except Exception as e:
+            res = {'state': 'failed', 'error': str(e), 'src': '?', 'profile': '?', 'out': None}
+        self.counts[res['state']] += 1
+        METRICS.count(f"transcode_{res['state']}")
+        emit('transcode', **res)
+        if res['state'] == 'done':
+            cprint(f"[+] {res['profile']}: {os.path.basename(res['out'])} ({res['seconds']:.0f}s)", FG_GREEN)
+        elif res['state'] == 'failed':
+            cprint(f"[!] {res['profile']}: {os.path.basename(res['src'])}: {res['error']}", FG_RED)
+
+    def join(self):
+        if self.futures and not all(f.done() for f in self.futures):
+            cprint(f"[i] Waiting for {sum(not f.done() for f in self.futures)} transcode(s) ...", FG_CYAN)
+        self.pool.shutdown(wait=True)
+        c = self.counts
+        cprint(f"[i] Transcode: {c['done']} encoded, {c['skipped']} already fit, {c['exists']} done earlier, "
+               f"{c['failed']} failed ({self.workers} worker(s))", FG_CYAN)
+
+# ----- Metadata & cover embedding (--embed, post-processing) -----
+# Title, uploader, date, URL, description, cover and chapters go into each
+# finished file. MP4/M4A tags are written into the moov box in place: rewritten
+# where it sits when it is the last box or has padding behind it, otherwise the
+# old moov becomes a 'free' box and the new one is appended. The media data is
+# never moved, so no chunk offsets change. Fragmented MP4 that can't grow in
+# place and FLAC go through mutagen when installed, else one ffmpeg -c copy pass.
+COVER_CACHE_MAX = 2000
+COVER_WORKERS = 8
+EMBED_BATCH = 8                 # files per pool task
+MP4_CONTAINERS = ('.mp4', '.m4a', '.m4v', '.mov')
+MP4_TEXT_ATOMS = {'title': b'\xa9nam', 'artist': b'\xa9ART', 'date': b'\xa9day', 'comment': b'\xa9cmt',
+                  'description': b'desc'}
+VORBIS_KEYS = {'title': 'TITLE', 'artist': 'ARTIST', 'date': 'DATE', 'comment': 'COMMENT',
+               'description': 'DESCRIPTION'}
+
+try:
+    import mutagen
+    import mutagen.flac
+    import mutagen.mp4
+except ImportError:
+    mutagen = None
+
+class NotInPlace(Exception):
+    pass
+
+def media_meta(info: dict) -> dict:
+    # Tags from a yt-dlp info dict (one video / anthology part)
+    day = info.get('upload_date') or (time.strftime('%Y%m%d', time.localtime(info['timestamp']))
+                                      if info.get('timestamp') else None)
+    return {'title': info.get('title'), 'artist': info.get('uploader'),
+            'date': f"{day[:4]}-{day[4:6]}-{day[6:8]}" if day else None,
+            'comment': info.get('webpage_url'), 'description': info.get('description'),
+            'thumbnail': info.get('thumbnail'),
+            'chapters': [(c.get('start_time') or 0, c.get('end_time'), c.get('title') or '')
+                         for c in info.get('chapters') or []] or None}
+
+def view_media_meta(view: dict, page: dict | None = None, title: str | None = None) -> dict:
+    # Tags from the view API; chapters are looked up by cid when the file is embedded
+    bvid = view.get('bvid')
+    return {'title': title or view.get('title'), 'artist': (view.get('owner') or {}).get('name'),
+            'date': time.strftime('%Y-%m-%d', time.localtime(view['pubdate'])) if view.get('pubdate') else None,
+            'comment': f"https://www.bilibili.com/video/{bvid}" if bvid else None,
+            'description': view.get('desc'), 'thumbnail': view.get('pic'), 'chapters': None,
+            'bvid': bvid, 'cid': page.get('cid') if page else None}
+
+def note_media(path: str, meta: dict):
+    # Download paths hand their file's tags over to the embed stage (if one runs)
+    if EMBED:
+        EMBED.note(path, meta)
+
+def fetch_chapters(bvid: str, cid: int, opener=None) -> list | None:
+    data = api_get('https://api.bilibili.com/x/player/wbi/v2', wbi_sign({'bvid': bvid, 'cid': cid}, opener), opener)
+    points = [p for p in (data or {}).get('view_points') or [] if p.get('type', 2) == 2]
+    return [(p.get('from') or 0, p.get('to'), p.get('content') or '') for p in points] or None
+
+def fetch_cover(url: str, opener=None) -> str | None:
+    # -> path of the cached image (JPEG/PNG only: what MP4 covr and FLAC accept)
+    if not url:
+        return None
+    if url.startswith('//'):
+        url = 'https:' + url
+    d = state_dir() / 'covers'
+    d.mkdir(exist_ok=True)
+    key = hashlib.sha1(url.encode()).hexdigest()[:24]
+    for ext in ('.jpg', '.png'):
+        if (d / (key + ext)).exists():
+            METRICS.count('cover_cache_hits')
+            return str(d / (key + ext))
+    data = http_get(url, opener, headers=CDN_HEADERS)
+    ext = '.jpg' if data[:2] == b'\xff\xd8' else '.png' if data[:8] == b'\x89PNG\r\n\x1a\n' else None
+    if not ext:
+        return None
+    path = d / (key + ext)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    return str(path)
+
+def prune_covers(keep: int = COVER_CACHE_MAX):
+    d = state_dir() / 'covers'
+    if not d.is_dir():
+        return
+    files = sorted(d.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)
+    for p in files[keep:]:
+        with contextlib.suppress(OSError):
+            p.unlink()
+
+def _box(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+def _boxes(buf: bytes, pos: int = 0, end: int | None = None) -> list:
+    # -> [(type, offset, size, header length)] of the boxes laid out in buf[pos:end]
+    end = len(buf) if end is None else end
+    out = []
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        hl = 8
+        if size == 1:
+            size, hl = struct.unpack_from('>Q', buf, pos + 8)[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < hl or pos + size > end:
+            raise NotInPlace(f"bad {kind!r} box")
+        out.append((kind, pos, size, hl))
+        pos += size
+    return out
+
+def _file_boxes(fh, file_size: int) -> list:
+    # Top-level boxes; the last one also reports whether its size field was 0 ("to EOF")
+    out, pos = [], 0
+    while pos + 8 <= file_size:
+        fh.seek(pos)
+        hdr = fh.read(16)
+        size, kind = struct.unpack('>I4s', hdr[:8])
+        hl, to_eof = 8, size == 0
+        if size == 1:
+            size, hl = struct.unpack('>Q', hdr[8:16])[0], 16
+        elif to_eof:
+            size = file_size - pos
+        if size < hl or pos + size > file_size:
+            raise NotInPlace(f"truncated {kind!r} box")
+        out.append((kind, pos, size, hl, to_eof))
+        pos += size
+    return out
+
+def mp4_meta_box(meta: dict, cover: bytes | None, old_ilst: list) -> bytes:
+    items = {kind: raw for kind, raw in old_ilst}
+    for key, atom in MP4_TEXT_ATOMS.items():
+        if meta.get(key):
+            items[atom] = _box(atom, _box(b'data', struct.pack('>II', 1, 0) + str(meta[key]).encode()))
+    if cover:
+        items[b'covr'] = _box(b'covr', _box(b'data', struct.pack('>II', 14 if cover[:4] == b'\x89PNG' else 13, 0)
+                                                + cover))
+    hdlr = _box(b'hdlr', b'\0' * 8 + b'mdirappl' + b'\0' * 9)
+    return _box(b'meta', b'\0' * 4 + hdlr + _box(b'ilst', b''.join(items.values())))
+
+def mp4_chpl_box(chapters) -> bytes:
+    # Nero chapter list, as ffmpeg writes it: 100 ns start times, 255 chapters at most
+    chapters = list(chapters)[:255]
+    body = b''.join(struct.pack('>QB', int(start * 10_000_000), len(t)) + t
+                    for start, _end, title in chapters for t in [title.encode()[:255]])
+    return _box(b'chpl', struct.pack('>IIB', 0x01000000, 0, len(chapters)) + body)
+
+def mp4_embed_in_place(path: str, meta: dict, cover: bytes | None) -> str:
+    with open(path, 'r+b') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        top = _file_boxes(fh, size)
+        idx = next((i for i, b in enumerate(top) if b[0] == b'moov'), None)
+        if idx is None:
+            raise NotInPlace("no moov box")
+        _, pos, msize, mhl, _ = top[idx]
+        fh.seek(pos)
+        moov = fh.read(msize)
+        children = _boxes(moov, mhl)
+        fragmented = any(k == b'mvex' for k, *_ in children)
+        kept, udta_kept, old_ilst = [], [], []
+        for kind, off, bsize, hl in children:
+            raw = moov[off:off + bsize]
+            if kind != b'udta':
+                kept.append(raw)
+                continue
+            for ukind, uoff, usize, uhl in _boxes(raw, hl):
+                if ukind == b'meta':
+                    for mkind, moff, msz, mhl2 in _boxes(raw, uoff + uhl + 4, uoff + usize):
+                        if mkind == b'ilst':
+                            old_ilst = [(k, raw[o:o + s]) for k, o, s, _ in _boxes(raw, moff + mhl2, moff + msz)]
+                elif ukind != b'chpl' or not meta.get('chapters'):
+                    udta_kept.append(raw[uoff:uoff + usize])
+        if meta.get('chapters'):
+            udta_kept.append(mp4_chpl_box(meta['chapters']))
+        udta_kept.append(mp4_meta_box(meta, cover, old_ilst))
+        new = _box(b'moov', b''.join(kept) + _box(b'udta', b''.join(udta_kept)))
+        # The new moov only ever goes to bytes no reader uses yet (the padding after the
+        # old one, else the end of the file) and is synced before the old box becomes
+        # 'free': a crash in between leaves the old tags, never a half-written moov
+        at, room, how = None, 0, 'in place (padding)'
+        if idx + 1 < len(top) and top[idx + 1][0] in (b'free', b'skip'):
+            room = top[idx + 1][2]
+            if len(new) == room or len(new) + 8 <= room:
+                at = pos + msize
+        if at is None:
+            tail = pos + msize == size
+            if not tail and (fragmented or top[-1][4] and top[-1][3] != 8):
+                raise NotInPlace("moov can't grow here")
+            if top[-1][4]:
+                # a box running "to EOF" gets its real size before anything is appended
+                fh.seek(top[-1][1])
+                fh.write(struct.pack('>I', top[-1][2]))
+            at, room, how = size, 0, 'in place (tail)' if tail else 'in place (moov moved to end)'
+        fh.seek(at)
+        fh.write(new)
+        if room > len(new):
+            fh.write(struct.pack('>I4s', room - len(new), b'free'))
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.seek(pos + 4)
+        fh.write(b'free')
+        return how
+
+def mutagen_embed(path: str, meta: dict, cover: bytes | None) -> str:
+    if path.lower().endswith('.flac'):
+        f = mutagen.flac.FLAC(path)
+        for key, name in VORBIS_KEYS.items():
+            if meta.get(key):
+                f[name] = str(meta[key])
+        for n, (start, _end, title) in enumerate(meta.get('chapters') or [], start=1):
+            f[f"CHAPTER{n:03d}"] = f"{int(start // 3600):02d}:{int(start % 3600 // 60):02d}:{start % 60:06.3f}"
+            f[f"CHAPTER{n:03d}NAME"] = title
+        if cover:
+            pic = mutagen.flac.Picture()
+            pic.type, pic.data = 3, cover
+            pic.mime = 'image/png' if cover[:4] == b'\x89PNG' else 'image/jpeg'
+            f.clear_pictures()
+            f.add_picture(pic)
+    else:
+        f = mutagen.mp4.MP4(path)
+        if f.tags is None:
+            f.add_tags()
+        for key, atom in MP4_TEXT_ATOMS.items():
+            if meta.get(key):
+                f.tags[atom.decode('latin-1')] = [str(meta[key])]
+        if cover:
+            fmt = mutagen.mp4.MP4Cover.FORMAT_PNG if cover[:4] == b'\x89PNG' else mutagen.mp4.MP4Cover.FORMAT_JPEG
+            f.tags['covr'] = [mutagen.mp4.MP4Cover(cover, fmt)]
+    f.save()
+    return 'mutagen'
+
+def ffmpeg_embed(path: str, meta: dict, cover_path: str | None, ffmpeg_path: str) -> str:
+    # Fallback: one stream-copy rewrite carrying tags, cover and chapters
+    root, ext = os.path.splitext(path)
+    tmp, chap = f"{root}.tag{ext}", f"{root}.chapters.txt"
+    cmd = [ffmpeg_path, '-v', 'error', '-y', '-i', path]
+    maps = ['-map', '0', '-map_metadata', '0']
+    inputs = 1
+    if cover_path:
+        cmd += ['-i', cover_path]
+        maps += ['-map', str(inputs), f"-disposition:v:{0 if ext.lower() in ('.m4a', '.flac') else 1}", 'attached_pic']
+        inputs += 1
+    if meta.get('chapters'):
+        with open(chap, 'w', encoding='utf-8') as fh:
+            fh.write(';FFMETADATA1\n')
+            for start, end, title in meta['chapters']:
+                title = re.sub(r'([=;#\\\n])', r'\\\1', title)
+                fh.write(f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={int(start * 1000)}\n"
+                         f"END={int((end or start) * 1000)}\ntitle={title}\n")
+        cmd += ['-i', chap]
+        maps += ['-map_chapters', str(inputs)]
+    for key in MP4_TEXT_ATOMS:
+        if meta.get(key):
+            maps += ['-metadata', f"{key}={meta[key]}"]
+    try:
+        proc = subprocess.run(cmd + maps + ['-c', 'copy', tmp], capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise ApiError((proc.stderr or '').strip()[-300:] or f"ffmpeg exit {proc.returncode}")
+        os.replace(tmp, path)
+    finally:
+        for p in (tmp, chap):
+            with contextlib.suppress(OSError):
+                os.remove(p)
+    return 'ffmpeg rewrite'
+
+def embed_one(path: str, meta: dict, cover_path: str | None, ffmpeg_path: str | None) -> str:
+    cover = Path(cover_path).read_bytes() if cover_path else None
+    if path.lower().endswith(MP4_CONTAINERS):
+        try:
+            return mp4_embed_in_place(path, meta, cover)
+        except NotInPlace:
+            pass
+    if mutagen and path.lower().endswith(MP4_CONTAINERS + ('.flac',)) \
+            and not (meta.get('chapters') and ffmpeg_path and not path.lower().endswith('.flac')):
+        return mutagen_embed(path, meta, cover)
+    if ffmpeg_path:
+        return ffmpeg_embed(path, meta, cover_path, ffmpeg_path)
+    raise ApiError("can't tag this file without mutagen or ffmpeg")
+
+def embed_batch(jobs, ffmpeg_path: str | None) -> list:
+    # Runs in a pool process: [(path, meta, cover_path), ...] -> results
+    results = []
+    for path, meta, cover_path in jobs:
+        t0 = time.time()
+        try:
+            how, err = embed_one(path, meta, cover_path, ffmpeg_path), None
+        except Exception as e:
+            how, err = None, str(e)
+        results.append({'path': path, 'state': 'failed' if err else 'done', 'how': how, 'error': err,
+                        'cover': bool(cover_path), 'chapters': len(meta.get('chapters') or ()),
+                        'seconds': round(time.time() - t0, 3)})
+    return results
+
+class EmbedStage:
+    # Same interface as TranscodeStage (submit/join), and chains into it when
+    # given one: a file is handed on only after its tags are written. Covers and
+    # chapter lists are fetched on threads, the writes run batched on a process pool.
+    def __init__(self, then=None, cookiefile: str | None = None, workers: int | None = None):
+        self.then = then
+        self.ffmpeg = shutil.which('ffmpeg')
+        if not (mutagen or self.ffmpeg):
+            cprint("[!] Neither mutagen nor ffmpeg found — only MP4 files with room for tags will be tagged.",
+                   FG_YELLOW)
+        self.opener = build_opener(cookiefile)
+        self.workers = workers or max(1, min(4, os.cpu_count() or 1))
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.fetcher = ThreadPoolExecutor(max_workers=self.workers)
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.pending = []
+        self.futures = []
+        self.counts = collections.Counter()
+
+    def note(self, path: str, meta: dict):
+        with self.lock:
+            self.meta[os.path.abspath(path)] = meta
+
+    def submit(self, path: str):
+        with self.lock:
+            meta = self.meta.pop(os.path.abspath(path), None)
+            if meta is None:
+                self.counts['untagged'] += 1
+                batch = None
+            else:
+                self.pending.append((path, meta))
+                batch = self._take() if len(self.pending) >= EMBED_BATCH else None
+        if meta is None and self.then:
+            self.then.submit(path)
+        if batch:
+            self.futures.append(self.fetcher.submit(self._run, batch))
+
+    def _take(self) -> list:
+        batch, self.pending = self.pending, []
+        return batch
+
+    def _prepare(self, item):
+        path, meta = item
+        cover = None
+        try:
+            cover = fetch_cover(meta.get('thumbnail'), self.opener)
+            if not meta.get('chapters') and meta.get('bvid') and meta.get('cid'):
+                meta = {**meta, 'chapters': fetch_chapters(meta['bvid'], meta['cid'], self.opener)}
+        except Exception as e:
+            cprint(f"[!] {os.path.basename(path)}: cover/chapters unavailable: {e}", FG_YELLOW)
+        return path, {k: v for k, v in meta.items() if k in MP4_TEXT_ATOMS or k == 'chapters'}, cover
+
+    def _run(self, batch):
+        jobs = list(bounded_map(self._prepare, batch, COVER_WORKERS))
+        for res in self.pool.submit(embed_batch, jobs, self.ffmpeg).result():
+            self._done(res)
+
+    def _done(self, res: dict):
+        with self.lock:
+            self.counts[res['state']] += 1
+            if res['how']:
+                self.counts[res['how']] += 1
+        METRICS.count(f"embed_{res['state']}")
+        emit('embed', **res)
+        if res['state'] == 'failed':
+            cprint(f"[!] Tags: {os.path.basename(res['path'])}: {res['error']}", FG_RED)
+        if self.then:
+            self.then.submit(res['path'])
+
+    def join(self):
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self.futures.append(self.fetcher.submit(self._run, batch))
+        for fut in self.futures:
+            try:
+                fut.result()
+            except Exception as e:
+                cprint(f"[!] Tag batch failed: {e}", FG_RED)
+        self.fetcher.shutdown()
+        self.pool.shutdown(wait=True)
+        prune_covers()
+        c = self.counts
+        ways = ', '.join(f"{c[k]} {k}" for k in sorted(c) if k not in ('done', 'failed', 'untagged'))
+        cprint(f"[i] Tags: {c['done']} file(s) tagged ({ways or 'none'}), {c['failed']} failed"
+               + (f", {c['untagged']} without metadata" if c['untagged'] else ''), FG_CYAN)
+        if self.then:
+            self.then.join()
+
+EMBED = None
+
+# ----- Channel (UP owner) sync -----
+SYNC_STATE = 'sync_state.json'
+SYNC_PAGE_DELAY = 1.5  # seconds between space-listing pages; the listing API is quick to 412
+
+def parse_space_mid(s: str) -> str | None:
+    m = re.search(r'space\.bilibili\.com/(\d+)', s)
+    if m:
+        return m.group(1)
+    return s.strip() if s.strip().isdigit() else None
+
+def fetch_space_page(mid: str, pn: int, opener=None, ps: int = 30) -> dict:
+    params = {
+        'keyword': '', 'mid': mid, 'order': 'pubdate', 'order_avoided': 'true', 'platform': 'web',
+        'pn': pn, 'ps': ps, 'tid': 0, 'web_location': 1550101,
+        'dm_img_list': '[]',
+        'dm_img_str': base64.b64encode(''.join(random.choices(string.printable, k=random.randint(16, 64))).encode())[:-2].decode(),
+        'dm_cover_img_str': base64.b64encode(''.join(random.choices(string.printable, k=random.randint(32, 128))).encode())[:-2].decode(),
+        'dm_img_inter': '{"ds":[],"wh":[6093,6631,31],"of":[430,760,380]}',
+    }
+    # 412s are retried with backoff (and slow the API controller down) inside api_get
+    return api_get('https://api.bilibili.com/x/space/wbi/arc/search', wbi_sign(params, opener), opener)
+
+def iter_new_uploads(mid: str, mark: dict, opener=None):
+    # Newest-first pages, stopping at the first upload at or behind the watermark
+    pn = 1
+    while True:
+        data = fetch_space_page(mid, pn, opener) or {}
+        vlist = ((data.get('list') or {}).get('vlist')) or []
+        for v in vlist:
+            bvid, created = v.get('bvid'), v.get('created') or 0
+            if mark and (bvid == mark.get('bvid') or created < mark.get('pubdate', 0)):
+                return
+            yield bvid, created, v.get('title') or bvid
+        page = data.get('page') or {}
+        if not vlist or pn * (page.get('ps') or 30) >= (page.get('count') or 0):
+            return
+        pn += 1
+        time.sleep(SYNC_PAGE_DELAY)
+
+def sync_channels(channels, enqueue, opener=None, mark_only: bool = False) -> dict:
+    # Walk each channel down to its watermark and enqueue what is new. Returns the
+    # updated state; failed downloads are put back in 'pending' by the caller.
+    state = load_state(SYNC_STATE)
+    for ch in channels:
+        mid = parse_space_mid(ch)
+        if not mid:
+            cprint(f"[!] Not a channel URL or mid: {ch}", FG_YELLOW)
+            continue
+        mark = state.get(mid) or {}
+        pending = mark.get('pending') or []
+        new = []
+        try:
+            for bvid, created, title in iter_new_uploads(mid, mark, opener):
+                new.append((bvid, created))
+                if not mark_only:
+                    cprint(f"[+] {mid}: new upload {bvid} {title}", FG_GREEN)
+                    enqueue(bvid)
+        except Exception as e:
+            cprint(f"[!] Sync of {mid} stopped early: {e}", FG_RED)
+            # keep what we found, but don't move the watermark past a gap
+            mark = {**mark, 'pending': pending + [b for b, _ in new]}
+            state[mid] = mark
+            continue
+        if not mark_only:
+            for bvid in pending:
+                enqueue(bvid)
+        if new:
+            bvid, created = new[0]
+            mark = {'bvid': bvid, 'pubdate': created}
+        mark = {**mark, 'pending': [] if mark_only else pending + [b for b, _ in new], 'synced_at': int(time.time())}
+        state[mid] = mark
+        cprint(f"[i] {mid}: {len(new)} new, watermark {mark.get('bvid')}", FG_CYAN)
+        save_state(SYNC_STATE, state)
+        time.sleep(SYNC_PAGE_DELAY)
+    save_state(SYNC_STATE, state)
+    return state
+
+def run_sync(channels, storage: StorageManager, cookiefile: str | None, fmt: str, jobs: int,
+             mark_only: bool = False, race_mirrors: bool = False, transcode=None,
+             danmaku_fmt: str | None = None, subs_fmt: str | None = None):
+    opener = build_opener(cookiefile)
+    opened = []
+    report, summary = make_batch_reporter(transcode)
+    jq = JobQueue(with_text_tracks(make_download_fn(storage, cookiefile, fmt, opened, race_mirrors),
+                                   danmaku_fmt, subs_fmt, cookiefile), jobs, report)
+    try:
+        state = sync_channels(channels, jq.put, opener, mark_only)
+        results = jq.join()
+    finally:
+        for ydl in opened:
+            ydl.close()
+    # only successfully downloaded videos leave the pending lists
+    done = {vid for vid, _, err in results if not err}
+    for mark in state.values():
+        if mark.get('pending'):
+            mark['pending'] = [b for b in mark['pending'] if b not in done]
+    save_state(SYNC_STATE, state)
+    summary("Sync")
+
+# ----- Live room recording -----
+LIVE_SEGMENT = 30 * 60          # s per output file
+LIVE_OFFLINE_POLL = 30.0        # s between status checks while a room is offline
+LIVE_RECONNECT_MAX = 60.0
+LIVE_READ_TIMEOUT = 20.0
+LIVE_READ_CHUNK = 64 * 1024
+LIVE_WRITE_QUEUE = 256          # chunks buffered for the disk writer (~16 MB at most)
+LIVE_RATE_GUESS = 500 * 1024    # bytes/s assumed for a segment's reservation until one has been measured
+LIVE_HEADERS = {**CDN_HEADERS, 'Referer': 'https://live.bilibili.com/'}
+HLS_SEEN_MAX = 256
+
+def parse_live_room(text: str) -> str | None:
+    m = re.search(r'live\.bilibili\.com/(?:h5/|blanc/)?(\d+)', text)
+    if m:
+        return m.group(1)
+    return text.strip() if text.strip().isdigit() else None
+
+def live_room_info(room: str, opener=None) -> dict:
+    # short ids (e.g. 6) map to the real room_id; live_status 1 = streaming
+    return api_get('https://api.live.bilibili.com/room/v1/Room/room_init', {'id': room}, opener) or {}
+
+def live_stream_url(room_id: int, opener=None, prefer: str = 'flv'):
+    # -> (container, url): 'flv', 'ts' or 'fmp4'. Signed URLs: fetch anew per connection.
+    params = {'room_id': room_id, 'protocol': '0,1', 'format': '0,1,2', 'codec': '0,1',
+              'qn': 10000, 'platform': 'web', 'ptype': 8}
+    data = api_get('https://api.live.bilibili.com/xlive/web-room/v2/index/getRoomPlayInfo', params, opener) or {}
+    options = []
+    for st in ((data.get('playurl_info') or {}).get('playurl') or {}).get('stream') or []:
+        for fmt in st.get('format') or []:
+            for codec in fmt.get('codec') or []:
+                for info in codec.get('url_info') or []:
+                    options.append((fmt.get('format_name'), codec.get('codec_name'),
+                                    info.get('host', '') + codec.get('base_url', '') + info.get('extra', '')))
+    if not options:
+        raise ApiError(f"room {room_id} is live but returned no stream URLs")
+    wanted = ('flv',) if prefer == 'flv' else ('fmp4', 'ts')
+    # preferred container first, then AVC over HEVC (plays everywhere)
+    name, _, url = min(options, key=lambda o: (o[0] not in wanted, o[1] != 'avc'))
+    return name, url
+
+class SegmentWriter:
+    # Rotating segment files fed through a bounded queue: the network reader never
+    # waits on fsync-heavy disks for long, and a slow disk can't grow memory --
+    # the reader blocks once LIVE_WRITE_QUEUE chunks are pending. A disk error
+    # stops the writing (the thread keeps draining so the reader never hangs) and
+    # is raised to the reader from its next write/rotate/close.
+    def __init__(self, storage: StorageManager, name: str, ext: str, on_closed,
+                 segment: float = LIVE_SEGMENT, rate: float = LIVE_RATE_GUESS):
+        self.storage, self.name, self.ext, self.on_closed = storage, name, ext, on_closed
+        self.segment = segment
+        self.rate = rate    # bytes/s of the last finished segment; sizes the next reservation
+        self.error = None
+        self.q = queue.Queue(maxsize=LIVE_WRITE_QUEUE)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        if self.error:
+            raise self.error
+        self.q.put(item)
+
+    def rotate(self, header: bytes = b''):
+        self._put(('open', header))
+
+    def write(self, data: bytes):
+        self._put(('data', data))
+
+    def close(self):
+        self.q.put(('close', None))
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _new_path(self, root: str) -> str:
+        # quick reconnects can start two segments within one second
+        stem = f"{self.name}_{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        staging, n = self.storage.staging(root), 1
+        name = stem
+        while any(os.path.exists(os.path.join(d, f"{name}.{ext}"))
+                  for d in (staging, root) for ext in (self.ext, 'mp4')):
+            n += 1
+            name = f"{stem}_{n}"
+        return os.path.join(staging, f"{name}.{self.ext}")
+
+    def _run(self):
+        fh = path = root = None
+        placed = contextlib.ExitStack()
+        t0 = nbytes = 0
+        while True:
+            op, data = self.q.get()
+            if self.error:
+                if op == 'close':
+                    return
+                continue  # drain: the reader learns of the error on its next put
+            try:
+                if op in ('open', 'close') and fh:
+                    fh.close()
+                    placed.close()
+                    if nbytes and time.monotonic() - t0 > 1:
+                        self.rate = nbytes / (time.monotonic() - t0)
+                    self.on_closed(path, root)
+                    fh = None
+                if op == 'close':
+                    return
+                if op == 'open':
+                    try:
+                        root = placed.enter_context(self.storage.place(int(self.rate * self.segment)))
+                    except StorageFull as e:
+                        cprint(f"[!] {self.name}: {e}; dropping stream data until space frees up", FG_RED)
+                        continue
+                    path = self._new_path(root)
+                    fh = open(path, 'wb', buffering=WRITE_BUFFER)
+                    t0, nbytes = time.monotonic(), 0
+                    cprint(f"[i] Recording segment {os.path.basename(path)}", FG_CYAN)
+                if fh and data:
+                    fh.write(data)
+                    nbytes += len(data)
+            except Exception as e:
+                self.error = e
+                cprint(f"[!] {self.name}: writing {os.path.basename(path or '')} failed: {e}", FG_RED)
+                if fh:
+                    with contextlib.suppress(OSError):
+                        fh.close()
+                    placed.close()
+                    fh = None
+                if op == 'close':
+                    return
+
+class FlvSplitter:
+    # Cuts an FLV byte stream into self-contained files at video keyframes: each
+    # starts with the FLV header, onMetaData and the AVC/AAC sequence headers,
+    # with timestamps rebased to 0. Holds at most one partial tag in memory.
+    def __init__(self, writer: SegmentWriter, segment: float = LIVE_SEGMENT):
+        self.writer, self.segment_ms = writer, segment * 1000
+        self.buf = bytearray()
+        self.header = self.meta = self.avc = self.aac = None
+        self.base = None
+
+    def feed(self, data: bytes):
+        buf = self.buf
+        buf += data
+        pos = 0
+        if self.header is None:
+            if len(buf) < 13:
+                return
+            if buf[:3] != b'FLV':
+                raise ApiError("live stream is not FLV")
+            self.header, pos = bytes(buf[:13]), 13   # header + PreviousTagSize0
+        while len(buf) - pos >= 11:
+            total = 11 + int.from_bytes(buf[pos + 1:pos + 4], 'big') + 4
+            if len(buf) - pos < total:
+                break
+            self._tag(bytes(buf[pos:pos + total]))
+            pos += total
+        del buf[:pos]
+
+    @staticmethod
+    def _rebased(tag: bytes, ts: int) -> bytes:
+        ts = max(0, ts)
+        return tag[:4] + (ts & 0xFFFFFF).to_bytes(3, 'big') + bytes([ts >> 24 & 0xFF]) + tag[8:]
+
+    def _tag(self, tag: bytes):
+        kind = tag[0] & 0x1F
+        ts = int.from_bytes(tag[4:7], 'big') | tag[7] << 24
+        if kind == 18:
+            self.meta = tag
+            return
+        video_seq = kind == 9 and len(tag) > 16 and tag[11] & 0x0F in (7, 12) and tag[12] == 0
+        audio_seq = kind == 8 and len(tag) > 16 and tag[11] >> 4 == 10 and tag[12] == 0
+        if video_seq or audio_seq:
+            if video_seq:
+                self.avc = tag
+            else:
+                self.aac = tag
+            if self.base is not None:
+                self.writer.write(self._rebased(tag, ts - self.base))
+            return
+        if kind == 9 and tag[11] >> 4 == 1 and (self.base is None or ts - self.base >= self.segment_ms):
+            self.base = ts
+            heads = [self._rebased(t, 0) for t in (self.meta, self.avc, self.aac) if t]
+            self.writer.rotate(self.header + b''.join(heads))
+        if self.base is not None:   # nothing before the first keyframe
+            self.writer.write(self._rebased(tag, ts - self.base))
+
+def record_flv(url: str, writer: SegmentWriter, segment: float, stop: threading.Event) -> int:
+    splitter = FlvSplitter(writer, segment)
+    got = 0
+    with http_open(url, headers=LIVE_HEADERS, timeout=LIVE_READ_TIMEOUT) as resp:
+        while not stop.is_set():
+            data = resp.read(LIVE_READ_CHUNK)
+            if not data:
+                break
+            splitter.feed(data)
+            got += len(data)
+            METRICS.count('live_bytes', len(data))
+    return got
+
+def record_hls(url: str, writer: SegmentWriter, segment: float, stop: threading.Event) -> int:
+    # Poll the media playlist; new media segments are appended, and a new file
+    # (with the EXT-X-MAP init for fMP4) is started every `segment` seconds.
+    seen = collections.deque(maxlen=HLS_SEEN_MAX)
+    init, elapsed, got, idle_since = None, None, 0, time.time()
+    while not stop.is_set():
+        text = http_get(url, headers=LIVE_HEADERS, timeout=LIVE_READ_TIMEOUT).decode('utf-8', 'replace')
+        lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+        variants = [lines[i + 1] for i, ln in enumerate(lines[:-1]) if ln.startswith('#EXT-X-STREAM-INF')]
+        if variants:
+            url = urllib.parse.urljoin(url, variants[0])
+            continue
+        target, dur, fresh = 2.0, 0.0, 0
+        for ln in lines:
+            if ln.startswith('#EXT-X-TARGETDURATION:'):
+                target = float(ln.split(':', 1)[1])
+            elif ln.startswith('#EXT-X-MAP:') and init is None:
+                m = re.search(r'URI="([^"]+)"', ln)
+                if m:
+                    init = http_get(urllib.parse.urljoin(url, m.group(1)), headers=LIVE_HEADERS)
+            elif ln.startswith('#EXTINF:'):
+                dur = float(ln[8:].split(',', 1)[0] or 0)
+            elif not ln.startswith('#'):
+                key = ln.split('?', 1)[0]
+                if key in seen:
+                    continue
+                seen.append(key)
+                data = http_get(urllib.parse.urljoin(url, ln), headers=LIVE_HEADERS, timeout=LIVE_READ_TIMEOUT)
+                if elapsed is None or elapsed >= segment:
+                    writer.rotate(init or b'')
+                    elapsed = 0.0
+                writer.write(data)
+                elapsed += dur
+                got += len(data)
+                fresh += 1
+                METRICS.count('live_bytes', len(data))
+        if '#EXT-X-ENDLIST' in lines:
+            break
+        if fresh:
+            idle_since = time.time()
+        elif time.time() - idle_since > target * 3:
+            raise ApiError("HLS playlist stopped advancing")
+        stop.wait(max(1.0, target / 2))
+    return got
+
+@profiled('postprocess')
+def remux_segment(path: str, root: str, storage: StorageManager, ffmpeg_path: str | None):
+    # Runs on the background pool: raw .flv/.ts/.m4s -> .mp4 with -c copy, then
+    # out of staging. Without ffmpeg (or if it fails) the raw file is kept.
+    out = path
+    if ffmpeg_path and os.path.getsize(path):
+        mp4 = os.path.splitext(path)[0] + '.mp4'
+        proc = subprocess.run([ffmpeg_path, '-v', 'error', '-y', '-i', path, '-c', 'copy',
+                               '-movflags', '+faststart', mp4], capture_output=True)
+        if proc.returncode == 0:
+            os.remove(path)
+            out = mp4
+        else:
+            cprint(f"[!] Remux failed for {os.path.basename(path)}; keeping the raw file", FG_YELLOW)
+            with contextlib.suppress(OSError):
+                os.remove(mp4)
+    final = storage.commit(out, root)
+    METRICS.count('live_segments')
+    emit('segment', file=final, bytes=os.path.getsize(final))
+    cprint(f"[+] Segment done: {final} ({human_size(os.path.getsize(final))})", FG_GREEN)
+
+def record_live(room: str, storage: StorageManager, opener, stop: threading.Event, remux_pool,
+                segment: float = LIVE_SEGMENT, prefer: str = 'flv'):
+    # Follows one room until stopped: waits while offline, reconnects with
+    # backoff on errors or EOF, fetches fresh signed URLs every time.
+    ffmpeg_path = shutil.which('ffmpeg')
+    room_id = None   # short ids resolve to the real one on the first successful call
+    on_closed = lambda path, root: remux_pool.submit(remux_segment, path, root, storage, ffmpeg_path)
+    backoff, offline_noted, rate = 1.0, False, LIVE_RATE_GUESS
+    while not stop.is_set():
+        try:
+            if room_id is None:
+                room_id = live_room_info(room, opener).get('room_id') or room
+            if live_room_info(room_id, opener).get('live_status') != 1:
+                if not offline_noted:
+                    cprint(f"[i] Room {room_id} is offline; checking every {LIVE_OFFLINE_POLL:.0f}s", FG_CYAN)
+                    offline_noted = True
+                stop.wait(LIVE_OFFLINE_POLL)
+                continue
+            offline_noted = False
+            kind, url = live_stream_url(room_id, opener, prefer)
+            writer = SegmentWriter(storage, f"live_{room_id}", {'ts': 'ts', 'fmp4': 'm4s'}.get(kind, 'flv'), on_closed,
+                                   segment, rate)
+            try:
+                got = (record_flv if kind == 'flv' else record_hls)(url, writer, segment, stop)
+            finally:
+                try:
+                    writer.close()
+                finally:
+                    rate = writer.rate   # measured: sizes the next connection's reservations
+            if got > CHUNK_SIZE:
+                backoff = 1.0
+            err = None
+        except Exception as e:
+            err = e
+        if stop.is_set():
+            break
+        METRICS.count('live_reconnects')
+        cprint(f"[!] Room {room_id or room}: {'stream ended' if err is None else err}; reconnecting in {backoff:.0f}s",
+               FG_YELLOW)
+        stop.wait(backoff)
+        backoff = min(backoff * 2, LIVE_RECONNECT_MAX)
+
+def run_live(rooms, storage: StorageManager, cookiefile: str | None, segment: float = LIVE_SEGMENT,
+             prefer: str = 'flv'):
+    opener = build_opener(cookiefile)
+    stop = threading.Event()
+    remux_pool = ThreadPoolExecutor(max_workers=1)   # remuxing is I/O bound; one at a time
+    threads = []
+    for text in rooms:
+        room = parse_live_room(text)
+        if not room:
+            cprint(f"[!] Not a live room: {text}", FG_YELLOW)
+            continue
+        t = threading.Thread(target=record_live, args=(room, storage, opener, stop, remux_pool, segment, prefer),
+                             daemon=True)
+        t.start()
+        threads.append(t)
+    cprint(f"[i] Recording {len(threads)} room(s); Ctrl-C to stop", FG_CYAN)
+    try:
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(1.0)
+    except KeyboardInterrupt:
+        cprint("\n[i] Stopping; closing the current segments ...", FG_YELLOW)
+        stop.set()
+        for t in threads:
+            t.join()
+    remux_pool.shutdown(wait=True)
+
+# ----- Metadata cache -----
+META_TTL = 24 * 3600  # sizes and format lists are stable for a day; stream URLs are not
+LEAN_FORMAT_KEYS = (
+    'format_id', 'format_note', 'format', 'url', 'ext', 'protocol', 'vcodec', 'acodec', 'width', 'height',
+    'fps', 'tbr', 'quality', 'dynamic_range', 'filesize', 'filesize_approx', 'http_headers', 'fragments',
+)
+LEAN_INFO_KEYS = (
+    'id', 'title', 'duration', 'uploader', 'uploader_id', 'timestamp', 'thumbnail', 'webpage_url',
+    'extractor', 'extractor_key', 'http_headers',
+)
+
+def url_deadline(url: str) -> int | None:
+    # Bilibili signs CDN URLs with ?deadline=<unix time>
+    q = urllib.parse.parse_qs(urllib.parse.urlsplit(url or '').query)
+    d = (q.get('deadline') or [None])[0]
+    return int(d) if d and d.isdigit() else None
+
+def lean_info(info: dict) -> dict:
+    # Just what planning and a later download need, nothing nested beyond formats
+    lean = {k: info[k] for k in LEAN_INFO_KEYS if info.get(k) is not None}
+    lean['formats'] = [{k: f[k] for k in LEAN_FORMAT_KEYS if f.get(k) is not None}
+                       for f in info.get('formats') or [] if f.get('format_id')]
+    deadlines = [d for d in (url_deadline(f.get('url')) for f in lean['formats']) if d]
+    lean['_expires'] = min(deadlines) if deadlines else None
+    lean['_cached'] = int(time.time())
+    return lean
+
+def _meta_path(vid: str) -> Path:
+    d = state_dir() / 'meta'
+    d.mkdir(exist_ok=True)
+    return d / f"{vid}.json"
+
+@profiled('extract')
+def cached_extract(vid: str, cookiefile: str | None, opened: list, max_age: float = META_TTL) -> list:
+    # -> lean info per part (an anthology has several); disk cache first, while
+    # it is younger than max_age and its signed URLs haven't reached their deadline
+    path = _meta_path(vid)
+    try:
+        with open(path, encoding='utf-8') as fh:
+            entries = json.load(fh)
+        now = time.time()
+        if entries and now - entries[0].get('_cached', 0) < max_age \
+                and all(not e.get('_expires') or e['_expires'] - STREAM_URL_MARGIN > now for e in entries):
+            METRICS.count('meta_cache_hits')
+            return entries
+    except (OSError, ValueError):
+        pass
+    opts = {'quiet': True, 'no_warnings': True, 'skip_download': True}
+    if cookiefile:
+        opts['cookiefile'] = cookiefile
+    ydl = thread_ydl(opts, opened)
+    info = with_retry(lambda _s: ydl.extract_info(f"https://www.bilibili.com/video/{vid}", download=False), 'api')
+    entries = []
+    for e in [e for e in info.get('entries') or [info] if e]:
+        fill_format_sizes(e.get('formats') or [], e.get('id'))
+        entries.append(lean_info(e))
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        json.dump(entries, fh, ensure_ascii=False)
+    os.replace(tmp, path)
+    return entries
+
+# ----- Job records (lean per-video state for queued jobs) -----
+# A queued job keeps only what scheduling and the download need; the info dict
+# it came from (dozens of formats with headers and fragments) is dropped as soon
+# as the record exists, so memory stays flat however long the collection is.
+STREAM_REF_KEYS = ('format_id', 'url', 'ext', 'protocol', 'vcodec', 'acodec', 'width', 'height', 'fps', 'tbr',
+                   'filesize', 'filesize_approx')
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class StreamRef:
+    # One chosen format: enough for yt-dlp to download it without re-extracting
+    format_id: str
+    url: str
+    ext: str | None = None
+    protocol: str | None = None
+    vcodec: str | None = None
+    acodec: str | None = None
+    width: int | None = None
+    height: int | None = None
+    fps: float | None = None
+    tbr: float | None = None
+    filesize: int | None = None
+    filesize_approx: int | None = None
+
+    @classmethod
+    def from_format(cls, f: dict) -> StreamRef:
+        return cls(**{k: f.get(k) for k in STREAM_REF_KEYS})
+
+    def to_format(self, headers: dict | None) -> dict:
+        f = {k: getattr(self, k) for k in STREAM_REF_KEYS if getattr(self, k) is not None}
+        if headers:
+            f['http_headers'] = headers
+        return f
+
+@dataclasses.dataclass(slots=True)
+class JobRecord:
+    vid: str
+    id: str | None = None           # yt-dlp's id for this part (anthologies: BV..._p2)
+    title: str | None = None
+    duration: float | None = None
+    format: str = ''                # chosen format ids, "video+audio"
+    bytes: int = 0
+    quality: str | None = None
+    egress: str | None = None
+    expires: int | None = None      # earliest ?deadline= of the stream URLs
+    webpage_url: str | None = None
+    extractor_key: str | None = None
+    headers: dict | None = None     # shared by all of a video's formats
+    streams: tuple = ()
+
+    @classmethod
+    def from_info(cls, vid: str, info: dict, pick: dict, quality: str | None = None,
+                  egress: str | None = None) -> JobRecord:
+        # info: a (lean) single-video info dict; pick: select_for_plan's choice
+        wanted = pick['format'].split('+')
+        by_id = {f['format_id']: f for f in info.get('formats') or [] if f['format_id'] in wanted}
+        streams = tuple(StreamRef.from_format(by_id[fid]) for fid in wanted if fid in by_id)
+        deadlines = [d for d in (url_deadline(s.url) for s in streams) if d]
+        headers = next((f['http_headers'] for f in by_id.values() if f.get('http_headers')), None)
+        return cls(vid, info.get('id'), info.get('title'), info.get('duration'), pick['format'], pick['bytes'],
+                   quality, egress, min(deadlines) if deadlines else info.get('_expires'),
+                   info.get('webpage_url'), info.get('extractor_key'), headers, streams)
+
+    @classmethod
+    def from_plan_item(cls, item: dict, quality: str | None = None) -> JobRecord:
+        info = item.get('info') or {}
+        return cls.from_info(item['vid'], info, item, item.get('quality') or quality, item.get('egress'))
+
+    def ie_result(self) -> dict:
+        # Single-video ie_result for process_ie_result (signed URLs, so only while fresh)
+        res = {'id': self.id or self.vid, 'title': self.title, 'duration': self.duration,
+               'webpage_url': self.webpage_url, 'extractor_key': self.extractor_key,
+               'extractor': self.extractor_key,
+               'formats': [s.to_format(self.headers) for s in self.streams]}
+        return {k: v for k, v in res.items() if v is not None}
+
+# ----- Signed stream URL reuse -----
+# Playurl/format URLs carry ?deadline=<unix time>. A job keeps its extraction
+# result until then: retries and resumed runs go straight to the CDN, and only a
+# 403 or a passed deadline sends it back through extract_info.
+STREAM_URL_MARGIN = 120     # s before the deadline at which a URL counts as expired
+
+class StreamUrlCache:
+    # vid -> single-video ie_result; in memory while its job runs, on disk (lean)
+    # so a restarted run can resume its .part files without re-extracting.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mem = {}
+
+    @staticmethod
+    def _path(vid: str) -> Path:
+        d = state_dir() / 'streams'
+        d.mkdir(exist_ok=True)
+        return d / f"{vid}.json"
+
+    def get(self, vid: str) -> dict | None:
+        with self.lock:
+            hit = self.mem.get(vid)
+        if hit is None:
+            try:
+                with open(self._path(vid), encoding='utf-8') as fh:
+                    info = json.load(fh)
+                hit = (info.pop('_expires', None), info)
+                info.pop('_cached', None)
+            except (OSError, ValueError):
+                return None
+        expires, info = hit
+        if not expires or expires - STREAM_URL_MARGIN < time.time():
+            self.drop(vid)
+            return None
+        METRICS.count('stream_url_reused')
+        return copy.deepcopy(info)  # yt-dlp annotates the dict it processes
+
+    def put(self, vid: str, info: dict):
+        # anthologies resolve their parts lazily: nothing signed to keep yet
+        if info.get('_type', 'video') != 'video':
+            return
+        deadlines = [d for d in (url_deadline(f.get('url')) for f in info.get('formats') or []) if d]
+        if not deadlines:
+            return
+        with self.lock:
+            self.mem[vid] = (min(deadlines), copy.deepcopy(info))
+        path = self._path(vid)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(lean_info(info), fh, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def drop(self, vid: str):
+        with self.lock:
+            self.mem.pop(vid, None)
+        with contextlib.suppress(OSError):
+            os.remove(self._path(vid))
+
+STREAM_URLS = StreamUrlCache()
+
+def is_url_expired_error(e: BaseException) -> bool:
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 403
+    return bool(re.search(r'HTTP Error 403|403: Forbidden', str(e)))
+
+def is_transient_error(e: BaseException) -> bool:
+    # worth another go with the same URLs
+    if isinstance(e, (TimeoutError, ConnectionError, http.client.IncompleteRead)):
+        return True
+    return bool(re.search(r'timed out|Connection (reset|aborted|refused)|IncompleteRead|Remote end closed'
+                          r'|HTTP Error 5\d\d|Temporary failure|EOF occurred', str(e)))
+
+# ----- Batch dry-run planner -----
+QUALITY_POLICIES = {
+    'best': BEST_FORMAT,
+    '1080p': 'bestvideo[height<=1080]+bestaudio/best[height<=1080]',
+    '720p': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
+    '480p': 'bestvideo[height<=480]+bestaudio/best[height<=480]',
+    'audio': AUDIO_FORMAT,
+}
+THROUGHPUT_STATE = 'throughput.json'
+PLAN_DISK_MARGIN = 1.05  # merge temp files and filesystem overhead
+
+def record_throughput(nbytes: int, seconds: float):
+    # Rolling (EWMA) aggregate batch throughput, used by the planner's estimates
+    if nbytes < 1024 * 1024 or seconds < 5:
+        return
+    st = load_state(THROUGHPUT_STATE)
+    rate = nbytes / seconds
+    st['ewma'] = rate if not st.get('ewma') else 0.7 * st['ewma'] + 0.3 * rate
+    st['samples'] = st.get('samples', 0) + 1
+    st['updated'] = int(time.time())
+    save_state(THROUGHPUT_STATE, st)
+
+def historical_throughput() -> float | None:
+    # batch EWMA, scaled by how the CDN usually does at this hour of day
+    ewma = load_state(THROUGHPUT_STATE).get('ewma')
+    return ewma * CDN_STATS.hour_factor(datetime.datetime.now().hour) if ewma else None
+
+def select_for_plan(ydl, info: dict, spec: str) -> dict | None:
+    # Run yt-dlp's own selector over the cached formats: same choice as a real run
+    formats = info.get('formats') or []
+    if not formats:
+        return None
+    chosen = next(iter(ydl.build_format_selector(spec)({
+        'formats': formats,
+        'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+        'incomplete_formats': (all(f.get('vcodec') == 'none' for f in formats)
+                               or all(f.get('acodec') == 'none' for f in formats)),
+    })), None)
+    if not chosen:
+        return None
+    parts = chosen.get('requested_formats') or [chosen]
+    duration = info.get('duration') or 0
+    size = sum(f.get('filesize') or f.get('filesize_approx') or (f.get('tbr') or 0) * 125 * duration for f in parts)
+    return {
+        'format': '+'.join(f['format_id'] for f in parts),
+        'bytes': int(size),
+        'exact': all(f.get('filesize') for f in parts),
+    }
+
+def fmt_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m{seconds % 60:02d}s"
+
+def build_plan(specs, storage: StorageManager, cookiefile: str | None, quality: str = 'best', jobs: int = 4) -> dict:
+    opened = []
+    pairs = ((v, meta) for url, meta in specs for v in iter_video_ids(url, cookiefile))
+
+    def work(pair):
+        vid, meta = pair
+        try:
+            with EGRESS.lease() as lease:
+                if lease.egress:
+                    meta = {**meta, 'egress': lease.egress.name}  # run_plan pins the download to it
+                return vid, meta, cached_extract(vid, cookiefile, opened), None
+        except Exception as e:
+            return vid, meta, None, e
+
+    items, failed = [], []
+    totals = {name: {'bytes': 0, 'exact': True, 'missing': 0} for name in QUALITY_POLICIES}
+    selector_ydl = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True})
+    try:
+        for vid, meta, entries, err in bounded_map(work, pairs, jobs):
+            if err:
+                failed.append({'vid': vid, 'error': str(err)})
+                cprint(f"[!] {vid}: {err}", FG_RED)
+                continue
+            for info in entries:
+                picks = {name: select_for_plan(selector_ydl, info, spec) for name, spec in QUALITY_POLICIES.items()}
+                for name, pick in picks.items():
+                    if pick:
+                        totals[name]['bytes'] += pick['bytes']
+                        totals[name]['exact'] &= pick['exact']
+                    else:
+                        totals[name]['missing'] += 1
+                pick = picks[quality]
+                if not pick:
+                    failed.append({'vid': vid, 'error': f"no format matches policy {quality}"})
+                    continue
+                # keep only the chosen formats so the plan file stays small
+                wanted = set(pick['format'].split('+'))
+                info = {**info, 'formats': [f for f in info['formats'] if f['format_id'] in wanted]}
+                items.append({'vid': vid, 'title': info.get('title'), 'duration': info.get('duration'),
+                              'format': pick['format'], 'bytes': pick['bytes'], **meta, 'info': info})
+    finally:
+        selector_ydl.close()
+        for ydl in opened:
+            ydl.close()
+    rate = historical_throughput()
+    free = storage.total_free()
+    for t in totals.values():
+        t['seconds'] = round(t['bytes'] / rate) if rate else None
+        t['fits'] = t['bytes'] * PLAN_DISK_MARGIN <= free
+    return {
+        'version': 1,
+        'created': int(time.time()),
+        'download_dir': storage.roots[0],
+        'roots': storage.roots,
+        'quality': quality,
+        'policy': QUALITY_POLICIES[quality],
+        'throughput': rate,
+        'disk_free': free,
+        'totals': totals,
+        'items': items,
+        'failed': failed,
+    }
+
+def print_plan(plan: dict):
+    cprint(f"\n[i] Plan: {len(plan['items'])} video(s), {len(plan['failed'])} failed to extract", FG_CYAN)
+    cprint(f"[i] Target: {', '.join(plan.get('roots') or [plan['download_dir']])} "
+           f"({human_size(plan['disk_free'])} free)", FG_CYAN)
+    cprint(f"{'policy':>8} {'total':>10} {'est. time':>11} {'fits':>5}", FG_MAGENTA)
+    for name, t in plan['totals'].items():
+        est = fmt_duration(t['seconds']) if t['seconds'] is not None else 'N/A'
+        size = human_size(t['bytes']) + ('' if t['exact'] else '~')
+        mark = '*' if name == plan['quality'] else ' '
+        color = FG_GREEN if t['fits'] else FG_RED
+        cprint(f"{mark}{name:>7} {size:>10} {est:>11} {'yes' if t['fits'] else 'NO':>5}", color)
+    if plan['throughput'] is None:
+        cprint("[i] No throughput history yet; time estimates appear after the first batch run.", FG_YELLOW)
+
+def plan_download_fn(storage: StorageManager, cookiefile: str | None, opened: list):
+    # Job records carry their chosen formats; reuse them while the signed URLs live,
+    # otherwise extract again but keep the planned format ids.
+    ffmpeg_path = shutil.which('ffmpeg')
+    def download(rec: JobRecord):
+        spec = f"{rec.format}/{QUALITY_POLICIES.get(rec.quality or 'best', BEST_FORMAT)}"
+        opts = batch_ydl_opts(storage.roots[0], cookiefile, spec, audio_only=rec.quality == 'audio')
+        fresh = rec.expires and rec.expires > time.time() + 300
+        return download_vid(rec.vid, opts, opened, ffmpeg_path, ie_result=rec.ie_result() if fresh else None,
+                            storage=storage, expected=rec.bytes or None)
+    return download
+
+def run_plan(plan_path: str, storage: StorageManager | None, cookiefile: str | None, jobs: int = 4,
+             order: str = 'fifo', aging: float | None = None, transcode=None,
+             danmaku_fmt: str | None = None, subs_fmt: str | None = None):
+    with open(plan_path, encoding='utf-8') as fh:
+        plan = json.load(fh)
+    # the plan's own roots unless --output-root overrides them
+    storage = storage or StorageManager(plan.get('roots') or [plan['download_dir']], stage_dir=STAGE_DIR)
+    need = sum(item['bytes'] for item in plan['items'])
+    if need * PLAN_DISK_MARGIN > storage.total_free():
+        cprint(f"[!] Plan needs {human_size(need)} but {', '.join(storage.roots)} no longer has room.", FG_RED)
+        return
+    opened = []
+    report, summary = make_batch_reporter(transcode)
+    jq = JobQueue(with_text_tracks(plan_download_fn(storage, cookiefile, opened), danmaku_fmt, subs_fmt, cookiefile),
+                  jobs, lambda rec, files, err: report(rec.vid, files, err), order, aging)
+    try:
+        # popped one by one so each plan dict is freed once its record is queued
+        items = plan.pop('items')[::-1]
+        while items:
+            item = items.pop()
+            jq.put(JobRecord.from_plan_item(item, plan.get('quality')), item['bytes'],
+                   item.get('priority', 0), item.get('deadline'))
+        jq.join()
+    finally:
+        for ydl in opened:
+            ydl.close()
+    summary("Plan")
+
+# ----- Main flow -----
+def section_arg(text: str):
+    try:
+        return parse_section(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def egress_arg(text: str):
+    # "SPEC[,limit=N]"
+    spec, _, opt = text.partition(',')
+    try:
+        limit = int(opt.removeprefix('limit=')) if opt else EGRESS_LIMIT
+        return Egress(spec.strip(), limit)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e) if 'egress' in str(e) else f"bad egress limit '{opt}'")
+
+def variants_arg(text: str):
+    names = list(dict.fromkeys(q.strip() for q in text.split(',') if q.strip()))
+    bad = [q for q in names if q not in QUALITY_POLICIES or q == 'audio']
+    if bad or not names:
+        raise argparse.ArgumentTypeError(f"unknown quality {', '.join(bad) or text!r} "
+                                         f"(choose from {', '.join(q for q in QUALITY_POLICIES if q != 'audio')})")
+    return names
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="BiliBili Video Downloader (yt-dlp based)")
+    ap.add_argument('urls', nargs='*', help="video / playlist URLs (prompted for if omitted)")
+    ap.add_argument('--danmaku', choices=('ass', 'srt'), help="also save danmaku (bullet comments) in this format")
+    ap.add_argument('--subs', choices=('srt', 'ass'), help="also save uploaded/AI subtitles in this format")
+    ap.add_argument('--text-only', action='store_true', help="only fetch danmaku/subtitles, skip the video download")
+    ap.add_argument('--audio', action='store_true', help="audio-only batch: DASH audio track as-is, never video")
+    ap.add_argument('--sync', action='store_true',
+                    help="treat arguments as channels (space URL or mid) and download uploads newer than the last sync")
+    ap.add_argument('--sync-mark-only', action='store_true',
+                    help="with --sync: just record the current watermark, download nothing")
+    ap.add_argument('-y', '--batch', action='store_true',
+                    help="non-interactive: no prompts, best quality for every URL; plain URLs need it "
+                         "for the batch-mode flags below (--json, --transcode, --embed, ...)")
+    ap.add_argument('--race-mirrors', action='store_true',
+                    help="batch modes: race the playurl backup_url CDN mirrors and switch when one slows down")
+    ap.add_argument('--no-adaptive', action='store_true',
+                    help="batch modes: run exactly --jobs at once instead of AIMD-adjusting concurrency")
+    ap.add_argument('--metrics', metavar='FILE', help="write run metrics (counters, controller decisions) as JSON")
+    ap.add_argument('-q', '--quality', choices=('best', '1080p', '720p', '480p', 'audio'),
+                    help="format policy for batch modes and plans (default best; audio with --audio)")
+    ap.add_argument('--plan', metavar='FILE',
+                    help="dry run: extract the batch, estimate bytes/time/disk per policy, write a plan file")
+    ap.add_argument('--from-plan', metavar='FILE', help="download exactly what a --plan file lists")
+    ap.add_argument('--order', choices=('fifo', 'size', 'priority', 'deadline'), default='fifo',
+                    help="batch job order: input order, smallest first, priority=N, or deadline=... (with aging)")
+    ap.add_argument('--aging', type=float, metavar='RATE',
+                    help="score credit per second waited (bytes/s for size order; default 4MB/s, 1 for priority)")
+    ap.add_argument('--live', action='append', metavar='ROOM',
+                    help="record a live room (id or live.bilibili.com URL) until Ctrl-C; repeat for several rooms")
+    ap.add_argument('--segment-minutes', type=float, default=LIVE_SEGMENT / 60,
+                    help="with --live: start a new file every N minutes (default 30)")
+    ap.add_argument('--live-format', choices=('flv', 'hls'), default='flv',
+                    help="with --live: preferred stream protocol (default flv)")
+    ap.add_argument('--variants', type=variants_arg, metavar='Q1,Q2',
+                    help="batch modes: keep several qualities per video (e.g. 1080p,480p): audio fetched once, shared by all")
+    ap.add_argument('--section', action='append', type=section_arg, metavar='START-END',
+                    help="batch modes, clip mode: fetch only this time range (e.g. 12:30-14:00); repeat for more clips")
+    ap.add_argument('-i', '--input', action='append', metavar='FILE',
+                    help="read URLs (or NDJSON objects) from FILE, '-' for stdin; streamed and de-duplicated")
+    ap.add_argument('--watch', metavar='DIR',
+                    help="keep reading URL list files dropped into DIR (moved to DIR/done once queued)")
+    ap.add_argument('-o', '--output-root', action='append', metavar='DIR',
+                    help="output directory; repeat to spread batch jobs over several roots by free space")
+    ap.add_argument('--stage-dir', metavar='DIR|auto',
+                    help="keep partial files and merges on DIR (e.g. app-private storage or tmpfs; 'auto' picks one) "
+                         "and copy each finished file to the output once")
+    ap.add_argument('--write-buffer', type=size_arg, metavar='SIZE',
+                    help=f"bytes per disk write, e.g. 1M (default {WRITE_BUFFER // (1024 * 1024)}M)")
+    ap.add_argument('--egress', action='append', type=egress_arg, metavar='SPEC[,limit=N]',
+                    help="batch modes: spread jobs over proxies (http://, socks5://host:port) or local source "
+                         "addresses; repeat per egress, each job stays on one (default limit 2 jobs each)")
+    ap.add_argument('-j', '--jobs', type=int, help="parallel jobs for batch work (default 4, 16 for --audio)")
+    ap.add_argument('--transcode', action='append', metavar='PROFILE',
+                    help="batch modes: after download, re-encode with this profile (built-in: tablet); repeatable")
+    ap.add_argument('--transcode-config', metavar='FILE',
+                    help=f"JSON transcode profiles (default ~/.config/bili_bili/{TRANSCODE_CONFIG})")
+    ap.add_argument('--transcode-workers', type=int, metavar='N',
+                    help="parallel encodes (default: CPU cores / ffmpeg threads per profile)")
+    ap.add_argument('--embed', action='store_true',
+                    help="batch modes: write title, uploader, date, cover and chapters into each file "
+                         "(in place for MP4; mutagen or ffmpeg otherwise)")
+    ap.add_argument('--json', action='store_true',
+                    help="batch modes: JSON-lines events (job states, progress ticks) on stdout; text goes to stderr")
+    ap.add_argument('--profile', metavar='DIR',
+                    help="profile extraction/download/post-processing phases; writes pstats + summary.txt to DIR")
+    ap.add_argument('--cdn-stats', action='store_true',
+                    help="show recorded per-CDN-host throughput and error rates, then exit")
+    ap.add_argument('--bench-danmaku', type=int, metavar='N', help="benchmark XML->ASS on N synthetic danmaku and exit")
+    ap.add_argument('--bench-write', nargs='?', const='', metavar='DIR',
+                    help="compare small, coalesced and staged writes on DIR (default: the download directory) and exit")
+    args = ap.parse_args(argv)
+    if (args.danmaku or args.subs) and (args.plan or args.live):
+        # a plan only lists videos and a live recording has no tracks yet: pass them to --from-plan instead
+        ap.error("--danmaku/--subs don't apply to --plan or --live")
+    return args
+
+BATCH_ONLY_FLAGS = (('--json', 'json'), ('--transcode', 'transcode'), ('--embed', 'embed'),
+                    ('--egress', 'egress'), ('--section', 'section'), ('--variants', 'variants'))
+
+def main():
+    global PROFILER, EVENTS, EGRESS, EMBED, WRITE_BUFFER, STAGE_DIR
+    args = parse_args()
+    # -y/--batch and the batch sources choose the unattended path; the flags in
+    # BATCH_ONLY_FLAGS only shape a batch run and never switch one on by themselves
+    unattended = (args.batch or args.sync or args.audio or args.text_only or args.plan or args.from_plan
+                  or args.input or args.watch or args.live)
+    if not unattended:
+        ignored = [flag for flag, dest in BATCH_ONLY_FLAGS if getattr(args, dest)]
+        if ignored:
+            cprint(f"[!] {', '.join(ignored)} only apply to batch runs (-y/--batch, --input, --watch, "
+                   f"--sync, plans); ignored for this interactive run.", FG_YELLOW)
+    if args.write_buffer:
+        WRITE_BUFFER = args.write_buffer
+    if args.profile:
+        PROFILER = PhaseProfiler(args.profile)
+    if args.json and unattended:
+        EVENTS = EventWriter(sys.stdout)
+    cprint("=== BiliBili Video Downloader ===", FG_CYAN)
+    if args.bench_danmaku:
+        bench_danmaku(args.bench_danmaku)
+        return
+    if args.bench_write is not None:
+        bench_write(args.bench_write or (args.output_root[0] if args.output_root else None))
+        return
+    if args.cdn_stats:
+        CDN_STATS.report()
+        return
+    # Optional command-line URL(s)
+    if args.urls or args.from_plan or args.input or args.watch or args.live:
+        urls = args.urls
+    else:
+        # interactive single or multiple
+        mode = input(f"{FG_YELLOW}Paste multiple URLs? (y/N): {RESET}").strip().lower()
+        if mode == 'y':
+            cprint("Paste URLs one per line. Enter an empty line to finish:", FG_BLUE)
+            lines = []
+            while True:
+                ln = input("> ").strip()
+                if not ln:
+                    break
+                lines.append(ln)
+            urls = lines
+        else:
+            u = prompt_with_default("Enter BiliBili video URL", "")
+            if not u:
+                cprint("[!] No URL provided. Exiting.", FG_RED)
+                return
+            urls = [u]
+
+    download_dir = args.output_root[0] if args.output_root else choose_download_dir()
+    cprint(f"[i] Download directory: {', '.join(args.output_root or [download_dir])}", FG_CYAN)
+    STAGE_DIR = resolve_stage_dir(args.stage_dir, download_dir)
+
+    # Cookie auto-detect
+    cookiefile = auto_detect_cookiefile()
+    if unattended:
+        pass  # batch runs use whatever was detected without asking
+    elif cookiefile:
+        use_cookie = input(f"{FG_YELLOW}Use this cookiefile? (Y/n): {RESET}").strip().lower()
+        if use_cookie == 'n':
+            cookiefile = None
+    else:
+        manual = input(f"{FG_YELLOW}No cookiefile auto-detected. Do you want to provide a cookies.txt path? (y/N): {RESET}").strip().lower()
+        if manual == 'y':
+            path_in = input("Enter path to cookies.txt: ").strip()
+            path_in = os.path.expanduser(path_in)
+            if os.path.isfile(path_in):
+                cookiefile = path_in
+                cprint(f"[+] Using cookiefile: {cookiefile}", FG_CYAN)
+            else:
+                cprint("[!] Cookie file not found; continuing without cookies.", FG_YELLOW)
+                cookiefile = None
+
+    if unattended:
+        jobs = args.jobs or (16 if args.audio else 4)
+        storage = StorageManager(args.output_root or [download_dir], stage_dir=STAGE_DIR)
+        if args.egress:
+            EGRESS = EgressPool(args.egress)
+            EGRESS.start()
+        configure_controllers(jobs, adaptive=not args.no_adaptive)
+        quality = args.quality or ('audio' if args.audio else 'best')
+        fmt = QUALITY_POLICIES[quality]
+        transcode = None
+        if args.transcode:
+            try:
+                transcode = TranscodeStage(args.transcode, load_transcode_profiles(args.transcode_config),
+                                           args.transcode_workers)
+            except ValueError as e:
+                cprint(f"[!] {e}", FG_RED)
+                return
+        if args.embed:
+            # tags first; the tagged file then goes on to any transcodes
+            transcode = EMBED = EmbedStage(transcode, cookiefile)
+        try:
+            lines = itertools.chain(urls, *(iter_source_lines(src) for src in args.input or ()))
+            if args.watch:
+                lines = itertools.chain(lines, iter_inbox(args.watch))
+            specs = ingest_specs(lines, resolver=ShortLinkResolver())
+            urls = (u for u, _ in specs)
+            if args.plan:
+                plan = build_plan(specs, storage, cookiefile, quality, jobs)
+                with open(args.plan, 'w', encoding='utf-8') as fh:
+                    json.dump(plan, fh, ensure_ascii=False, indent=1)
+                print_plan(plan)
+                cprint(f"[+] Plan written to {args.plan} (run it with --from-plan)", FG_GREEN)
+            elif args.from_plan:
+                run_plan(args.from_plan, storage if args.output_root else None, cookiefile, jobs,
+                         args.order, args.aging, transcode, args.danmaku, args.subs)
+            elif args.live:
+                run_live(args.live, storage, cookiefile, args.segment_minutes * 60, args.live_format)
+            elif args.text_only:
+                if not (args.danmaku or args.subs):
+                    args.danmaku, args.subs = 'ass', 'srt'
+                fetch_text_tracks_batch(urls, download_dir, args.danmaku, args.subs, cookiefile, jobs)
+            elif args.sync:
+                run_sync(urls, storage, cookiefile, fmt, jobs, args.sync_mark_only, args.race_mirrors, transcode,
+                         args.danmaku, args.subs)
+            else:
+                run_batch(specs, storage, cookiefile, fmt, jobs, args.race_mirrors,
+                          "Clips" if args.section else "Variants" if args.variants
+                          else "Audio" if fmt == AUDIO_FORMAT else "Batch",
+                          args.order, args.aging, quality, args.section, transcode, args.variants,
+                          args.danmaku, args.subs)
+        finally:
+            EGRESS.stop()
+            close_size_probes()
+            if args.metrics:
+                METRICS.write(args.metrics)
+            if PROFILER:
+                PROFILER.write()
+            CDN_STATS.flush()
+            if EVENTS:
+                EVENTS.close()
+        cprint("\n=== All tasks complete ===", FG_CYAN)
+        return
+
+    # Detect aria2c and ffmpeg
+    aria2_path = shutil.which('aria2c')
+    ffmpeg_path = shutil.which('ffmpeg')
+    if aria2_path:
+        cprint(f"[i] aria2c found at: {aria2_path}", FG_CYAN)
+        use_aria2 = input(f"{FG_YELLOW}Use aria2c for segmented downloads? (y/N): {RESET}").strip().lower() == 'y'
+    else:
+        use_aria2 = False
+    if not ffmpeg_path:
+        cprint("[!] ffmpeg not found — merges or re-muxing may fail for separate streams. Install with: pip install ffmpeg", FG_YELLOW)
+
+    # Offer yt-dlp auto-update
+    try_update = input(f"{FG_YELLOW}Check for yt-dlp updates before downloading? (y/N): {RESET}").strip().lower() == 'y'
+    if try_update:
+        cprint("[i] Attempting to update yt-dlp via pip ...", FG_CYAN)
+        try:
+            subprocess.run([sys.executable, "-m", "pip", "install", "-U", "yt-dlp[default]"], check=False)
+            cprint("[i] Update attempt finished. Continuing...", FG_CYAN)
+        except Exception:
+            cprint("[!] Could not auto-update yt-dlp. Please update manually if needed.", FG_YELLOW)
+
+    # Loop through urls
+    for url in urls:
+        url = url.strip()
+        if not url:
+            continue
+        cprint(f"\n=== Processing: {url} ===", FG_MAGENTA)
+        # Extract info (no download)
+        ydl_opts_info = {
+            'skip_download': True,
+            'quiet': True,
+            'no_warnings': True,
+            # get manifests and formats
+            'allow_unplayable_formats': False,
+        }
+        if cookiefile:
+            ydl_opts_info['cookiefile'] = cookiefile
+
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts_info) as ydl:
+                with profile_phase('extract'):
+                    info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            cprint("[!] Error extracting video info: " + str(e), FG_RED)
+            cprint("    Make sure the URL is valid and yt-dlp is updated.", FG_YELLOW)
+            continue
+
+        # handle playlist: choose first entry and inform user
+        if 'entries' in info and info['entries']:
+            cprint("[!] URL is a playlist — selecting first entry by default.", FG_YELLOW)
+            info = info['entries'][0] or {}
+
+        title = safe_filename(info.get('title') or "video")
+        
+        # FIXED: Handle duration properly - ensure it's an integer before formatting
+        duration = info.get('duration', 0)
+        cprint(f"[i] Title: {title}", FG_CYAN)
+        
+        if duration:
+            try:
+                # Convert to integer to avoid float formatting issues
+                total_seconds = int(float(duration))
+                minutes = total_seconds // 60
+                seconds = total_seconds % 60
+                cprint(f"[i] Duration: {minutes}:{seconds:02d}", FG_CYAN)
+            except (ValueError, TypeError):
+                # Fallback if conversion fails
+                cprint(f"[i] Duration: {duration} seconds", FG_CYAN)
+
+        formats = info.get('formats') or []
+        if not formats:
+            cprint("[!] No formats found. Try cookies or update yt-dlp.", FG_RED)
+            continue
+
+        # Show a condensed format list and allow selection
+        print_format_list(formats, info.get('id'))
+
+        # Ask download type (enhanced interactivity)
+        cprint("\nDownload type options:", FG_BLUE)
+        cprint("  0 = Automatic BEST (bestvideo+bestaudio/best)", FG_BLUE)
+        cprint("  1 = Best (video+audio)", FG_BLUE)
+        cprint("  2 = Audio only (DASH audio track, no video)", FG_BLUE)
+        cprint("  3 = Video only (bestvideo)", FG_BLUE)
+
+        # allow multiple attempts for a valid selection
+        attempts = 0
+        selected_fmt = None
+        while attempts < 3:
+            sel = input(f"{FG_YELLOW}Enter index number shown above to pick a specific format, or 0 for automatic BEST (press Enter for 0): {RESET}").strip()
+            if sel == '' or sel == '0':
+                # ask for download type refinement
+                dtype = input(f"{FG_YELLOW}Which download type? (0=auto,1=best,2=audio-only,3=video-only) [0]: {RESET}").strip() or '0'
+                if dtype == '2':
+                    selected_fmt = AUDIO_FORMAT
+                elif dtype == '3':
+                    selected_fmt = 'bestvideo'
+                else:
+                    selected_fmt = 'bestvideo+bestaudio/best'
+                break
+            # try interpret as index
+            try:
+                idx = int(sel)
+                if idx < 0:
+                    raise ValueError
+                if idx == 0:
+                    selected_fmt = 'bestvideo+bestaudio/best'
+                    break
+                # map to sorted list
+                sorted_f = sorted(formats, key=lambda x: (x.get('height') or 0, x.get('filesize') or 0), reverse=True)
+                if 1 <= idx <= len(sorted_f):
+                    chosen = sorted_f[idx-1]
+                    fid = chosen.get('format_id')
+                    if not fid:
+                        cprint("[!] Selected entry has no format id; choose another or use 0 for best.", FG_YELLOW)
+                        attempts += 1
+                        continue
+                    selected_fmt = fid
+                    cprint(f"[i] Selected format id: {selected_fmt}", FG_CYAN)
+                    break
+                else:
+                    cprint("[!] Index out of shown range, try again.", FG_YELLOW)
+            except ValueError:
+                cprint("[!] Invalid input; enter a number from the list or 0.", FG_YELLOW)
+            attempts += 1
+
+        if not selected_fmt:
+            cprint("[!] No valid format selected after multiple tries — defaulting to best.", FG_YELLOW)
+            selected_fmt = 'bestvideo+bestaudio/best'
+
+        # Preflight: make sure the pick fits before committing to a long download
+        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+            pick = select_for_plan(ydl, info, selected_fmt)
+        free = shutil.disk_usage(download_dir).free
+        need = (pick['bytes'] if pick else STORAGE_UNKNOWN_BYTES) * STORAGE_MARGIN
+        staging = STAGE_DIR if STAGE_DIR and shutil.disk_usage(STAGE_DIR).free >= need \
+            else os.path.join(download_dir, STAGING_DIRNAME)
+        if pick and pick['bytes'] * STORAGE_MARGIN > free:
+            cprint(f"[!] Needs about {human_size(pick['bytes'])} but only {human_size(free)} is free in {download_dir}.", FG_RED)
+            if input(f"{FG_YELLOW}Download anyway? (y/N): {RESET}").strip().lower() != 'y':
+                continue
+
+        # Build yt-dlp options for download
+        ydl_opts_dl = {
+            'format': selected_fmt,
+            'outtmpl': '%(title)s.%(ext)s',
+            # fragments and the merge happen in .bili_staging (or --stage-dir), then one rename/copy into place
+            'paths': {'home': download_dir, 'temp': staging},
+            'merge_output_format': 'mp4',
+            'progress_hooks': [make_progress_hook(), functools.partial(
+                cdn_stats_hook, setting='aria2c -x16 -s16' if use_aria2 and aria2_path else 'native')],
+            'noprogress': False,
+            'restrictfilenames': False,
+            'quiet': False,
+            'no_warnings': True,
+            'keep_fragments': False,
+            'continuedl': True,
+            'buffersize': WRITE_BUFFER,
+            'noresizebuffer': True,
+        }
+        if selected_fmt == AUDIO_FORMAT:
+            # nothing to merge: keep the audio track as downloaded
+            del ydl_opts_dl['merge_output_format']
+            ydl_opts_dl['fixup'] = 'never'
+        if cookiefile:
+            ydl_opts_dl['cookiefile'] = cookiefile
+        if use_aria2 and aria2_path:
+            ydl_opts_dl['external_downloader'] = 'aria2c'
+            ydl_opts_dl['external_downloader_args'] = [
+                '-x', '16', '-s', '16', '-k', '1M', '--file-allocation=falloc', '--continue=true'
+            ]
+
+        # Commence download with error handling
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts_dl) as ydl:
+                cprint("\n[+] Starting download ...\n", FG_GREEN)
+                with profile_phase('download'), cdn_stats_job():
+                    ydl.download([url])
+            cprint(f"\n[+] Done. File should be in: {download_dir}", FG_GREEN)
+            if args.danmaku or args.subs:
+                fetch_text_tracks_batch([url], download_dir, args.danmaku, args.subs, cookiefile, args.jobs or 4)
+        except yt_dlp.utils.DownloadError as de:
+            cprint("[!] DownloadError: " + str(de), FG_RED)
+            cls = classify_error(de)
+            if cls == 'auth':
+                cprint("    If this is member-only content, try exporting cookies from a browser and placing cookies.txt in your storage.", FG_YELLOW)
+            elif cls in ERROR_HINTS:
+                cprint(f"    Looks {ERROR_HINTS[cls]}.", FG_YELLOW)
+        except Exception as e:
+            cprint("[!] Unexpected error: " + str(e), FG_RED)
+
+    close_size_probes()
+    CDN_STATS.flush()
+    if PROFILER:
+        PROFILER.write()
+    cprint("\n=== All tasks complete ===", FG_CYAN)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,937 @@
+import base64
+import contextlib
+import copy
+import errno
+import http.server
+import io
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.error
+
+# watermarks, caches and CDN history go to a throwaway dir, never the user's
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='bili_test_cache_')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bili_bili
+
+
+class LocalServer:
+    # Threaded http.server on 127.0.0.1; routes map a path (query stripped) to
+    # fn(handler) -> bytes, or to bytes served as-is. Requests are logged.
+    def __init__(self, routes):
+        self.routes, self.requests = routes, []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                route = server.routes.get(self.path.split('?', 1)[0])
+                if route is None:
+                    self.send_error(404)
+                    return
+                body = route(self) if callable(route) else route
+                if body is None:    # the route answered by itself
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.handle_error = lambda *args: None     # clients hanging up early is expected
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='bili_test_')
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        # fresh CDN history per test: mirror ranking blends it in
+        self.addCleanup(setattr, bili_bili, 'CDN_STATS', bili_bili.CDN_STATS)
+        bili_bili.CDN_STATS = bili_bili.CdnStats(os.path.join(self.tmp, 'cdn_stats.sqlite'))
+
+    def patch(self, name: str, value):
+        self.addCleanup(setattr, bili_bili, name, getattr(bili_bili, name))
+        setattr(bili_bili, name, value)
+
+    def serve(self, routes) -> LocalServer:
+        srv = LocalServer(routes)
+        self.addCleanup(srv.close)
+        return srv
+
+    def fake_ffmpeg(self, ok: bool = True) -> str:
+        # copies -i INPUT to the last argument, or fails like a broken remux
+        path = os.path.join(self.tmp, 'ffmpeg_ok' if ok else 'ffmpeg_bad')
+        with open(path, 'w') as fh:
+            fh.write(f"#!{sys.executable}\nimport shutil, sys\n"
+                     + ("shutil.copyfile(sys.argv[sys.argv.index('-i') + 1], sys.argv[-1])\n" if ok
+                        else "sys.exit(1)\n"))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+
+# ----- retries (yt-dlp limits, circuit breaker) -----
+class RetryTest(TempDirTest):
+    def test_yt_dlp_does_not_retry_on_its_own(self):
+        opts = bili_bili.batch_ydl_opts(self.tmp, None)
+        self.assertEqual((opts['retries'], opts['fragment_retries'], opts['extractor_retries']), (0, 0, 0))
+        self.assertFalse(opts['skip_unavailable_fragments'])
+
+    def test_interrupted_probe_lets_the_next_caller_probe(self):
+        breaker = bili_bili.CircuitBreaker('API')
+        breaker.state, breaker.until = 'open', 0.0      # cooldown over: the next call probes
+        self.patch('BREAKERS', {'API': breaker})
+
+        def interrupted(slot):
+            raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            bili_bili.with_retry(interrupted)
+        self.assertIsNone(breaker.probing)
+        done = []
+        caller = threading.Thread(target=lambda: done.append(bili_bili.with_retry(lambda slot: 'ok')),
+                                  daemon=True)
+        caller.start()
+        caller.join(5)
+        self.assertEqual(done, ['ok'])
+        self.assertEqual(breaker.state, 'closed')
+
+
+# ----- danmaku / subtitles -----
+class FakeResponse(io.BytesIO):
+    headers = {}
+
+
+def dm_segment(*comments) -> bytes:
+    # DmSegMobileReply with (ms, text) elements; only the fields the parser reads
+    def field(num: int, wire: int, payload: bytes) -> bytes:
+        return bytes([num << 3 | wire]) + payload
+
+    def varint(n: int) -> bytes:
+        out = b''
+        while True:
+            out += bytes([n & 0x7f | (0x80 if n > 0x7f else 0)])
+            n >>= 7
+            if not n:
+                return out
+    elems = b''
+    for ms, text in comments:
+        body = field(2, 0, varint(ms)) + field(7, 2, varint(len(text.encode())) + text.encode())
+        elems += field(1, 2, varint(len(body)) + body)
+    return elems
+
+
+class TextTrackTest(TempDirTest):
+    XML = (b'<?xml version="1.0" encoding="UTF-8"?><i>'
+           b'<d p="2.0,1,25,16777215,0,0,0,1">second</d><d p="1.0,1,25,16777215,0,0,0,2">first</d></i>')
+
+    def fetch(self, segment_reply) -> list:
+        def http_get(url, opener=None, headers=None, timeout=15):
+            if isinstance(segment_reply, Exception):
+                raise segment_reply
+            return segment_reply
+        self.patch('http_get', http_get)
+        self.patch('http_open', lambda url, opener=None, headers=None, timeout=15: FakeResponse(self.XML))
+        return [d.text for d in bili_bili.fetch_danmaku(1, 60)]
+
+    def test_segments_first_xml_only_when_protobuf_is_unavailable(self):
+        self.assertEqual(self.fetch(dm_segment((5000, 'late'), (1000, 'early'))), ['early', 'late'])
+        not_found = bili_bili.urllib.error.HTTPError('u', 404, 'Not Found', None, None)
+        self.assertEqual(self.fetch(not_found), ['first', 'second'])
+        self.assertEqual(self.fetch(b'\xff\xff\xff'), ['first', 'second'])     # not protobuf
+        for err in (bili_bili.urllib.error.HTTPError('u', 403, 'Forbidden', None, None),
+                    ConnectionResetError('reset'), TypeError('a bug')):
+            with self.assertRaises(type(err)):
+                self.fetch(err)
+
+    def test_ass_escape_never_produces_override_codes(self):
+        esc = bili_bili._ass_escape('C:\\new\\N {\\b1}x\nline')
+        self.assertNotIn('\\n', esc)
+        self.assertNotIn('\\\\', esc)
+        self.assertEqual(esc.replace('\u200d', ''), 'C:\\new\\N \\{\\b1\\}x\\Nline')
+
+    def test_batch_jobs_fetch_their_text_tracks(self):
+        asked, wrote = [], []
+        self.patch('iter_video_parts', lambda url, opener=None, cookiefile=None: asked.append(url) or [('T', 'BV1', 7, 60)])
+        self.patch('fetch_text_tracks', lambda part, out_dir, d, s, opener=None: wrote.append((out_dir, d, s))
+                   or {'title': part[0], 'danmaku': 3, 'subtitles': []})
+        video = os.path.join(self.tmp, 'T [BV1].mp4')
+        fn = bili_bili.with_text_tracks(lambda item: [(video, 1)], 'ass', None)
+        fn('BV1xx411c7mD')
+        fn(bili_bili.JobRecord('BV1xx411c7mD', id='BV1xx411c7mD_p2'))
+        self.assertEqual(asked, ['https://www.bilibili.com/video/BV1xx411c7mD',
+                                 'https://www.bilibili.com/video/BV1xx411c7mD?p=2'])
+        self.assertEqual(wrote, [(self.tmp, 'ass', None)] * 2)
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            bili_bili.parse_args(['--plan', 'p.json', '--danmaku', 'ass', 'BV1xx411c7mD'])
+
+
+class ModeTest(TempDirTest):
+    parse_args = staticmethod(bili_bili.parse_args)
+
+    def run_main(self, argv):
+        # stops main() right after it has picked the mode
+        picked = []
+
+        def stop(*a, **kw):
+            picked.append(bili_bili.EVENTS)
+            raise KeyboardInterrupt
+        args = self.parse_args(argv)
+        self.patch('parse_args', lambda: args)
+        self.patch('choose_download_dir', stop)
+        self.patch('EVENTS', None)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out), \
+                self.assertRaises(KeyboardInterrupt):
+            bili_bili.main()
+        return picked[0], out.getvalue()
+
+    def test_batch_only_flags_do_not_switch_to_batch(self):
+        events, out = self.run_main(['--json', '--embed', 'BV1xx411c7mD'])
+        self.assertIsNone(events)
+        self.assertIn('--json, --embed only apply to batch runs', out)
+        events, out = self.run_main(['-y', '--json', 'BV1xx411c7mD'])
+        self.assertIsNotNone(events)
+        self.assertNotIn('only apply to batch runs', out)
+
+
+# ----- live recording (FLV splitting, HLS follow, rotation, remux) -----
+FLV_HEAD = b'FLV\x01\x05\x00\x00\x00\x09' + b'\0' * 4
+
+
+def flv_tag(kind: int, ts: int, data: bytes) -> bytes:
+    tag = (bytes([kind]) + len(data).to_bytes(3, 'big') + (ts & 0xFFFFFF).to_bytes(3, 'big')
+           + bytes([ts >> 24 & 0xFF]) + b'\0\0\0' + data)
+    return tag + len(tag).to_bytes(4, 'big')
+
+
+def flv_ts(tag: bytes) -> int:
+    return int.from_bytes(tag[4:7], 'big') | tag[7] << 24
+
+
+def flv_tags(data: bytes) -> list:
+    tags, pos = [], 0
+    while pos < len(data):
+        total = 11 + int.from_bytes(data[pos + 1:pos + 4], 'big') + 4
+        tags.append(data[pos:pos + total])
+        pos += total
+    return tags
+
+
+def flv_capture(start: int = 10_000, seconds: int = 12, gop_ms: int = 2000) -> bytes:
+    # a live FLV as the CDN sends it: joined mid-GOP, timestamps far from zero
+    out = [FLV_HEAD, flv_tag(18, 0, b'\x02\x00\x0aonMetaData\x08' + b'm' * 8),
+           flv_tag(9, 0, b'\x17\x00\x00\x00\x00avcC-config'), flv_tag(8, 0, b'\xaf\x00\x12\x10aac-config')]
+    out.append(flv_tag(9, start - 40, b'\x27\x01\x00\x00\x00' + b'p' * 20))    # before any keyframe
+    for t in range(start, start + seconds * 1000, 40):
+        key = (t - start) % gop_ms == 0
+        out.append(flv_tag(9, t, (b'\x17' if key else b'\x27') + b'\x01\x00\x00\x00' + b'v' * 30))
+        out.append(flv_tag(8, t, b'\xaf\x01' + b'a' * 12))
+    return b''.join(out)
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.segments = []
+
+    def rotate(self, header: bytes = b''):
+        self.segments.append(bytearray(header))
+
+    def write(self, data: bytes):
+        self.segments[-1] += data
+
+
+class FlvSplitterTest(unittest.TestCase):
+    def test_cuts_at_keyframes_with_rebased_headers(self):
+        capture = flv_capture()
+        writer = RecordingWriter()
+        splitter = bili_bili.FlvSplitter(writer, segment=4)
+        for i in range(0, len(capture), 7):     # tags arrive split across reads
+            splitter.feed(capture[i:i + 7])
+        self.assertEqual(len(writer.segments), 3)
+        for seg in writer.segments:
+            self.assertTrue(seg.startswith(FLV_HEAD))
+            tags = flv_tags(bytes(seg[13:]))
+            self.assertEqual([t[0] for t in tags[:3]], [18, 9, 8])     # meta + AVC/AAC config first
+            self.assertEqual([flv_ts(t) for t in tags[:3]], [0, 0, 0])
+            self.assertEqual(tags[3][11], 0x17)                        # media starts on a keyframe at 0
+            self.assertEqual(flv_ts(tags[3]), 0)
+            self.assertEqual(max(flv_ts(t) for t in tags), 4000 - 40)
+        self.assertNotIn(b'p' * 20, b''.join(writer.segments))
+
+
+class LiveReplayTest(TempDirTest):
+    def record(self, fn, url, ext, segment, closed):
+        storage = bili_bili.StorageManager([self.tmp])
+        writer = bili_bili.SegmentWriter(storage, 'live_1', ext, lambda p, r: closed.append((p, r)),
+                                         segment, rate=1024)
+        try:
+            return fn(url, writer, segment, threading.Event()), storage
+        finally:
+            writer.close()
+
+    def test_flv_stream_rotates_segments_and_remuxes(self):
+        capture = flv_capture()
+        srv = self.serve({'/live.flv': capture})
+        closed = []
+        got, storage = self.record(bili_bili.record_flv, srv.url + '/live.flv', 'flv', 4, closed)
+        self.assertEqual(got, len(capture))
+        self.assertEqual(len(closed), 3)
+        for path, _ in closed:
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(13), FLV_HEAD)
+        # one remux goes through, one fails and keeps the raw file
+        (p1, root), (p2, _) = closed[:2]
+        bili_bili.remux_segment(p1, root, storage, self.fake_ffmpeg(ok=True))
+        bili_bili.remux_segment(p2, root, storage, self.fake_ffmpeg(ok=False))
+        done = sorted(os.listdir(self.tmp))
+        self.assertIn(os.path.splitext(os.path.basename(p1))[0] + '.mp4', done)
+        self.assertIn(os.path.basename(p2), done)
+        self.assertFalse(os.path.exists(p1) or os.path.exists(p2))
+
+    def test_hls_follows_master_and_rotates_on_duration(self):
+        init = b'INIT-fmp4'
+        media = [
+            '#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MAP:URI="init.mp4"\n'
+            + ''.join(f'#EXTINF:2.0,\nseg{i}.m4s?tok=a\n' for i in range(0, 4)),
+            '#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MAP:URI="init.mp4"\n'
+            + ''.join(f'#EXTINF:2.0,\nseg{i}.m4s?tok=b\n' for i in range(2, 6)) + '#EXT-X-ENDLIST\n',
+        ]
+        polls = []
+
+        def playlist(_h):
+            polls.append(1)
+            return media[min(len(polls), len(media)) - 1].encode()
+        routes = {'/master.m3u8': b'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1\nsub/media.m3u8\n',
+                  '/sub/media.m3u8': playlist, '/sub/init.mp4': init}
+        routes.update({f'/sub/seg{i}.m4s': f'<seg{i}>'.encode() for i in range(6)})
+        srv = self.serve(routes)
+        closed = []
+        got, _ = self.record(bili_bili.record_hls, srv.url + '/master.m3u8', 'm4s', 4, closed)
+        fetched = [p.split('?')[0] for p in srv.requests if '.m4s' in p]
+        self.assertEqual(fetched, [f'/sub/seg{i}.m4s' for i in range(6)])      # overlap fetched once
+        self.assertEqual(srv.requests.count('/sub/init.mp4'), 1)
+        self.assertEqual(got, sum(len(f'<seg{i}>') for i in range(6)))
+        contents = []
+        for path, _ in closed:
+            with open(path, 'rb') as fh:
+                contents.append(fh.read())
+        self.assertEqual(contents, [init + b'<seg0><seg1>', init + b'<seg2><seg3>', init + b'<seg4><seg5>'])
+
+    def test_hls_playlist_that_stops_advancing_raises(self):
+        srv = self.serve({'/media.m3u8': b'#EXTM3U\n#EXT-X-TARGETDURATION:0.3\n#EXTINF:0.3,\nseg0.ts\n',
+                          '/seg0.ts': b'ts-data'})
+        with self.assertRaisesRegex(bili_bili.ApiError, 'stopped advancing'):
+            self.record(bili_bili.record_hls, srv.url + '/media.m3u8', 'ts', 60, [])
+        self.assertEqual(sum(1 for p in srv.requests if p == '/seg0.ts'), 1)
+
+
+# ----- CDN mirrors (race, failover, local write errors) -----
+def mirror(data: bytes, rate: float | None = None, die_at: int | None = None, status: int | None = None):
+    # Range-serving route: `rate` bytes/s, a connection cut once the transfer
+    # reaches offset `die_at` (503 for everything after), or a fixed error status
+    ranges, state = [], {'dead': False}
+
+    def serve(h):
+        first, _, last = h.headers['Range'].removeprefix('bytes=').partition('-')
+        start, end = int(first), int(last) if last else len(data) - 1
+        ranges.append((start, end))
+        if status or state['dead']:
+            h.send_error(status or 503)
+            return None
+        h.send_response(206)
+        h.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        h.send_header('Content-Length', str(end + 1 - start))
+        h.end_headers()
+        pos = start
+        while pos <= end:
+            if die_at is not None and pos >= die_at:
+                state['dead'] = True
+                return None
+            stop = min(end + 1, pos + 16 * 1024, die_at if die_at is not None and die_at > pos else end + 1)
+            h.wfile.write(data[pos:stop])
+            if rate:
+                time.sleep((stop - pos) / rate)
+            pos = stop
+        return None
+    serve.ranges = ranges
+    return serve
+
+
+class MirrorTest(TempDirTest):
+    CHUNK = 256 * 1024
+
+    def setUp(self):
+        super().setUp()
+        self.patch('RACE_PROBE_BYTES', 64 * 1024)
+        self.patch('RACE_WINDOW', 0.3)
+        self.data = os.urandom(1024 * 1024)
+        self.out = os.path.join(self.tmp, 'stream.m4s')
+
+    def mirrors(self, *routes) -> list:
+        return [self.serve({'/v.m4s': r}).url + '/v.m4s?deadline=1' for r in routes]
+
+    def download_ranges(self, route) -> list:
+        # the downloader's requests, not the race probes
+        return [r for r in route.ranges if r[1] + 1 - r[0] != bili_bili.RACE_PROBE_BYTES]
+
+    def test_race_prefers_the_fastest_mirror(self):
+        slow, fast, broken = mirror(self.data, rate=256 * 1024), mirror(self.data), mirror(self.data, status=403)
+        urls = self.mirrors(slow, fast, broken)
+        ranked = bili_bili.race_mirrors(urls)
+        self.assertEqual([r['url'] for r in ranked], [urls[1], urls[0], urls[2]])
+        self.assertIsNotNone(ranked[2]['error'])
+        dl = bili_bili.MirrorDownloader(urls, self.out, chunk_size=self.CHUNK, min_speed=0)
+        self.assertEqual(dl.run(), len(self.data))
+        with open(self.out, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(len(self.download_ranges(fast)), 4)
+        self.assertEqual(self.download_ranges(slow), [])
+        self.assertFalse(os.path.exists(self.out + '.part' + bili_bili.RESUME_SUFFIX))
+
+    def test_failover_mid_chunk_keeps_the_bytes_already_written(self):
+        cut = self.CHUNK + 100_000
+        flaky, backup = mirror(self.data, die_at=cut), mirror(self.data, rate=4 * 1024 * 1024)
+        dl = bili_bili.MirrorDownloader(self.mirrors(flaky, backup), self.out, chunk_size=self.CHUNK, min_speed=0)
+        self.assertEqual(dl.run(), len(self.data))
+        with open(self.out, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(dl.switches, 1)
+        # the backup picks up where the cut left off, inside chunk 1
+        self.assertEqual(self.download_ranges(backup)[0], (cut, 2 * self.CHUNK - 1))
+
+    def test_disk_error_ends_the_job_without_blaming_the_cdn(self):
+        class FullDisk(bili_bili.CoalescingWriter):
+            def write(self, data):
+                if self.pos + len(self.buf) + len(data) > 300_000:
+                    raise OSError(errno.ENOSPC, 'No space left on device')
+                return super().write(data)
+        self.patch('CoalescingWriter', FullDisk)
+        a, b = mirror(self.data), mirror(self.data, rate=4 * 1024 * 1024)
+        errors = bili_bili.METRICS.counters['cdn_errors']
+        dl = bili_bili.MirrorDownloader(self.mirrors(a, b), self.out, chunk_size=self.CHUNK, min_speed=0)
+        with self.assertRaises(OSError) as ctx:
+            dl.run()
+        self.assertEqual(bili_bili.classify_error(ctx.exception), 'storage')
+        self.assertEqual(dl.switches, 0)
+        self.assertEqual(bili_bili.METRICS.counters['cdn_errors'], errors)
+        self.assertFalse(any(p[3] for p in bili_bili.CDN_STATS.pending.values()))
+        self.assertEqual(len(self.download_ranges(a)) + len(self.download_ranges(b)), 2)
+
+
+class SizeProbeTest(TempDirTest):
+    def test_probe_pool_is_reused_then_shut_down(self):
+        self.addCleanup(bili_bili.close_size_probes)
+        url = self.serve({'/v.m4s': mirror(b'x' * 5000)}).url + '/v.m4s'
+        formats = [{'format_id': str(i), 'url': url} for i in range(3)]
+        self.assertEqual(bili_bili.fill_format_sizes(formats), 3)
+        pool = bili_bili._probe_pool
+        bili_bili.fill_format_sizes([{'format_id': '9', 'url': url}])
+        self.assertIs(bili_bili._probe_pool, pool)
+        self.assertEqual([f['filesize'] for f in formats], [5000] * 3)
+        bili_bili.close_size_probes()
+        self.assertIsNone(bili_bili._probe_pool)
+        self.assertFalse(any(t.is_alive() for t in pool._threads))
+
+
+# ----- egress (CONNECT proxies, pool health) -----
+class ConnectProxy:
+    # Minimal CONNECT proxy: answers `reply` (optionally demanding Basic auth),
+    # then relays. Bytes the target sends first go out with the reply header.
+    def __init__(self, reply: bytes = b'200 Connection established', auth: tuple | None = None):
+        self.reply, self.auth, self.requests = reply, auth, []
+        proxy = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                head = b''
+                while b'\r\n\r\n' not in head:
+                    b = self.request.recv(4096)
+                    if not b:
+                        return
+                    head += b
+                lines = head.decode().split('\r\n')
+                proxy.requests.append(lines[0])
+                want = proxy.auth and 'Proxy-Authorization: Basic ' + base64.b64encode(':'.join(proxy.auth).encode()).decode()
+                if want and want not in lines:
+                    self.request.sendall(b'HTTP/1.1 407 Proxy Authentication Required\r\n\r\n')
+                    return
+                if not proxy.reply.startswith(b'200'):
+                    self.request.sendall(b'HTTP/1.1 ' + proxy.reply + b'\r\n\r\n')
+                    return
+                host, port = lines[0].split()[1].rsplit(':', 1)
+                up = socket.create_connection((host, int(port)))
+                up.settimeout(0.1)
+                try:
+                    greeting = up.recv(4096)
+                except socket.timeout:
+                    greeting = b''
+                up.settimeout(None)
+                self.request.sendall(b'HTTP/1.1 ' + proxy.reply + b'\r\n\r\n' + greeting)
+                t = threading.Thread(target=self.pipe, args=(up, self.request), daemon=True)
+                t.start()
+                self.pipe(self.request, up)
+                t.join()
+                up.close()
+
+            @staticmethod
+            def pipe(src, dst):
+                with contextlib.suppress(OSError):
+                    while b := src.recv(65536):
+                        dst.sendall(b)
+                    dst.shutdown(socket.SHUT_WR)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def spec(self, cred: str = '') -> str:
+        return f"http://{cred}127.0.0.1:{self.port}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class EgressTest(TempDirTest):
+    def proxy(self, *args, **kwargs) -> ConnectProxy:
+        p = ConnectProxy(*args, **kwargs)
+        self.addCleanup(p.close)
+        return p
+
+    def talker(self) -> int:
+        # a server that speaks first, like SMTP; its greeting tests the CONNECT reply parsing
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.sendall(b'HELLO\n')
+                self.request.sendall(self.request.recv(100).upper())
+        srv = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        self.addCleanup(srv.server_close)
+        self.addCleanup(srv.shutdown)
+        return srv.server_address[1]
+
+    def recv_exactly(self, sock, n: int) -> bytes:
+        data = b''
+        while len(data) < n:
+            b = sock.recv(n - len(data))
+            if not b:
+                break
+            data += b
+        return data
+
+    def test_connect_200_keeps_bytes_after_the_header(self):
+        proxy = self.proxy()
+        port = self.talker()
+        sock = bili_bili.Egress(proxy.spec()).create_connection(('127.0.0.1', port), 5)
+        with sock:
+            self.assertEqual(self.recv_exactly(sock, 6), b'HELLO\n')
+            sock.sendall(b'ping')
+            self.assertEqual(self.recv_exactly(sock, 4), b'PING')
+        self.assertEqual(proxy.requests, [f'CONNECT 127.0.0.1:{port} HTTP/1.1'])
+
+    def test_http_request_through_the_tunnel(self):
+        proxy = self.proxy(auth=('user', 'p w'))
+        srv = self.serve({'/x': b'through the proxy'})
+        e = bili_bili.Egress(proxy.spec('user:p%20w@'))
+        with bili_bili.use_egress(e):
+            self.assertEqual(bili_bili.http_get(srv.url + '/x'), b'through the proxy')
+        self.assertEqual(srv.requests, ['/x'])
+
+    def test_407_and_other_refusals(self):
+        port = self.talker()
+        with self.assertRaisesRegex(ConnectionRefusedError, 'proxy authentication required'):
+            bili_bili.Egress(self.proxy(auth=('user', 'pw')).spec()).create_connection(('127.0.0.1', port), 5)
+        with self.assertRaisesRegex(ConnectionRefusedError, '502 Bad Gateway'):
+            bili_bili.Egress(self.proxy(b'502 Bad Gateway').spec()).create_connection(('127.0.0.1', port), 5)
+        self.assertEqual(bili_bili.classify_error(ConnectionRefusedError('x')), 'network')
+
+    def test_pool_rests_throttled_marks_down_and_recovers(self):
+        self.patch('EGRESS_CHECK_EVERY', 0.1)
+        srv = self.serve({'/zone': b'{"code": 0}'})
+        self.patch('EGRESS_CHECK_URL', srv.url + '/zone')
+        with socket.socket() as s:          # a port nothing listens on
+            s.bind(('127.0.0.1', 0))
+            dead_port = s.getsockname()[1]
+        e1, e2 = bili_bili.Egress(self.proxy().spec()), bili_bili.Egress(self.proxy().spec())
+        dead = bili_bili.Egress(f'http://127.0.0.1:{dead_port}')
+        pool = bili_bili.EgressPool([e1, e2, dead])
+        self.addCleanup(pool.stop)
+        pool.start()
+        self.assertEqual([e.down for e in (e1, e2, dead)], [False, False, True])
+        self.assertIsNotNone(e1.latency)
+        # a throttled job sends its egress to rest; new jobs go elsewhere
+        with self.assertRaises(urllib.error.HTTPError):
+            with pool.lease(e1.name):
+                raise urllib.error.HTTPError(srv.url, 429, 'Too Many Requests', None, None)
+        self.assertGreater(e1.rest_until, time.time())
+        with pool.lease() as lease:
+            self.assertIs(lease.egress, e2)
+        # repeated network failures take it down until a health check passes again
+        for _ in range(bili_bili.EGRESS_FAILS):
+            with self.assertRaises(ConnectionResetError):
+                with pool.lease(e2.name):
+                    raise ConnectionResetError('reset by peer')
+        self.assertTrue(e2.down)
+        deadline = time.time() + 5
+        while e2.down and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(e2.down)
+        self.assertTrue(dead.down)
+        pool.stop()
+        self.assertIsNone(pool._checker)
+
+    def test_pool_with_every_egress_down_refuses_jobs(self):
+        srv = self.serve({})
+        self.patch('EGRESS_CHECK_URL', srv.url + '/zone')
+        pool = bili_bili.EgressPool([bili_bili.Egress(self.proxy(b'503 Service Unavailable').spec())])
+        self.addCleanup(pool.stop)
+        pool.start()
+        with self.assertRaisesRegex(bili_bili.ApiError, 'all are down'):
+            pool.acquire()
+
+
+# ----- URL ingestion (watch folder) -----
+class InboxTest(TempDirTest):
+    def test_watch_releases_its_inotify_fd(self):
+        def fds():
+            return len(os.listdir('/proc/self/fd'))
+        with open(os.path.join(self.tmp, 'a.txt'), 'w') as fh:
+            fh.write('BV1xx411c7mD\n')
+        before = fds()
+        with contextlib.redirect_stdout(io.StringIO()):
+            inbox = bili_bili.iter_inbox(self.tmp, poll=0.01)
+            self.assertEqual(next(inbox), 'BV1xx411c7mD\n')
+            inbox.close()
+        self.assertEqual(fds(), before)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'done')))
+
+
+# ----- tag embedding (in-place MP4 moov rewrite) -----
+MVHD = bili_bili._box(b'mvhd', b'\0' * 4 + struct.pack('>IIII', 0, 0, 1000, 5000) + b'\0' * 80)
+
+
+class EmbedTest(TempDirTest):
+    def mp4(self, *layout):
+        boxes = {'moov': bili_bili._box(b'moov', MVHD), 'free': bili_bili._box(b'free', b'\0' * 4000),
+                 'mdat': bili_bili._box(b'mdat', b'x' * 100)}
+        path = os.path.join(self.tmp, 'v.mp4')
+        with open(path, 'wb') as fh:
+            fh.write(bili_bili._box(b'ftyp', b'isom\0\0\0\0isom') + b''.join(boxes[k] for k in layout))
+        return path
+
+    def layout(self, path):
+        with open(path, 'rb') as fh:
+            return [kind.decode() for kind, *_ in bili_bili._file_boxes(fh, os.path.getsize(path))]
+
+    def title(self, path):
+        with open(path, 'rb') as fh:
+            top = bili_bili._file_boxes(fh, os.path.getsize(path))
+            _, pos, size, _, _ = next(b for b in top if b[0] == b'moov')   # the first moov is the one read
+            fh.seek(pos)
+            moov = fh.read(size)
+        return re.search(rb'\xa9nam.{4}data.{8}([^\0]*)', moov, re.S).group(1) if b'\xa9nam' in moov else None
+
+    def test_new_moov_never_overwrites_the_old_one(self):
+        meta = {'title': 'new', 'chapters': [(0, 5, 'intro')]}
+        for layout, how, after in (
+                (('moov', 'free', 'mdat'), 'padding', ['ftyp', 'free', 'moov', 'free', 'mdat']),
+                (('mdat', 'moov'), 'tail', ['ftyp', 'mdat', 'free', 'moov']),
+                (('moov', 'mdat'), 'moov moved to end', ['ftyp', 'free', 'mdat', 'moov'])):
+            path = self.mp4(*layout)
+            self.assertEqual(bili_bili.mp4_embed_in_place(path, meta, None), f"in place ({how})")
+            self.assertEqual(self.layout(path), after)
+            self.assertEqual(self.title(path), b'new')
+
+    def test_crash_before_the_flip_keeps_the_old_tags(self):
+        path = self.mp4('moov', 'free', 'mdat')
+        bili_bili.mp4_embed_in_place(path, {'title': 'old'}, None)
+        with unittest.mock.patch('os.fsync', side_effect=OSError(errno.EIO, 'power cut')), \
+                self.assertRaises(OSError):
+            bili_bili.mp4_embed_in_place(path, {'title': 'new'}, None)
+        self.assertEqual(self.title(path), b'old')
+        self.assertEqual(self.layout(path).count('moov'), 2)
+
+
+# ----- lean job queue (memory, lazy collection listing) -----
+RECORD_BUDGET = 4096        # bytes of peak RSS per queued job
+
+
+def synthetic_entry(i: int, rnd: random.Random) -> dict:
+    # what yt-dlp's BiliBili extractor returns for one video, at realistic size
+    heights = {30080: 1080, 30077: 1080, 30064: 720, 30032: 480, 30016: 360}
+    headers = {'User-Agent': bili_bili.API_HEADERS['User-Agent'], 'Referer': 'https://www.bilibili.com/',
+               'Accept': '*/*', 'Accept-Language': 'en-us,en;q=0.5', 'Sec-Fetch-Mode': 'navigate'}
+    bvid = f"BV1{i:09d}"
+    deadline = int(time.time()) + 7200
+    formats = []
+    for fid, vcodec in itertools.product(heights, ('avc1', 'hev1', 'av01')):
+        height = heights[fid]
+        url = (f"https://upos-sz-mirrorcos.bilivideo.com/upgcxcode/{i}/{fid}-{vcodec}.m4s"
+               f"?e={'x' * 120}&deadline={deadline}&upsig={rnd.getrandbits(128):032x}")
+        formats.append({'format_id': f"{fid}-{vcodec}", 'url': url, 'ext': 'mp4', 'protocol': 'https',
+                        'vcodec': vcodec, 'acodec': 'none', 'width': height * 16 // 9, 'height': height,
+                        'fps': 30.0, 'tbr': rnd.uniform(300, 3000), 'filesize': rnd.randrange(10 ** 7, 10 ** 9),
+                        'http_headers': dict(headers), 'format_note': f"{height}P",
+                        'fragments': [{'url': url, 'duration': 5.0} for _ in range(6)],
+                        'downloader_options': {'http_chunk_size': 10485760},
+                        'backup_url': [url.replace('mirrorcos', 'mirrorali'), url.replace('mirrorcos', 'mirrorhw')]})
+    for fid, tbr in ((30280, 320), (30232, 128), (30216, 64)):
+        url = f"https://upos-sz-mirrorcos.bilivideo.com/upgcxcode/{i}/{fid}.m4s?deadline={deadline}&e={'y' * 120}"
+        formats.append({'format_id': str(fid), 'url': url, 'ext': 'm4a', 'protocol': 'https', 'vcodec': 'none',
+                        'acodec': 'mp4a.40.2', 'tbr': tbr, 'filesize': rnd.randrange(10 ** 6, 10 ** 8),
+                        'http_headers': dict(headers)})
+    return {'id': bvid, 'title': f"synthetic video {i} " + '标题' * 20, 'duration': rnd.uniform(60, 3600),
+            'webpage_url': f"https://www.bilibili.com/video/{bvid}", 'extractor_key': 'BiliBili',
+            'description': 'desc ' * 200, 'tags': [f"tag{j}" for j in range(20)],
+            'thumbnails': [{'url': f"https://i0.hdslb.com/{i}_{j}.jpg", 'id': str(j)} for j in range(5)],
+            'formats': formats, 'http_headers': dict(headers)}
+
+
+def memory_probe(n: int) -> dict:
+    # Run in a fresh interpreter (see measure_memory): queue a lazily listed
+    # n-entry collection the way run_batch does - ids off _iter_entry_ids, one
+    # JobRecord per extracted entry, into an ordered JobQueue whose downloads are
+    # stalled so every record sits queued - and report the process's peak RSS.
+    import gc
+    import resource
+    rnd = random.Random(42)
+    selector = bili_bili.yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True})
+    collection = {'_type': 'playlist', 'entries': (
+        {'_type': 'url', 'url': f"https://www.bilibili.com/video/BV1{i:09d}", 'ie_key': 'BiliBili'}
+        for i in range(n))}
+    info = synthetic_entry(0, rnd)
+    bili_bili.select_for_plan(selector, info, bili_bili.BEST_FORMAT)  # warm the format machinery first
+    del info
+    gc.collect()
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    release = threading.Event()
+    errors = []
+    jq = bili_bili.JobQueue(lambda rec: release.wait() and [], 4,
+                            lambda rec, files, err: err and errors.append(err), order='size')
+    queued = 0
+    for i, vid in enumerate(bili_bili._iter_entry_ids(selector, collection)):
+        info = synthetic_entry(i, rnd)
+        rec = bili_bili.JobRecord.from_info(vid, info, bili_bili.select_for_plan(selector, info, bili_bili.BEST_FORMAT),
+                                            'best')
+        del info
+        jq.put(rec, rec.bytes)
+        queued += 1
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    release.set()
+    jq.join()
+    selector.close()
+    # ru_maxrss is in KiB on Linux / Android
+    return {'jobs': queued, 'base_rss': base * 1024, 'peak_rss': peak * 1024, 'failed': len(errors)}
+
+
+def measure_memory(n: int) -> dict:
+    # memory_probe in its own interpreter, so nothing this process allocated counts
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = (f"import sys, json; sys.path.insert(0, {here!r}); "
+            f"import test_bili_bili; print(json.dumps(test_bili_bili.memory_probe({int(n)})))")
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"memory probe failed: {proc.stderr.strip()[-500:]}")
+    res = json.loads(proc.stdout.strip().splitlines()[-1])
+    res['per_job'] = (res['peak_rss'] - res['base_rss']) / max(1, res['jobs'])
+    return res
+
+
+class LeanQueueMemoryTest(unittest.TestCase):
+    def test_5000_entry_collection_stays_under_rss_budget(self):
+        # the probe runs in its own interpreter; only the queueing path counts
+        res = measure_memory(5000)
+        self.assertEqual(res['jobs'], 5000)
+        self.assertEqual(res['failed'], 0)
+        self.assertLessEqual(res['per_job'], RECORD_BUDGET, f"{res['per_job']:.0f} bytes of peak RSS per queued job")
+
+
+class CdnStatsTest(TempDirTest):
+    def test_hook_state_lives_for_one_job(self):
+        def progress(name, status, done):
+            bili_bili.cdn_stats_hook({'filename': name, 'status': status, 'downloaded_bytes': done,
+                                      'info_dict': {'url': 'https://upos-hz.bilivideo.com/x.m4s'}})
+        with bili_bili.cdn_stats_job():
+            progress('a.mp4', 'downloading', 0)
+            progress('b.mp4', 'downloading', 0)   # fails without an 'error' report
+            progress('a.mp4', 'finished', 100)
+            self.assertEqual(list(bili_bili._stats_local.files), ['b.mp4'])
+        self.assertFalse(hasattr(bili_bili._stats_local, 'files'))
+        seen = []
+        worker = threading.Thread(target=lambda: seen.append(hasattr(bili_bili._stats_local, 'files')))
+        with bili_bili.cdn_stats_job():
+            progress('c.mp4', 'downloading', 0)
+            worker.start()
+            worker.join()
+        self.assertEqual(seen, [False])   # other threads' jobs never see this one's files
+
+    def test_samples_are_recorded_while_sqlite_is_busy(self):
+        stats = bili_bili.CDN_STATS
+        stats.record('a.example', 10 ** 6, 1.0)
+        stats.flush()
+        with stats.db_lock:                 # a flush or query in progress
+            recorded = threading.Thread(target=stats.record, args=('a.example', 10 ** 6, 1.0))
+            recorded.start()
+            recorded.join(5)
+            self.assertFalse(recorded.is_alive())
+        stats.flush()
+        self.assertEqual(stats._query("SELECT samples, bytes FROM host_stats"), [(2, 2 * 10 ** 6)])
+
+
+class FakeYdl:
+    # process_ie_result mutates what it is given, as yt-dlp does, and fails the first time
+    def __init__(self, fresh=None):
+        self.seen, self.states, self.extracted, self.fresh = [], [], 0, fresh
+
+    def process_ie_result(self, res, download=True):
+        self.seen.append(res)
+        self.states.append((len(res.get('formats') or []), 'requested_downloads' in res))
+        res['requested_downloads'] = []
+        res.pop('formats', None)
+        if len(self.seen) == 1:
+            raise ConnectionResetError('reset by peer')
+        return res
+
+    def extract_info(self, url, download=False, process=False):
+        self.extracted += 1
+        return self.fresh()
+
+
+class StreamReuseTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        self.patch('RETRY_POLICIES', {**bili_bili.RETRY_POLICIES,
+                                      'network': bili_bili.RetryPolicy(tries=3, requeues=0, base=0.0)})
+
+    def test_every_attempt_processes_a_pristine_result(self):
+        info = synthetic_entry(1, random.Random(1))
+        ydl = FakeYdl()
+        self.patch('thread_ydl', lambda opts, opened: ydl)
+        self.assertEqual(bili_bili.download_vid(info['id'], {'format': 'x'}, [], ie_result=info), [])
+        self.assertEqual(len(ydl.seen), 2)
+        self.assertIsNot(ydl.seen[0], ydl.seen[1])
+        self.assertEqual(ydl.states, [(18, False), (18, False)])
+        self.assertEqual(len(info['formats']), 18)     # the caller's dict is left alone too
+
+    def test_anthology_is_listed_again_for_a_retry(self):
+        lists = []
+
+        def playlist():
+            lists.append({'_type': 'playlist', 'entries': iter([])})
+            return lists[-1]
+        ydl = FakeYdl(playlist)
+        self.patch('thread_ydl', lambda opts, opened: ydl)
+        bili_bili.download_vid('BV1xx411c7mD', {'format': 'x'}, [], ie_result=playlist())
+        self.assertEqual(ydl.extracted, 1)
+        self.assertEqual(ydl.seen, lists)
+
+    def test_disk_copy_is_a_processable_video_result(self):
+        info = synthetic_entry(2, random.Random(2))
+        cache = bili_bili.StreamUrlCache()
+        cache.put(info['id'], info)
+        cache.mem.clear()                   # as after a restart
+        again = cache.get(info['id'])
+        picked = []
+        for res in (copy.deepcopy(info), again):
+            with bili_bili.yt_dlp.YoutubeDL({'quiet': True, 'format': 'bestvideo+bestaudio'}) as ydl:
+                out = ydl.process_ie_result(res, download=False)
+            picked.append([f['format_id'] for f in out['requested_formats']])
+        self.assertEqual(picked[0], picked[1])
+        cache.put('BV1anthology', {'_type': 'playlist', 'entries': iter([])})
+        self.assertIsNone(cache.get('BV1anthology'))
+
+    def test_metadata_cache_is_not_reused_past_the_url_deadline(self):
+        extracted = []
+
+        class Ydl:
+            def extract_info(self, url, download=False):
+                extracted.append(url)
+                return synthetic_entry(3, random.Random(3))
+        self.patch('thread_ydl', lambda opts, opened: Ydl())
+        self.patch('fill_format_sizes', lambda formats, vid=None: None)
+        bili_bili.cached_extract('BV1000000003', None, [])
+        bili_bili.cached_extract('BV1000000003', None, [])
+        self.assertEqual(len(extracted), 1)
+        path = bili_bili._meta_path('BV1000000003')
+        with open(path, encoding='utf-8') as fh:
+            entries = json.load(fh)
+        entries[0]['_expires'] = int(time.time()) + 30      # signed URLs about to lapse
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump(entries, fh)
+        bili_bili.cached_extract('BV1000000003', None, [])
+        self.assertEqual(len(extracted), 2)
+
+
+class LazyListingTest(unittest.TestCase):
+    # iter_video_ids over yt-dlp's own extract_info(process=False): the space
+    # extractor is swapped for a fake whose entries come a page at a time
+    def listing(self, entries_for):
+        from yt_dlp.extractor import bilibili as ie
+        pulled = []
+
+        def real_extract(ie_self, url):
+            uid = ie_self._match_id(url)
+            return ie_self.playlist_result(entries_for(ie_self, uid, pulled), uid, f"space {uid}")
+        original = ie.BilibiliSpaceVideoIE._real_extract
+        ie.BilibiliSpaceVideoIE._real_extract = real_extract
+        self.addCleanup(setattr, ie.BilibiliSpaceVideoIE, '_real_extract', original)
+        return bili_bili.iter_video_ids('https://space.bilibili.com/1/video'), pulled
+
+    def test_paged_entries_are_fetched_as_ids_are_consumed(self):
+        from yt_dlp.utils import OnDemandPagedList
+
+        def entries(ie_self, uid, pulled):
+            def page(n):
+                pulled.append((uid, n))
+                for k in range(n * 30, min(n * 30 + 30, 95)):
+                    yield ie_self.url_result(f"https://www.bilibili.com/video/BV1{k:09d}", 'BiliBili')
+            return OnDemandPagedList(page, 30)
+        ids, pulled = self.listing(entries)
+        self.assertEqual([next(ids) for _ in range(5)], [f"BV1{k:09d}" for k in range(5)])
+        self.assertEqual(pulled, [('1', 0)])
+        self.assertEqual(len(list(ids)), 90)
+        self.assertEqual(pulled, [('1', n) for n in range(4)])
+
+    def test_generator_entries_and_nested_lists_stay_lazy(self):
+        def entries(ie_self, uid, pulled):
+            for k in range(3):
+                pulled.append((uid, k))
+                yield ie_self.url_result(f"https://www.bilibili.com/video/BV1{int(uid) * 10 + k:09d}", 'BiliBili')
+            if uid == '1':      # a nested collection is only opened when the walk reaches it
+                pulled.append((uid, 'nested'))
+                yield ie_self.url_result('https://space.bilibili.com/2/video', 'BilibiliSpaceVideo')
+        ids, pulled = self.listing(entries)
+        self.assertEqual(next(ids), 'BV1000000010')
+        self.assertEqual(pulled, [('1', 0)])
+        self.assertEqual(list(ids), ['BV1000000011', 'BV1000000012', 'BV1000000020', 'BV1000000021',
+                                     'BV1000000022'])
+        self.assertEqual(pulled[3:5], [('1', 'nested'), ('2', 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()